@@ -7,6 +7,7 @@ import logging
 from info import *
 from pyrogram import Client
 from TechVJ.util.config_parser import TokenParser
+from TechVJ.util.session_store import session_name, lock_session
 from TechVJ.bot import multi_clients, work_loads, TechVJBot
 
 
@@ -24,14 +25,20 @@ async def initialize_clients():
             if client_id == len(all_tokens):
                 await asyncio.sleep(2)
                 print("This will take some time, please wait...")
+            name = session_name(token)
+            # keep the session (and its auth key) on disk unless another process still holds it
+            persistent = await lock_session(name)
+            if not persistent:
+                logging.warning(f"Session of Client {client_id} is locked, starting it in memory")
             client = await Client(
-                name=str(client_id),
+                name=name,
                 api_id=API_ID,
                 api_hash=API_HASH,
                 bot_token=token,
                 sleep_threshold=SLEEP_THRESHOLD,
                 no_updates=True,
-                in_memory=True
+                workdir=SESSION_DIR,
+                in_memory=not persistent
             ).start()
             work_loads[client_id] = 0
             return client_id, client
@@ -0,0 +1,103 @@
+import math
+import time
+import asyncio
+import logging
+from info import *
+from aiohttp import web
+from collections import Counter
+from TechVJ.bot import multi_clients
+from TechVJ.util.custom_dl import ByteStreamer
+from TechVJ.util.scheduler import scheduler, INTERACTIVE
+
+PAGE = "page"
+STREAM = "stream"
+
+
+class AdmissionController:
+    def __init__(self):
+        """Load shedding for new work when every client is saturated.
+        Load is the scheduler's fetch slots (all taken, or playing viewers already queueing for
+        one), the number of GetFile calls in flight (against ADMISSION_MAX_INFLIGHT per client,
+        it also counts fetches outside the scheduler like header reads) and the event loop lag. Over the limit, new streams wait up to ADMISSION_WAIT seconds
+        for room and are then refused with 503 + Retry-After. Watch pages only care about loop
+        lag (they don't fetch chunks) and new streams give way while pages are waiting.
+        Ranges of already playing viewers are never queued here.
+        attributes:
+            lag: smoothed event loop lag in seconds, measured by run.
+        """
+        self.lag = 0.0
+        self.waiting: Counter = Counter()
+        self.admitted: Counter = Counter()
+        self.rejected: Counter = Counter()
+
+    @property
+    def capacity(self) -> int:
+        return ADMISSION_MAX_INFLIGHT * max(len(multi_clients), 1)
+
+    def overloaded(self, kind: str) -> bool:
+        max_lag = ADMISSION_MAX_LAG / 1000
+        if kind == PAGE:
+            return self.lag > max_lag * 2
+        return (
+            self.saturated
+            or ByteStreamer.in_flight >= self.capacity
+            or self.lag > max_lag
+            or self.waiting[PAGE] > 0
+        )
+
+    @property
+    def saturated(self) -> bool:
+        """
+        No fetch slot to spare: a new stream would only queue behind the viewers already playing.
+        """
+        return scheduler.in_use >= scheduler.capacity or scheduler.waiting(INTERACTIVE) > 0
+
+    async def admit(self, kind: str) -> bool:
+        if not self.overloaded(kind) and not self.waiting[kind]:
+            self.admitted[kind] += 1
+            return True
+        self.waiting[kind] += 1
+        deadline = time.monotonic() + ADMISSION_WAIT
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+                if not self.overloaded(kind):
+                    self.admitted[kind] += 1
+                    return True
+        finally:
+            self.waiting[kind] -= 1
+        self.rejected[kind] += 1
+        logging.warning(f"Shed a new {kind}: {scheduler.in_use}/{scheduler.capacity} slots in use, "
+                        f"{ByteStreamer.in_flight} GetFile calls in flight, loop lag {self.lag * 1000:.0f} ms")
+        return False
+
+    async def check(self, kind: str) -> None:
+        """
+        Raises 503 with Retry-After if the request can't be admitted in time.
+        """
+        if not await self.admit(kind):
+            raise web.HTTPServiceUnavailable(
+                text="Server is busy, please retry shortly",
+                headers={"Retry-After": str(math.ceil(ADMISSION_WAIT * 2))},
+            )
+
+    def metrics(self) -> dict:
+        return {
+            "in_flight": ByteStreamer.in_flight,
+            "capacity": self.capacity,
+            "saturated": self.saturated,
+            "loop_lag_ms": round(self.lag * 1000, 1),
+            "waiting": dict(self.waiting),
+            "admitted": dict(self.admitted),
+            "rejected": dict(self.rejected),
+        }
+
+    async def run(self, interval: float = 0.5) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            # anything past the interval is time the loop was too busy to wake us up
+            self.lag = 0.8 * self.lag + 0.2 * max(time.monotonic() - started - interval, 0)
+
+
+admission = AdmissionController()
@@ -0,0 +1,89 @@
+import os
+import json
+import asyncio
+import logging
+from info import *
+from typing import Dict, List
+from collections import Counter
+from plugins.database import db
+
+# Telegram ids fit in BSON's int64, anything larger is forged and would fail the whole bulk write
+MAX_USER_ID = 2 ** 63 - 1
+
+
+class ClickBuffer:
+    def __init__(self, wal_path: str = BEACON_WAL_PATH):
+        """Append-only buffer of /click-counter beacons, applied to the database in bulk.
+        attributes:
+            pending: user ids of the beacons received since the last flush.
+            wal_path: local write-ahead log the aggregated counts spill to while the database is down.
+        """
+        self.pending: List[int] = []
+        self.wal_path = wal_path
+        self.lock = asyncio.Lock()
+
+    def add(self, user_id: int) -> None:
+        self.pending.append(user_id)
+
+    def read_wal(self) -> Counter:
+        counts = Counter()
+        if not os.path.exists(self.wal_path):
+            return counts
+        with open(self.wal_path) as f:
+            for line in f:
+                try:
+                    counts.update({int(k): v for k, v in json.loads(line).items() if 0 < int(k) <= MAX_USER_ID})
+                except ValueError:
+                    logging.warning("Skipping a corrupt beacon WAL line")
+        return counts
+
+    def append_wal(self, counts: Dict[int, int]) -> None:
+        os.makedirs(os.path.dirname(self.wal_path) or ".", exist_ok=True)
+        with open(self.wal_path, "a") as f:
+            f.write(json.dumps({str(k): v for k, v in counts.items()}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replace_wal(self, counts: Dict[int, int]) -> None:
+        tmp = f"{self.wal_path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps({str(k): v for k, v in counts.items()}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.wal_path)
+
+    async def flush(self) -> int:
+        """
+        Applies buffered beacons (and any spilled to the WAL earlier) as one $inc per user,
+        the WAL keeps the users whose $inc failed. Returns how many beacons were applied.
+        """
+        async with self.lock:
+            beacons, self.pending = self.pending, []
+            counts = Counter(beacons)
+            if counts:
+                # spill first, so a crash between here and the database write loses nothing
+                self.append_wal(counts)
+            counts = self.read_wal()
+            if not counts:
+                return 0
+            failed = await db.add_visits(counts)
+            # only what wasn't applied stays in the WAL, replaying applied counts would pay them twice
+            if failed:
+                self.replace_wal(failed)
+                logging.warning(f"{sum(failed.values())} beacons not applied, kept in the WAL")
+            else:
+                os.remove(self.wal_path)
+            return sum(counts.values()) - sum(failed.values())
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(BEACON_FLUSH_INTERVAL)
+            try:
+                applied = await self.flush()
+                if applied:
+                    logging.debug(f"Applied {applied} click beacons")
+            except Exception:
+                logging.error("Flushing click beacons failed", exc_info=True)
+
+
+click_buffer = ClickBuffer()
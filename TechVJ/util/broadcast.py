@@ -0,0 +1,214 @@
+import os
+import time
+import socket
+import asyncio
+import secrets
+import logging
+from info import *
+from pyrogram import Client
+from typing import Dict, List
+from pyrogram.errors import FloodWait, UserIsBlocked, InputUserDeactivated, PeerIdInvalid, RPCError
+from plugins.database import db
+from TechVJ.bot import multi_clients
+from TechVJ.util.token_bucket import TokenBucket
+from TechVJ.util.time_format import get_readable_time
+
+# users a helper bot couldn't reach after all (they blocked it), the primary bot retries those
+UNREACHABLE = (UserIsBlocked, InputUserDeactivated, PeerIdInvalid)
+
+# identifies this process as the owner of the broadcasts it sends
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+
+class Broadcaster:
+    def __init__(self, primary: Client, broadcast: Dict):
+        """Sends one LOG_CHANNEL message to every user.
+        Users are streamed from a batched, projected cursor ordered by _id. A bot can only message
+        users who started it, so a user goes to a helper bot (the started multi_clients) only if
+        that helper has them as a known peer, and to the primary bot otherwise. Every bot sends
+        BROADCAST_CONCURRENCY messages at a time paced by its own token bucket, and the _id up to
+        which every user is done is checkpointed so a crash resumes there.
+        Each checkpoint renews the broadcast's lease, only one process sends it at a time.
+        attributes:
+            broadcast: the broadcasts document (source message, checkpoint, counters, status message).
+        """
+        self.primary = primary
+        self.broadcast = broadcast
+        self.senders: List[Client] = [primary] + [
+            c for c in multi_clients.values() if c is not primary and getattr(c, "is_connected", False)
+        ]
+        self.buckets: Dict[Client, TokenBucket] = {c: TokenBucket(BROADCAST_RATE) for c in self.senders}
+        self.queues: Dict[Client, asyncio.Queue] = {c: asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 10) for c in self.senders}
+        self.sent = broadcast.get("sent", 0)
+        self.failed = broadcast.get("failed", 0)
+        self.started = time.monotonic()
+        self.session_done = 0
+        # checkpointing: sequence number -> user _id of everything handed out, done ones are
+        # dropped from the front once all earlier sequence numbers finished
+        self.in_flight: Dict[int, object] = {}
+        self.finished: set = set()
+        self.watermark = -1
+        self.checkpoint = broadcast.get("last_id")
+
+    async def send(self, client: Client, user_id: int) -> None:
+        while True:
+            await self.buckets[client].consume(1)
+            try:
+                await client.copy_message(
+                    chat_id=user_id, from_chat_id=LOG_CHANNEL, message_id=self.broadcast["source"]
+                )
+                return
+            except FloodWait as e:
+                logging.warning(f"FloodWait of {e.value}s while broadcasting")
+                await asyncio.sleep(e.value)
+
+    async def deliver(self, client: Client, user_id: int) -> bool:
+        try:
+            await self.send(client, user_id)
+            return True
+        except UNREACHABLE:
+            if client is self.primary:
+                return False
+        except RPCError as e:
+            logging.debug(f"Broadcast to {user_id} failed: {e}")
+            return False
+        try:
+            await self.send(self.primary, user_id)
+            return True
+        except RPCError:
+            return False
+
+    def complete(self, seq: int) -> None:
+        self.finished.add(seq)
+        while self.watermark + 1 in self.finished:
+            self.watermark += 1
+            self.finished.remove(self.watermark)
+            self.checkpoint = self.in_flight.pop(self.watermark)
+
+    async def knows(self, client: Client, user_id: int) -> bool:
+        """
+        Whether a helper bot has met the user (it's in its session's peers), otherwise it can't message them.
+        """
+        try:
+            await client.storage.get_peer_by_id(user_id)
+            return True
+        except (KeyError, AttributeError):
+            return False
+
+    async def route(self, user_id: int) -> Client:
+        """
+        The least busy bot that can reach the user, the primary bot if no helper can.
+        """
+        reachable = [self.primary]
+        for client in self.senders[1:]:
+            if await self.knows(client, user_id):
+                reachable.append(client)
+        return min(reachable, key=lambda c: self.queues[c].qsize())
+
+    async def worker(self, client: Client) -> None:
+        while True:
+            item = await self.queues[client].get()
+            if item is None:
+                return
+            seq, user_id = item
+            try:
+                delivered = await self.deliver(client, user_id)
+            except Exception:
+                logging.error(f"Broadcast to {user_id} crashed", exc_info=True)
+                delivered = False
+            if delivered:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self.session_done += 1
+            self.complete(seq)
+
+    async def produce(self) -> None:
+        seq = 0
+        async for user in db.iter_users(after_id=self.checkpoint, batch_size=BROADCAST_BATCH_SIZE):
+            self.in_flight[seq] = user["_id"]
+            await self.queues[await self.route(user["user_id"])].put((seq, user["user_id"]))
+            seq += 1
+        for queue in self.queues.values():
+            for _ in range(BROADCAST_CONCURRENCY):
+                await queue.put(None)
+
+    def status_text(self, done: bool = False) -> str:
+        elapsed = time.monotonic() - self.started
+        rate = self.session_done / elapsed if elapsed else 0
+        text = f"<b>Broadcast {'Completed' if done else 'In Progress'}</b>\n\n"
+        text += f"Sent :- {self.sent}\nFailed :- {self.failed}\n"
+        text += f"Bots :- {len(self.senders)}\nSpeed :- {rate:.1f} msg/s\n"
+        text += f"Time :- {get_readable_time(int(elapsed))}"
+        return text
+
+    async def report(self) -> None:
+        """
+        Checkpoints and edits the status message until another process owns the broadcast.
+        """
+        while True:
+            await asyncio.sleep(BROADCAST_STATUS_INTERVAL)
+            if not await self.save("running"):
+                return
+            try:
+                await self.primary.edit_message_text(
+                    self.broadcast["status_chat"], self.broadcast["status_message"], self.status_text()
+                )
+            except RPCError:
+                pass
+
+    async def save(self, status: str) -> bool:
+        return await db.update_broadcast(self.broadcast["_id"], OWNER, {
+            "last_id": self.checkpoint,
+            "sent": self.sent,
+            "failed": self.failed,
+            "status": status,
+        })
+
+    async def run(self) -> None:
+        reporter = asyncio.create_task(self.report())
+        workers = [self.worker(c) for c in self.senders for _ in range(BROADCAST_CONCURRENCY)]
+        work = asyncio.ensure_future(asyncio.gather(self.produce(), *workers))
+        try:
+            await asyncio.wait({reporter, work}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            reporter.cancel()
+        if not work.done():
+            # our lease lapsed (the loop stalled) and another process resumed it
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+            logging.warning(f"Broadcast {self.broadcast['_id']} was taken over, stopping here")
+            return
+        work.result()
+        await self.save("done")
+        try:
+            await self.primary.edit_message_text(
+                self.broadcast["status_chat"], self.broadcast["status_message"], self.status_text(done=True)
+            )
+        except RPCError:
+            pass
+        logging.info(f"Broadcast {self.broadcast['_id']} done: {self.sent} sent, {self.failed} failed")
+
+
+async def start_broadcast(client: Client, source: int, status_chat: int, status_message: int) -> None:
+    broadcast = await db.create_broadcast(source, status_chat, status_message, OWNER)
+    await Broadcaster(client, broadcast).run()
+
+
+async def resume_broadcasts(client: Client) -> None:
+    """
+    Resumes broadcasts whose process stopped renewing their lease, from their last checkpoint.
+    Runs for the life of the process, during a rolling restart the old process may still be
+    sending when this one starts.
+    """
+    while True:
+        try:
+            while True:
+                broadcast = await db.claim_broadcast(OWNER, BROADCAST_LEASE)
+                if broadcast is None:
+                    break
+                logging.info(f"Resuming broadcast {broadcast['_id']} after user {broadcast.get('last_id')}")
+                asyncio.create_task(Broadcaster(client, broadcast).run())
+        except Exception:
+            logging.error("Resuming broadcasts failed", exc_info=True)
+        await asyncio.sleep(BROADCAST_LEASE)
@@ -0,0 +1,32 @@
+from typing import AsyncIterator, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def trim(chunk: Buffer, start: int = 0, end: int = None) -> memoryview:
+    """
+    Returns chunk[start:end] as a memoryview, so trimming a 1 MiB chunk copies nothing.
+    """
+    view = chunk if isinstance(chunk, memoryview) else memoryview(chunk)
+    return view[start:end]
+
+
+async def coalesce(chunks: AsyncIterator[Buffer], min_size: int = 64 * 1024) -> AsyncIterator[Buffer]:
+    """
+    Merges runs of small pieces into one write of at least `min_size` bytes.
+    Large pieces are passed through untouched (never copied into the merge buffer).
+    """
+    pending = bytearray()
+    async for chunk in chunks:
+        if len(chunk) >= min_size:
+            if pending:
+                yield bytes(pending)
+                pending.clear()
+            yield chunk
+            continue
+        pending += chunk
+        if len(pending) >= min_size:
+            yield bytes(pending)
+            pending.clear()
+    if pending:
+        yield bytes(pending)
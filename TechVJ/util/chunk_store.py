@@ -0,0 +1,76 @@
+import logging
+from info import *
+from typing import Optional, Tuple
+from collections import OrderedDict
+
+
+class ChunkStore:
+    def __init__(self, max_bytes: int = CHUNK_CACHE_SIZE * 1024 * 1024,
+                 max_pinned: int = PREFETCH_CACHE_SIZE * 1024 * 1024):
+        """Local LRU store of GetFile chunks, shared by every client.
+        attributes:
+            max_bytes: memory budget, least recently used chunks are dropped past it.
+            chunks: (media_id, offset, chunk_size) -> bytes.
+            size: bytes currently held.
+            pinned: chunks pulled by the prefetcher, a separate LRU of `max_pinned` bytes so
+                the chunks of live streams don't push them out before anyone plays them.
+        """
+        self.max_bytes = max_bytes
+        self.max_pinned = max_pinned
+        self.chunks: "OrderedDict[Tuple[int, int, int], bytes]" = OrderedDict()
+        self.pinned: "OrderedDict[Tuple[int, int, int], bytes]" = OrderedDict()
+        self.size = 0
+        self.pinned_size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, media_id: int, offset: int, chunk_size: int) -> Optional[bytes]:
+        key = (media_id, offset, chunk_size)
+        for lru in (self.chunks, self.pinned):
+            chunk = lru.get(key)
+            if chunk is not None:
+                self.hits += 1
+                lru.move_to_end(key)
+                return chunk
+        self.misses += 1
+        return None
+
+    def has(self, media_id: int, offset: int, chunk_size: int) -> bool:
+        key = (media_id, offset, chunk_size)
+        return key in self.chunks or key in self.pinned
+
+    def put(self, media_id: int, offset: int, chunk_size: int, chunk: bytes) -> None:
+        key = (media_id, offset, chunk_size)
+        if not chunk or len(chunk) > self.max_bytes or key in self.pinned:
+            return
+        old = self.chunks.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.chunks[key] = chunk
+        self.size += len(chunk)
+        while self.size > self.max_bytes:
+            _, dropped = self.chunks.popitem(last=False)
+            self.size -= len(dropped)
+        logging.debug(f"Chunk store holds {len(self.chunks)} chunks ({self.size} bytes)")
+
+    def pin(self, media_id: int, offset: int, chunk_size: int, chunk: bytes) -> None:
+        """
+        Moves a prefetched chunk to the pinned LRU.
+        """
+        key = (media_id, offset, chunk_size)
+        if not chunk or len(chunk) > self.max_pinned:
+            return
+        old = self.chunks.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        old = self.pinned.pop(key, None)
+        if old is not None:
+            self.pinned_size -= len(old)
+        self.pinned[key] = chunk
+        self.pinned_size += len(chunk)
+        while self.pinned_size > self.max_pinned:
+            _, dropped = self.pinned.popitem(last=False)
+            self.pinned_size -= len(dropped)
+
+
+chunk_store = ChunkStore()
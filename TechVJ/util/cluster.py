@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import fcntl
+import bisect
+import asyncio
+import hashlib
+import logging
+from info import *
+from aiohttp import web
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# query parameter marking a redirected request, a node never redirects it again
+HOP = "hop"
+# a registered node that hasn't renewed its heartbeat for this long is taken as dead
+STALE_AFTER = 3 * CLUSTER_REFRESH
+
+
+def point(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes: List[str], vnodes: int = CLUSTER_VNODES):
+        """Consistent hash ring, each node owns `vnodes` points so load spreads evenly and
+        adding or removing a node only moves about 1/N of the keys.
+        """
+        self.nodes = sorted({node.rstrip("/") for node in nodes})
+        self.points: List[Tuple[int, str]] = sorted(
+            (point(f"{node}#{replica}"), node) for node in self.nodes for replica in range(vnodes)
+        )
+        self.hashes = [hash for hash, _ in self.points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self.points:
+            return None
+        index = bisect.bisect(self.hashes, point(key)) % len(self.points)
+        return self.points[index][1]
+
+
+class Cluster:
+    def __init__(self, node_url: str = NODE_URL, nodes: List[str] = CLUSTER_NODES,
+                 registry: str = CLUSTER_REGISTRY):
+        """Optional cluster mode: every file has one owner node, picked on a hash ring of the
+        members, and /dl requests for it are redirected there so its chunks and metadata are
+        only hot in one node's caches.
+        attributes:
+            nodes: static members (CLUSTER_NODES).
+            registry: shared file mapping members to their last heartbeat (unix time). Nodes
+                renew theirs every CLUSTER_REFRESH seconds and remove it on shutdown, one that
+                crashed drops out after STALE_AFTER seconds. Stands in for a real service registry.
+        """
+        self.node_url = node_url.rstrip("/")
+        self.static = [node.rstrip("/") for node in nodes if node]
+        self.registry = registry
+        self.ring = HashRing(self.static + [node_url] if self.static else [])
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.ring.nodes) > 1
+
+    def owner(self, id: int) -> Optional[str]:
+        return self.ring.owner(str(id))
+
+    def redirect(self, request: web.Request, id: int) -> None:
+        """
+        Sends the request to the file's owner node with a 307, unless that's us or it already hopped.
+        """
+        if not self.enabled or request.query.get(HOP):
+            return
+        owner = self.owner(id)
+        if owner and owner != self.node_url:
+            url = request.rel_url.update_query({HOP: "1"})
+            raise web.HTTPTemporaryRedirect(f"{owner}{url}")
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """
+        Holds an exclusive lock on the registry, so concurrent joins and heartbeats don't drop each other.
+        """
+        os.makedirs(os.path.dirname(self.registry) or ".", exist_ok=True)
+        with open(f"{self.registry}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read_registry(self) -> Dict[str, float]:
+        try:
+            with open(self.registry) as f:
+                nodes = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return nodes if isinstance(nodes, dict) else {}
+
+    def write_registry(self, nodes: Dict[str, float]) -> None:
+        tmp = f"{self.registry}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(nodes, f, sort_keys=True)
+        os.replace(tmp, self.registry)
+
+    def live_nodes(self, nodes: Dict[str, float]) -> Dict[str, float]:
+        now = time.time()
+        return {node: seen for node, seen in nodes.items() if now - seen <= STALE_AFTER}
+
+    def heartbeat(self) -> None:
+        """
+        Adds this node to the registry or renews its entry, dropping nodes gone stale.
+        """
+        if self.registry:
+            with self.locked():
+                nodes = self.live_nodes(self.read_registry())
+                nodes[self.node_url] = time.time()
+                self.write_registry(nodes)
+
+    def join(self) -> None:
+        if self.registry:
+            self.heartbeat()
+            self.reload()
+
+    def leave(self) -> None:
+        if self.registry:
+            with self.locked():
+                nodes = self.live_nodes(self.read_registry())
+                nodes.pop(self.node_url, None)
+                self.write_registry(nodes)
+
+    def reload(self) -> None:
+        registered = set(self.live_nodes(self.read_registry())) if self.registry else set()
+        nodes = set(self.static) | registered | {self.node_url}
+        if set(self.ring.nodes) != nodes:
+            self.ring = HashRing(list(nodes))
+            logging.info(f"Cluster membership changed, {len(nodes)} nodes: {', '.join(sorted(nodes))}")
+
+    async def run(self) -> None:
+        if not self.registry:
+            return
+        self.join()
+        while True:
+            await asyncio.sleep(CLUSTER_REFRESH)
+            try:
+                self.heartbeat()
+                self.reload()
+            except Exception:
+                logging.error("Renewing the cluster registry failed", exc_info=True)
+
+
+cluster = Cluster()
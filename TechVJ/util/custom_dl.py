@@ -1,28 +1,44 @@
 import math
 import asyncio
+import hashlib
 import logging
 from info import *
-from typing import Dict, Union
+from functools import partial
+from typing import Dict, List, Optional, Union
 from TechVJ.bot import work_loads
-from pyrogram import Client, utils, raw
-from TechVJ.util.file_properties import get_file_ids
+from TechVJ.util.chunk_store import chunk_store
+from TechVJ.util.buffers import trim
+from TechVJ.util.session_store import media_auth_store
+from TechVJ.util.token_bucket import TokenBucket
+from TechVJ.util.scheduler import scheduler, BULK
+from pyrogram import Client, raw
+from TechVJ.util.media_index import media_index
 from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
+from pyrogram.crypto import aes
+from pyrogram.errors import AuthBytesInvalid, AuthKeyUnregistered, Unauthorized, FileReferenceExpired, CDNFileHashMismatch, RPCError
 from TechVJ.server.exceptions import FIleNotFound
-from pyrogram.file_id import FileId, FileType, ThumbnailSource
+from TechVJ.util.file_properties import MediaRecord
 
 
 class ByteStreamer:
+    # GetFile calls in flight across every client, read by admission control
+    in_flight = 0
+
     def __init__(self, client: Client):
         """A custom class that holds the cache of a specific client and class functions.
         attributes:
             client: the client that the cache is for.
             cached_file_ids: a dict of cached file IDs.
+            cdn_redirects: a dict of media ids Telegram redirected to a CDN DC.
             cached_file_properties: a dict of cached file properties.
         
         functions:
             generate_file_properties: returns the properties for a media of a specific message contained in Tuple.
             generate_media_session: returns the media session for the DC that contains the media file.
+            get_chunk: returns one chunk, from the local chunk store when possible.
+            get_cdn_chunk: fetches, decrypts and verifies a chunk from a CDN DC after a FileCdnRedirect.
+            prefetch: pulls chunks into the local chunk store ahead of viewers.
+            read: returns an arbitrary byte range of the file, for container parsing.
             yield_file: yield a file from telegram servers for streaming.
             
         This is a modified version of the <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py>
@@ -30,12 +46,15 @@ class ByteStreamer:
         """
         self.clean_timer = 30 * 60
         self.client: Client = client
-        self.cached_file_ids: Dict[int, FileId] = {}
+        self.cached_file_ids: Dict[int, MediaRecord] = {}
+        self.cdn_redirects: Dict[int, raw.types.upload.FileCdnRedirect] = {}
+        self.cdn_sessions: Dict[int, Session] = {}
+        self.cdn_hashes: Dict[bytes, Dict[int, raw.types.FileHash]] = {}
         asyncio.create_task(self.clean_cache())
 
-    async def get_file_properties(self, id: int) -> FileId:
+    async def get_file_properties(self, id: int) -> MediaRecord:
         """
-        Returns the properties of a media of a specific message in a FIleId class.
+        Returns the properties of a media of a specific message in a MediaRecord.
         if the properties are cached, then it'll return the cached results.
         or it'll generate the properties from the Message ID and cache them.
         """
@@ -44,13 +63,13 @@ class ByteStreamer:
             logging.debug(f"Cached file properties for message with ID {id}")
         return self.cached_file_ids[id]
     
-    async def generate_file_properties(self, id: int) -> FileId:
+    async def generate_file_properties(self, id: int) -> MediaRecord:
         """
         Generates the properties of a media file on a specific message.
-        returns ths properties in a FIleId class.
+        returns ths properties in a MediaRecord.
+        The media index is tried first, Telegram is only asked for messages it doesn't know yet.
         """
-        file = await self.client.get_messages(LOG_CHANNEL, int(id))
-        file_id = await get_file_ids(file) 
+        file_id = await media_index.get_file_id(self.client, int(id))
         logging.debug(f"Generated file ID and Unique ID for message with ID {id}")
         if not file_id:
             logging.debug(f"Message with ID {id} not found")
@@ -59,7 +78,16 @@ class ByteStreamer:
         logging.debug(f"Cached media message with ID {id}")
         return self.cached_file_ids[id]
 
-    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
+    async def refresh_file_properties(self, id: int) -> MediaRecord:
+        """
+        Re-reads the message from Telegram, used when the cached file reference has expired.
+        """
+        file_id = await media_index.refresh(self.client, int(id))
+        self.cached_file_ids[id] = file_id
+        logging.debug(f"Refreshed file reference for message with ID {id}")
+        return file_id
+
+    async def generate_media_session(self, client: Client, file_id: MediaRecord) -> Session:
         """
         Generates the media session for the DC that contains the media file.
         This is required for getting the bytes from Telegram servers.
@@ -69,13 +97,17 @@ class ByteStreamer:
 
         if media_session is None:
             if file_id.dc_id != await client.storage.dc_id():
+                media_session = await self.restore_media_session(client, file_id.dc_id)
+                if media_session is not None:
+                    client.media_sessions[file_id.dc_id] = media_session
+                    return media_session
+                test_mode = await client.storage.test_mode()
+                auth_key = await Auth(client, file_id.dc_id, test_mode).create()
                 media_session = Session(
                     client,
                     file_id.dc_id,
-                    await Auth(
-                        client, file_id.dc_id, await client.storage.test_mode()
-                    ).create(),
-                    await client.storage.test_mode(),
+                    auth_key,
+                    test_mode,
                     is_media=True,
                 )
                 await media_session.start()
@@ -91,6 +123,7 @@ class ByteStreamer:
                                 id=exported_auth.id, bytes=exported_auth.bytes
                             )
                         )
+                        await media_auth_store.set(client.name, file_id.dc_id, test_mode, auth_key)
                         break
                     except AuthBytesInvalid:
                         logging.debug(
@@ -116,63 +149,263 @@ class ByteStreamer:
         return media_session
 
 
+    async def restore_media_session(self, client: Client, dc_id: int) -> Optional[Session]:
+        """
+        Starts a media session with the auth key stored by a previous run, if there is one
+        and it's still authorized, skipping ExportAuthorization/ImportAuthorization.
+        """
+        test_mode = await client.storage.test_mode()
+        auth_key = await media_auth_store.get(client.name, dc_id, test_mode)
+        if auth_key is None:
+            return None
+        media_session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+        try:
+            await media_session.start()
+            await media_session.send(raw.functions.updates.GetState())
+        except (AuthKeyUnregistered, Unauthorized):
+            await media_session.stop()
+            await media_auth_store.delete(client.name, dc_id, test_mode)
+            return None
+        logging.debug(f"Restored media session for DC {dc_id}")
+        return media_session
+
     @staticmethod
-    async def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation,
-                                                     raw.types.InputDocumentFileLocation,
-                                                     raw.types.InputPeerPhotoFileLocation,]:
+    async def get_location(file_id: MediaRecord) -> Union[raw.types.InputPhotoFileLocation,
+                                                         raw.types.InputDocumentFileLocation,
+                                                         raw.types.InputPeerPhotoFileLocation,]:
         """
-        Returns the file location for the media file.
+        Returns the file location for the media file, precomputed when the record was built.
         """
-        file_type = file_id.file_type
+        return file_id.location
 
-        if file_type == FileType.CHAT_PHOTO:
-            if file_id.chat_id > 0:
-                peer = raw.types.InputPeerUser(
-                    user_id=file_id.chat_id, access_hash=file_id.chat_access_hash
-                )
-            else:
-                if file_id.chat_access_hash == 0:
-                    peer = raw.types.InputPeerChat(chat_id=-file_id.chat_id)
-                else:
-                    peer = raw.types.InputPeerChannel(
-                        channel_id=utils.get_channel_id(file_id.chat_id),
-                        access_hash=file_id.chat_access_hash,
-                    )
+    async def get_chunk(
+        self,
+        media_session: Session,
+        file_id: MediaRecord,
+        offset: int,
+        chunk_size: int,
+    ) -> bytes:
+        """
+        Returns one GetFile chunk, from the local chunk store when it's there.
+        """
+        chunk = chunk_store.get(file_id.media_id, offset, chunk_size)
+        if chunk is not None:
+            return chunk
+        ByteStreamer.in_flight += 1
+        try:
+            return await self.fetch_chunk(media_session, file_id, offset, chunk_size)
+        finally:
+            ByteStreamer.in_flight -= 1
+
+    async def fetch_chunk(
+        self,
+        media_session: Session,
+        file_id: MediaRecord,
+        offset: int,
+        chunk_size: int,
+    ) -> bytes:
+        """
+        Fetches one chunk from Telegram (or its CDN) and keeps it in the chunk store.
+        """
+        redirect = self.cdn_redirects.get(file_id.media_id)
+        if redirect is None:
+            r = await media_session.send(
+                raw.functions.upload.GetFile(
+                    location=await self.get_location(file_id),
+                    offset=offset,
+                    limit=chunk_size,
+                    cdn_supported=CDN_SUPPORT or None,
+                ),
+            )
+            if isinstance(r, raw.types.upload.File):
+                chunk_store.put(file_id.media_id, offset, chunk_size, r.bytes)
+                return r.bytes
+            if not isinstance(r, raw.types.upload.FileCdnRedirect):
+                raise ValueError(f"Unexpected GetFile response {type(r).__name__}")
+            logging.debug(f"Media {file_id.media_id} redirected to CDN DC {r.dc_id}")
+            redirect = self.cdn_redirects[file_id.media_id] = r
+        try:
+            chunk = await self.get_cdn_chunk(media_session, redirect, offset, chunk_size)
+        except (RPCError, CDNFileHashMismatch):
+            # expired file token, unreachable CDN or bad data from it, go back to the main DC next time
+            self.cdn_redirects.pop(file_id.media_id, None)
+            raise
+        chunk_store.put(file_id.media_id, offset, chunk_size, chunk)
+        return chunk
 
-            location = raw.types.InputPeerPhotoFileLocation(
-                peer=peer,
-                volume_id=file_id.volume_id,
-                local_id=file_id.local_id,
-                big=file_id.thumbnail_source == ThumbnailSource.CHAT_PHOTO_BIG,
+    async def generate_cdn_session(self, dc_id: int) -> Session:
+        """
+        Generates (or reuses) the session for a CDN DC. CDN DCs need no authorization import.
+        """
+        cdn_session = self.cdn_sessions.get(dc_id)
+        if cdn_session is None:
+            test_mode = await self.client.storage.test_mode()
+            cdn_session = Session(
+                self.client,
+                dc_id,
+                await Auth(self.client, dc_id, test_mode).create(),
+                test_mode,
+                is_media=True,
+                is_cdn=True,
             )
-        elif file_type == FileType.PHOTO:
-            location = raw.types.InputPhotoFileLocation(
-                id=file_id.media_id,
-                access_hash=file_id.access_hash,
-                file_reference=file_id.file_reference,
-                thumb_size=file_id.thumbnail_size,
+            await cdn_session.start()
+            self.cdn_sessions[dc_id] = cdn_session
+            logging.debug(f"Created CDN session for DC {dc_id}")
+        return cdn_session
+
+    async def get_cdn_chunk(
+        self,
+        media_session: Session,
+        redirect: raw.types.upload.FileCdnRedirect,
+        offset: int,
+        chunk_size: int,
+    ) -> bytes:
+        """
+        Fetches one chunk from a CDN DC, asking the main DC to reupload it when the CDN
+        doesn't have it yet, then decrypts it and checks it against GetCdnFileHashes.
+        """
+        cdn_session = await self.generate_cdn_session(redirect.dc_id)
+        for _ in range(3):
+            r = await cdn_session.send(
+                raw.functions.upload.GetCdnFile(
+                    file_token=redirect.file_token, offset=offset, limit=chunk_size
+                )
             )
-        else:
-            location = raw.types.InputDocumentFileLocation(
-                id=file_id.media_id,
-                access_hash=file_id.access_hash,
-                file_reference=file_id.file_reference,
-                thumb_size=file_id.thumbnail_size,
+            if not isinstance(r, raw.types.upload.CdnFileReuploadNeeded):
+                break
+            hashes = await media_session.send(
+                raw.functions.upload.ReuploadCdnFile(
+                    file_token=redirect.file_token, request_token=r.request_token
+                )
             )
-        return location
+            self.remember_cdn_hashes(redirect.file_token, hashes)
+        else:
+            raise CDNFileHashMismatch
+
+        chunk = aes.ctr256_decrypt(
+            r.bytes,
+            redirect.encryption_key,
+            bytearray(redirect.encryption_iv[:-4] + (offset // 16).to_bytes(4, "big")),
+        )
+        await self.verify_cdn_chunk(media_session, redirect, offset, chunk)
+        return chunk
+
+    def remember_cdn_hashes(self, file_token: bytes, hashes: List[raw.types.FileHash]) -> None:
+        known = self.cdn_hashes.setdefault(file_token, {})
+        for h in hashes:
+            known[h.offset] = h
+
+    async def verify_cdn_chunk(
+        self,
+        media_session: Session,
+        redirect: raw.types.upload.FileCdnRedirect,
+        offset: int,
+        chunk: bytes,
+    ) -> None:
+        known = self.cdn_hashes.setdefault(redirect.file_token, {})
+        position = offset
+        while position < offset + len(chunk):
+            if position not in known:
+                self.remember_cdn_hashes(
+                    redirect.file_token,
+                    await media_session.send(
+                        raw.functions.upload.GetCdnFileHashes(
+                            file_token=redirect.file_token, offset=position
+                        )
+                    ),
+                )
+                if position not in known:
+                    raise CDNFileHashMismatch
+            h = known[position]
+            part = chunk[position - offset:position - offset + h.limit]
+            if hashlib.sha256(part).digest() != h.hash:
+                raise CDNFileHashMismatch
+            position += h.limit
+
+    async def prefetch(
+        self,
+        file_id: MediaRecord,
+        index: int,
+        offsets: List[int],
+        chunk_size: int,
+        bucket: Optional[TokenBucket] = None,
+    ) -> int:
+        """
+        Pulls the chunks at the given offsets into the chunk store (pinned) without streaming them.
+        Returns the number of bytes fetched from Telegram.
+        """
+        fetched = 0
+        work_loads[index] += 1
+        try:
+            media_session = await self.generate_media_session(self.client, file_id)
+            for offset in offsets:
+                chunk = chunk_store.get(file_id.media_id, offset, chunk_size)
+                if chunk is None:
+                    if bucket:
+                        await bucket.consume(chunk_size)
+                    # queued as a bulk download of its own, so viewers still get their turns first
+                    try:
+                        await scheduler.acquire("prefetch", file_id.message_id, BULK)
+                    except asyncio.TimeoutError:
+                        break
+                    try:
+                        chunk = await self.get_chunk(media_session, file_id, offset, chunk_size)
+                    finally:
+                        scheduler.release("prefetch", file_id.message_id)
+                    if not chunk:
+                        break
+                    fetched += len(chunk)
+                chunk_store.pin(file_id.media_id, offset, chunk_size, chunk)
+        finally:
+            work_loads[index] -= 1
+        return fetched
+
+    async def read(
+        self,
+        file_id: MediaRecord,
+        index: int,
+        start: int,
+        length: int,
+        chunk_size: int = 1024 * 1024,
+    ) -> bytes:
+        """
+        Returns `length` bytes of the file from `start`, used to parse container headers.
+        Small header reads should pass a small chunk_size (a multiple of 4096 dividing 1 MiB).
+        """
+        end = min(start + length, file_id.file_size)
+        parts = []
+        work_loads[index] += 1
+        try:
+            media_session = await self.generate_media_session(self.client, file_id)
+            offset = start - start % chunk_size
+            while offset < end:
+                try:
+                    chunk = await self.get_chunk(media_session, file_id, offset, chunk_size)
+                except FileReferenceExpired:
+                    file_id = await self.refresh_file_properties(file_id.message_id)
+                    chunk = await self.get_chunk(media_session, file_id, offset, chunk_size)
+                if not chunk:
+                    break
+                parts.append(trim(chunk, max(start - offset, 0), end - offset))
+                offset += chunk_size
+        finally:
+            work_loads[index] -= 1
+        return b"".join(parts)
 
     async def yield_file(
         self,
-        file_id: FileId,
+        file_id: MediaRecord,
         index: int,
         offset: int,
         first_part_cut: int,
         last_part_cut: int,
         part_count: int,
         chunk_size: int,
+        session=None,
     ) -> Union[str, None]:
         """
         Custom generator that yields the bytes of the media file.
+        With a viewer's StreamSession, chunks come from (and read ahead into) its window.
         Modded from <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py#L20>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
@@ -182,39 +415,29 @@ class ByteStreamer:
         media_session = await self.generate_media_session(client, file_id)
 
         current_part = 1
-        location = await self.get_location(file_id)
 
         try:
-            r = await media_session.send(
-                raw.functions.upload.GetFile(
-                    location=location, offset=offset, limit=chunk_size
-                ),
-            )
-            if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
+            while current_part <= part_count:
+                get_chunk = partial(session.get_chunk, self) if session else self.get_chunk
+                try:
+                    chunk = await get_chunk(media_session, file_id, offset, chunk_size)
+                except FileReferenceExpired:
+                    file_id = await self.refresh_file_properties(file_id.message_id)
+                    chunk = await get_chunk(media_session, file_id, offset, chunk_size)
+                if not chunk:
+                    break
+                # trimming returns memoryviews, the chunk bytes are never copied on the way to the socket
+                elif part_count == 1:
+                    yield trim(chunk, first_part_cut, last_part_cut)
+                elif current_part == 1:
+                    yield trim(chunk, first_part_cut)
+                elif current_part == part_count:
+                    yield trim(chunk, 0, last_part_cut)
+                else:
+                    yield chunk
 
-                    r = await media_session.send(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
+                current_part += 1
+                offset += chunk_size
         except (TimeoutError, AttributeError):
             pass
         finally:
@@ -229,4 +452,18 @@ class ByteStreamer:
         while True:
             await asyncio.sleep(self.clean_timer)
             self.cached_file_ids.clear()
+            self.cdn_redirects.clear()
+            self.cdn_hashes.clear()
             logging.debug("Cleaned the cache")
+
+
+class_cache: Dict[Client, ByteStreamer] = {}
+
+
+def get_streamer(client: Client) -> ByteStreamer:
+    """
+    Returns the ByteStreamer of a client, creating it on first use.
+    """
+    if client not in class_cache:
+        class_cache[client] = ByteStreamer(client)
+    return class_cache[client]
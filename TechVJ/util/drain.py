@@ -0,0 +1,66 @@
+import time
+import asyncio
+import logging
+from info import *
+from aiohttp import web
+from typing import AsyncIterator
+
+
+class Drain:
+    def __init__(self):
+        """Graceful shutdown state.
+        Once started the instance reports not ready, refuses new streams with 503 and waits
+        (up to DRAIN_TIMEOUT seconds) for the streams already running to finish.
+        attributes:
+            active: response bodies currently being streamed.
+        """
+        self.draining = False
+        self.forced = False
+        self.active = 0
+
+    @property
+    def ready(self) -> bool:
+        return not self.draining
+
+    def start(self) -> None:
+        if not self.draining:
+            self.draining = True
+            logging.info(f"Draining, {self.active} streams still running")
+
+    def force(self) -> None:
+        """
+        A second signal while draining, stop waiting for streams.
+        """
+        logging.warning("Drain interrupted, cutting remaining streams")
+        self.forced = True
+
+    def check(self) -> None:
+        if self.draining:
+            raise web.HTTPServiceUnavailable(
+                text="Server is restarting, please retry shortly",
+                headers={"Retry-After": "5", "Connection": "close"},
+            )
+
+    async def track(self, body: AsyncIterator) -> AsyncIterator:
+        self.active += 1
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            self.active -= 1
+
+    async def wait(self, timeout: float = DRAIN_TIMEOUT) -> bool:
+        """
+        Waits for the active streams to end. Returns False if some were still running at the deadline.
+        """
+        deadline = time.monotonic() + timeout
+        while self.active and not self.forced and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        if self.active:
+            logging.warning(f"Drain deadline reached with {self.active} streams running")
+            return False
+        logging.info("All streams finished")
+        return True
+
+
+drain = Drain()
@@ -0,0 +1,214 @@
+import time
+import bisect
+import struct
+import logging
+from info import *
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+from TechVJ.util.buffers import trim
+from TechVJ.util.custom_dl import ByteStreamer
+from TechVJ.util.file_properties import MediaRecord
+from TechVJ.util.mp4 import Box, iter_boxes, top_level, MAX_MOOV_SIZE
+from TechVJ.util.keyed_lock import KeyedLock
+
+# boxes on the path from moov down to the chunk offset tables, rebuilt instead of copied
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+MP4_TYPES = ("video/mp4", "video/quicktime", "video/x-m4v", "audio/mp4")
+
+
+class Layout:
+    __slots__ = ("size", "starts", "pieces", "moov_size")
+
+    def __init__(self, pieces: List[Tuple[int, Optional[int], Optional[bytes]]]):
+        """Byte layout of a virtually remuxed file: ftyp, the rewritten moov, then everything else.
+        attributes:
+            pieces: (length, source offset, data) in output order, data is set for in-memory pieces.
+            starts: output offset of each piece.
+        """
+        self.pieces = pieces
+        self.starts, position = [], 0
+        for length, _, _ in pieces:
+            self.starts.append(position)
+            position += length
+        self.size = position
+        self.moov_size = sum(len(data) for _, _, data in pieces if data is not None)
+
+    def output_offset(self, source_offset: int) -> int:
+        """
+        Maps an offset of the original file to the same byte in the rewritten one.
+        """
+        for (length, source, _), start in zip(self.pieces, self.starts):
+            if source is not None and source <= source_offset < source + length:
+                return start + source_offset - source
+        return source_offset
+
+
+def rebuild(data: bytes, start: int, end: int, remap: Callable[[int], int], co64: bool) -> bytes:
+    """
+    Rebuilds the boxes in data[start:end] with every stco/co64 offset passed through remap.
+    With co64, stco tables are widened to 64 bit ones.
+    """
+    out = bytearray()
+    for box in iter_boxes(data, start, end):
+        if box.type in CONTAINERS:
+            payload = rebuild(data, box.start, box.end, remap, co64)
+            out += struct.pack(">I4s", 8 + len(payload), box.type) + payload
+        elif box.type in (b"stco", b"co64"):
+            count = struct.unpack_from(">I", data, box.start + 4)[0]
+            wide = box.type == b"co64"
+            offsets = struct.unpack_from(f">{count}{'Q' if wide else 'I'}", data, box.start + 8)
+            offsets = [remap(offset) for offset in offsets]
+            kind = b"co64" if wide or co64 else b"stco"
+            table = struct.pack(f">{count}{'Q' if kind == b'co64' else 'I'}", *offsets)
+            out += struct.pack(">I4sII", 16 + len(table), kind, 0, count) + table
+        else:
+            out += data[box.offset:box.end]
+    return bytes(out)
+
+
+def build_layout(boxes: List[Box], moov: bytes) -> Optional[Layout]:
+    """
+    Lays out ftyp, the moov (payload `moov`) and the remaining top level boxes.
+    Returns None when the moov already precedes the media data.
+    """
+    kinds = [box.type for box in boxes]
+    if b"moov" not in kinds or b"mdat" not in kinds or kinds.index(b"moov") < kinds.index(b"mdat"):
+        return None
+    ftyp = next((box for box in boxes if box.type == b"ftyp"), None)
+    rest = [box for box in boxes if box.type not in (b"ftyp", b"moov")]
+    head = ftyp.size if ftyp else 0
+
+    def remapper(moov_size: int) -> Callable[[int], int]:
+        starts, new_starts, position = [], [], head + moov_size
+        for box in rest:
+            starts.append(box.offset)
+            new_starts.append(position)
+            position += box.size
+
+        def remap(offset: int) -> int:
+            index = max(bisect.bisect_right(starts, offset) - 1, 0)
+            return offset - starts[index] + new_starts[index]
+        return remap
+
+    for co64 in (False, True):
+        # table sizes don't depend on the offsets, so an identity pass gives the final moov size
+        moov_size = 8 + len(rebuild(moov, 0, len(moov), lambda offset: offset, co64))
+        try:
+            rebuilt = rebuild(moov, 0, len(moov), remapper(moov_size), co64)
+            break
+        except struct.error:
+            # shifted 32 bit chunk offsets overflowed, widen them to co64
+            continue
+    moov_box = struct.pack(">I4s", 8 + len(rebuilt), b"moov") + rebuilt
+
+    pieces = [(ftyp.size, ftyp.offset, None)] if ftyp else []
+    pieces.append((len(moov_box), None, moov_box))
+    pieces += [(box.size, box.offset, None) for box in rest]
+    return Layout(pieces)
+
+
+class Faststart:
+    def __init__(self, max_bytes: int = FASTSTART_CACHE_SIZE * 1024 * 1024):
+        """Virtual faststart for MP4s with the moov at the end.
+        The moov is rewritten to the front with shifted chunk offsets and every other byte is
+        served from the original file, so the player gets its index with the first request.
+        attributes:
+            layouts: media id -> Layout (None for files that need no rewrite), LRU by moov bytes.
+            ttfb: label -> [count, total seconds] of time to first byte, with and without rewrite.
+        """
+        self.max_bytes = max_bytes
+        self.layouts: "OrderedDict[int, Optional[Layout]]" = OrderedDict()
+        self.size = 0
+        self.locks = KeyedLock()
+        self.ttfb: Dict[str, List[float]] = {"original": [0, 0.0], "faststart": [0, 0.0]}
+
+    async def get(self, streamer: ByteStreamer, file_id: MediaRecord, index: int) -> Optional[Layout]:
+        if (file_id.mime_type or "").lower() not in MP4_TYPES:
+            return None
+        if file_id.media_id in self.layouts:
+            self.layouts.move_to_end(file_id.media_id)
+            return self.layouts[file_id.media_id]
+        async with self.locks(file_id.media_id):
+            if file_id.media_id not in self.layouts:
+                try:
+                    layout = await self.build(streamer, file_id, index)
+                except (struct.error, AttributeError, TypeError):
+                    logging.warning(f"Couldn't rewrite MP4 of message {file_id.message_id}", exc_info=True)
+                    layout = None
+                self.remember(file_id.media_id, layout)
+        return self.layouts.get(file_id.media_id)
+
+    async def build(self, streamer: ByteStreamer, file_id: MediaRecord, index: int) -> Optional[Layout]:
+        async def read(start: int, length: int) -> bytes:
+            return await streamer.read(file_id, index, start, length, 4096 if length <= 4096 else 1024 * 1024)
+
+        boxes = await top_level(read, file_id.file_size, stop=(b"moof",))
+        moov = next((box for box in boxes if box.type == b"moov"), None)
+        if moov is None or boxes[-1].type == b"moof" or moov.size > MAX_MOOV_SIZE:
+            return None
+        kinds = [box.type for box in boxes]
+        if b"mdat" not in kinds or kinds.index(b"moov") < kinds.index(b"mdat"):
+            return None
+        started = time.monotonic()
+        layout = build_layout(boxes, await read(moov.start, moov.size - moov.header))
+        logging.debug(f"Rewrote moov of message {file_id.message_id} in {time.monotonic() - started:.3f}s")
+        return layout
+
+    def remember(self, media_id: int, layout: Optional[Layout]) -> None:
+        self.layouts[media_id] = layout
+        self.size += layout.moov_size if layout else 0
+        while self.size > self.max_bytes and self.layouts:
+            _, dropped = self.layouts.popitem(last=False)
+            self.size -= dropped.moov_size if dropped else 0
+
+    async def yield_range(
+        self,
+        streamer: ByteStreamer,
+        file_id: MediaRecord,
+        index: int,
+        layout: Layout,
+        from_bytes: int,
+        until_bytes: int,
+        chunk_size: int,
+        session=None,
+    ) -> AsyncIterator[memoryview]:
+        """
+        Yields output bytes from_bytes..until_bytes (inclusive) of a rewritten file.
+        """
+        piece = bisect.bisect_right(layout.starts, from_bytes) - 1
+        position = from_bytes
+        while position <= until_bytes and piece < len(layout.pieces):
+            length, source, data = layout.pieces[piece]
+            start = position - layout.starts[piece]
+            end = min(length, until_bytes - layout.starts[piece] + 1)
+            if data is not None:
+                yield trim(data, start, end)
+            else:
+                first, last = source + start, source + end - 1
+                offset = first - first % chunk_size
+                part_count = last // chunk_size - offset // chunk_size + 1
+                async for chunk in streamer.yield_file(
+                    file_id, index, offset, first - offset, last % chunk_size + 1, part_count, chunk_size, session
+                ):
+                    yield chunk
+            position = layout.starts[piece] + end
+            piece += 1
+
+    async def timed(self, body: AsyncIterator, label: str) -> AsyncIterator:
+        """
+        Passes the body through, recording how long the first byte took.
+        """
+        started = time.monotonic()
+        first = True
+        async for chunk in body:
+            if first:
+                first = False
+                stats = self.ttfb[label]
+                stats[0] += 1
+                stats[1] += time.monotonic() - started
+                logging.debug(f"First byte ({label}) after {time.monotonic() - started:.3f}s, "
+                              f"average {stats[1] / stats[0]:.3f}s over {stats[0]} streams")
+            yield chunk
+
+
+faststart = Faststart()
@@ -0,0 +1,104 @@
+import time
+import bisect
+import logging
+from info import *
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple
+from plugins.database import db
+from TechVJ.util.render_template import clean_file_name, remove_after_year
+
+
+def tokenize(file_name: str) -> List[str]:
+    return clean_file_name(str(file_name or "").replace("_", " ")).lower().split()
+
+
+class UserLibrary:
+    def __init__(self):
+        """Inverted index over the cleaned file names of one uploader.
+        attributes:
+            postings: token -> message ids of the files containing it.
+            tokens: sorted tokens, prefix lookups are a bisect range over it.
+            files: message id -> (title, size, uploaded timestamp).
+        """
+        self.postings: Dict[str, Set[int]] = {}
+        self.tokens: List[str] = []
+        self.files: Dict[int, Tuple[str, int, float]] = {}
+
+    def add(self, message_id: int, file_name: str, file_size: int, uploaded: float) -> None:
+        if message_id in self.files:
+            return
+        clean = clean_file_name(str(file_name or "").replace("_", " "))
+        self.files[message_id] = (remove_after_year(clean) or clean or "File", file_size or 0, uploaded)
+        for token in set(tokenize(file_name)):
+            if token not in self.postings:
+                self.postings[token] = set()
+                bisect.insort(self.tokens, token)
+            self.postings[token].add(message_id)
+
+    def prefixed(self, prefix: str) -> Set[int]:
+        ids: Set[int] = set()
+        start = bisect.bisect_left(self.tokens, prefix)
+        for token in self.tokens[start:]:
+            if not token.startswith(prefix):
+                break
+            ids |= self.postings[token]
+        return ids
+
+    def search(self, query: str) -> List[int]:
+        """
+        Message ids of the files matching every word of the query (as a prefix), newest first.
+        """
+        words = tokenize(query)
+        if not words:
+            ids = set(self.files)
+        else:
+            ids = self.prefixed(words[0])
+            for word in words[1:]:
+                if not ids:
+                    break
+                ids &= self.prefixed(word)
+        return sorted(ids, key=lambda id: self.files[id][2], reverse=True)
+
+
+class FileLibrary:
+    def __init__(self, max_users: int = LIBRARY_CACHE_USERS):
+        """Per uploader searchable file libraries, built from the files collection on first use
+        and kept up to date on ingest. Only the most recently used uploaders stay in memory.
+        """
+        self.max_users = max_users
+        self.libraries: "OrderedDict[int, UserLibrary]" = OrderedDict()
+
+    async def get(self, user_id: int) -> UserLibrary:
+        library = self.libraries.get(user_id)
+        if library is None:
+            started = time.monotonic()
+            library = UserLibrary()
+            async for file in db.iter_user_files(user_id):
+                library.add(file["message_id"], file.get("file_name"), file.get("file_size"),
+                            file["uploaded_date"].timestamp())
+            self.libraries[user_id] = library
+            logging.debug(f"Built library of {len(library.files)} files for {user_id} in {time.monotonic() - started:.3f}s")
+            while len(self.libraries) > self.max_users:
+                self.libraries.popitem(last=False)
+        self.libraries.move_to_end(user_id)
+        return library
+
+    def add(self, user_id: int, message_id: int, file_name: str, file_size: int) -> None:
+        # libraries not in memory are rebuilt from the database, which already has the file
+        library = self.libraries.get(user_id)
+        if library is not None:
+            library.add(message_id, file_name, file_size, time.time())
+
+    async def search(self, user_id: int, query: str, page: int = 0,
+                     per_page: int = 10) -> Tuple[List[Tuple[int, str, int]], int]:
+        """
+        Returns one page of (message id, title, size) matches and the total number of matches.
+        """
+        library = await self.get(user_id)
+        ids = library.search(query)
+        return [
+            (id, *library.files[id][:2]) for id in ids[page * per_page:(page + 1) * per_page]
+        ], len(ids)
+
+
+file_library = FileLibrary()
@@ -1,11 +1,93 @@
-from pyrogram import Client
-from typing import Any, Optional
+from pyrogram import Client, utils, raw
+from typing import Any, Optional, Union
 from pyrogram.types import Message
-from pyrogram.file_id import FileId
+from pyrogram.file_id import FileId, FileType, ThumbnailSource
 from pyrogram.raw.types.messages import Messages
 from TechVJ.server.exceptions import FIleNotFound
 
 
+class MediaRecord:
+    """
+    Immutable description of a streamable media, holding only what streaming needs.
+    Replaces the full pyrogram FileId that used to be cached per file, the GetFile
+    location is built once here instead of on every request.
+    """
+    __slots__ = (
+        "message_id",
+        "dc_id",
+        "media_id",
+        "file_size",
+        "mime_type",
+        "file_name",
+        "unique_id",
+        "location",
+    )
+
+    def __init__(self, file_id: FileId, message_id: int, file_size: int, mime_type: str, file_name: str, unique_id: str):
+        for name, value in (
+            ("message_id", message_id),
+            ("dc_id", file_id.dc_id),
+            ("media_id", file_id.media_id),
+            ("file_size", file_size or 0),
+            ("mime_type", mime_type or ""),
+            ("file_name", file_name or ""),
+            ("unique_id", unique_id),
+            ("location", get_location(file_id)),
+        ):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __repr__(self):
+        return f"MediaRecord(message_id={self.message_id}, dc_id={self.dc_id}, file_size={self.file_size})"
+
+
+def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation,
+                                           raw.types.InputDocumentFileLocation,
+                                           raw.types.InputPeerPhotoFileLocation,]:
+    """
+    Returns the file location for the media file.
+    """
+    file_type = file_id.file_type
+
+    if file_type == FileType.CHAT_PHOTO:
+        if file_id.chat_id > 0:
+            peer = raw.types.InputPeerUser(
+                user_id=file_id.chat_id, access_hash=file_id.chat_access_hash
+            )
+        else:
+            if file_id.chat_access_hash == 0:
+                peer = raw.types.InputPeerChat(chat_id=-file_id.chat_id)
+            else:
+                peer = raw.types.InputPeerChannel(
+                    channel_id=utils.get_channel_id(file_id.chat_id),
+                    access_hash=file_id.chat_access_hash,
+                )
+
+        location = raw.types.InputPeerPhotoFileLocation(
+            peer=peer,
+            volume_id=file_id.volume_id,
+            local_id=file_id.local_id,
+            big=file_id.thumbnail_source == ThumbnailSource.CHAT_PHOTO_BIG,
+        )
+    elif file_type == FileType.PHOTO:
+        location = raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size,
+        )
+    else:
+        location = raw.types.InputDocumentFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size,
+        )
+    return location
+
+
 async def parse_file_id(message: "Message") -> Optional[FileId]:
     media = get_media_from_message(message)
     if media:
@@ -16,17 +98,57 @@ async def parse_file_unique_id(message: "Messages") -> Optional[str]:
     if media:
         return media.file_unique_id
 
-async def get_file_ids(message):
+async def get_file_ids(message) -> MediaRecord:
     if message.empty:
         raise FIleNotFound
     media = get_media_from_message(message)
     file_unique_id = await parse_file_unique_id(message)
     file_id = await parse_file_id(message)
-    setattr(file_id, "file_size", getattr(media, "file_size", 0))
-    setattr(file_id, "mime_type", getattr(media, "mime_type", ""))
-    setattr(file_id, "file_name", getattr(media, "file_name", ""))
-    setattr(file_id, "unique_id", file_unique_id)
-    return file_id
+    return MediaRecord(
+        file_id,
+        message.id,
+        getattr(media, "file_size", 0),
+        getattr(media, "mime_type", ""),
+        getattr(media, "file_name", ""),
+        file_unique_id,
+    )
+
+def get_media_record(message: "Message") -> Optional[dict]:
+    """Compact, storable description of the media in a LOG_CHANNEL message."""
+    media = get_media_from_message(message)
+    if not media:
+        return None
+    file_id = FileId.decode(media.file_id)
+    return {
+        "_id": message.id,
+        "file_id": media.file_id,
+        "media_id": file_id.media_id,
+        "dc_id": file_id.dc_id,
+        "access_hash": file_id.access_hash,
+        "size": getattr(media, "file_size", 0),
+        "mime": getattr(media, "mime_type", ""),
+        "name": getattr(media, "file_name", ""),
+        "unique_id": media.file_unique_id,
+        "thumb": pick_thumb(media),
+    }
+
+def pick_thumb(media: Any, min_width: int = 320) -> Optional[dict]:
+    """Smallest embedded thumbnail at least `min_width` wide (else the largest one), for posters."""
+    thumbs = sorted(getattr(media, "thumbs", None) or [], key=lambda thumb: thumb.width)
+    if not thumbs:
+        return None
+    thumb = next((thumb for thumb in thumbs if thumb.width >= min_width), thumbs[-1])
+    return {"file_id": thumb.file_id, "size": thumb.file_size}
+
+def file_id_from_record(record: dict) -> MediaRecord:
+    return MediaRecord(
+        FileId.decode(record["file_id"]),
+        record["_id"],
+        record["size"],
+        record["mime"],
+        record["name"],
+        record["unique_id"],
+    )
 
 def get_media_from_message(message: "Message") -> Any:
     media_types = (
@@ -0,0 +1,76 @@
+import time
+from info import *
+from typing import Dict
+from plugins.database import db
+from TechVJ.bot import multi_clients
+from TechVJ.util.admission import admission
+from TechVJ.util.scheduler import scheduler
+from TechVJ.util.drain import drain
+from TechVJ import StartTime, __version__
+
+
+def capacity_report() -> Dict:
+    """
+    Free streaming capacity: the tighter of GetFile headroom and scheduler slots.
+    """
+    fetch = admission.metrics()
+    free_fetch = max(fetch["capacity"] - fetch["in_flight"], 0) / fetch["capacity"]
+    free_slots = max(scheduler.capacity - scheduler.in_use, 0) / max(scheduler.capacity, 1)
+    return {
+        "in_flight": fetch["in_flight"],
+        "max_in_flight": fetch["capacity"],
+        "slots_in_use": scheduler.in_use,
+        "slots": scheduler.capacity,
+        "free": round(min(free_fetch, free_slots), 3),
+    }
+
+
+def weight(capacity: Dict, lag: float) -> int:
+    """
+    Balancer weight hint from 0 to 100, free capacity scaled down as loop lag nears its limit.
+    """
+    if not drain.ready:
+        return 0
+    lag_factor = max(1 - lag / (ADMISSION_MAX_LAG / 1000), 0)
+    return max(round(100 * capacity["free"] * lag_factor), 1)
+
+
+async def health_report(ping: bool = True) -> Dict:
+    """
+    Node state for /healthz and /readyz. Without `ping` the database status is the last one
+    known, so liveness never waits on the database.
+    """
+    clients = {
+        index: {
+            "connected": bool(getattr(client, "is_connected", False)),
+            # DCs this client holds an authorized media session for
+            "dc_sessions": sorted(getattr(client, "media_sessions", {}) or {}),
+        }
+        for index, client in multi_clients.items()
+    }
+    database = await db.ping() if ping else db.ping_ok
+    capacity = capacity_report()
+    return {
+        "version": __version__,
+        "uptime": round(time.time() - StartTime),
+        "ready": drain.ready,
+        "clients": clients,
+        "connected_clients": sum(client["connected"] for client in clients.values()),
+        "database": {"ok": database, "ping_ms": db.ping_ms},
+        "capacity": capacity,
+        "loop_lag_ms": round(admission.lag * 1000, 1),
+        "weight": weight(capacity, admission.lag),
+    }
+
+
+def is_ready(report: Dict) -> bool:
+    """
+    Ready for new viewers: not draining, a client and the database up, and not saturated.
+    """
+    return (
+        report["ready"]
+        and report["connected_clients"] > 0
+        and report["database"]["ok"]
+        and report["capacity"]["free"] > 0
+        and report["loop_lag_ms"] < ADMISSION_MAX_LAG
+    )
@@ -0,0 +1,53 @@
+import math
+import hashlib
+from typing import Iterable
+
+
+class HyperLogLog:
+    def __init__(self, p: int = 12, registers: bytes = None):
+        """HyperLogLog cardinality sketch.
+        With p = 12 it uses 4096 one-byte registers (4 KiB) whatever the number of items,
+        for a standard error of about 1.6%.
+        """
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers else bytearray(self.m)
+        if len(self.registers) != self.m:
+            raise ValueError("Register count doesn't match precision")
+
+    def add(self, value: str) -> None:
+        x = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+        index = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        if other.m != self.m:
+            raise ValueError("Can't merge sketches of different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # small range correction (linear counting)
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        return cls(int(math.log2(len(data))), data)
+
+    @classmethod
+    def union(cls, blobs: Iterable[bytes]) -> "HyperLogLog":
+        sketch = cls()
+        for blob in blobs:
+            sketch.merge(cls.from_bytes(blob))
+        return sketch
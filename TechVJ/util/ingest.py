@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from info import *
+from pyrogram import Client
+from pyrogram.types import Message
+from pyrogram.errors import FloodWait
+from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from plugins.database import db
+from TechVJ.util.media_index import media_index
+from TechVJ.util.file_library import file_library
+from TechVJ.util.keyed_lock import KeyedLock
+from TechVJ.util.file_properties import get_media_from_message
+
+
+class IngestIndex:
+    def __init__(self, max_size: int = INGEST_CACHE_SIZE):
+        """Maps a media's file_unique_id to the LOG_CHANNEL message already holding it.
+        attributes:
+            max_size: how many entries are kept in memory, older ones fall back to the database.
+            cache: LRU of file_unique_id -> message id.
+            locks: per file_unique_id locks so concurrent uploads of one file copy it only once.
+        """
+        self.max_size = max_size
+        self.cache: "OrderedDict[str, int]" = OrderedDict()
+        self.locks = KeyedLock()
+
+    async def get(self, unique_id: str) -> Optional[int]:
+        if unique_id in self.cache:
+            self.cache.move_to_end(unique_id)
+            return self.cache[unique_id]
+        message_id = await db.get_ingested(unique_id)
+        if message_id:
+            self._remember(unique_id, message_id)
+        return message_id
+
+    async def add(self, unique_id: str, message_id: int) -> None:
+        self._remember(unique_id, message_id)
+        await db.add_ingested(unique_id, message_id)
+
+    def _remember(self, unique_id: str, message_id: int) -> None:
+        self.cache[unique_id] = message_id
+        self.cache.move_to_end(unique_id)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+
+ingest_index = IngestIndex()
+
+
+async def record_upload(user_id: int, media: Any, message_id: int) -> None:
+    """
+    Adds the file to the uploader's library (the files collection).
+    Uploading the same file twice keeps a single entry.
+    """
+    added = await db.add_file({
+        "file_id": f"{user_id}_{message_id}",
+        "user_id": user_id,
+        "message_id": message_id,
+        "file_name": getattr(media, "file_name", None) or "",
+        "file_size": getattr(media, "file_size", 0),
+        "mime_type": getattr(media, "mime_type", None) or "",
+        "duration": getattr(media, "duration", 0),
+    })
+    if added:
+        file_library.add(user_id, message_id, getattr(media, "file_name", None), getattr(media, "file_size", 0))
+
+
+async def copy_to_log(client: Client, media: Any) -> int:
+    """
+    Copies the media to LOG_CHANNEL and indexes it, the caller holds its ingest lock.
+    """
+    log_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=media.file_id)
+    await ingest_index.add(media.file_unique_id, log_msg.id)
+    await media_index.add(log_msg)
+    return log_msg.id
+
+
+async def ingest_media(client: Client, media: Any, user_id: int = None) -> int:
+    """
+    Returns the LOG_CHANNEL message id that holds the given media.
+    The media is only copied to the channel the first time its file_unique_id is seen,
+    repeat uploads reuse the existing message.
+    When user_id is given the file is also recorded in that uploader's library.
+    """
+    unique_id = media.file_unique_id
+    async with ingest_index.locks(unique_id):
+        message_id = await ingest_index.get(unique_id)
+        if message_id:
+            logging.debug(f"Reusing LOG_CHANNEL message {message_id} for {unique_id}")
+        else:
+            message_id = await copy_to_log(client, media)
+    if user_id:
+        await record_upload(user_id, media, message_id)
+    return message_id
+
+
+async def ingest_many(client: Client, messages: List[Message]) -> List[int]:
+    """
+    Bulk version of ingest_media for albums and /batch sessions.
+    Already ingested files are reused, the rest are forwarded to LOG_CHANNEL with
+    forward_messages in pages of 100, at most BATCH_CONCURRENCY calls at a time.
+    Every file's ingest lock is held throughout (taken in sorted order, so batches can't
+    deadlock each other) so a concurrent upload of the same file can't copy it again.
+    Returns the LOG_CHANNEL message ids in the same order as the given messages.
+    Every file is recorded in the library of the user who sent it.
+    """
+    medias = [get_media_from_message(m) for m in messages]
+    results: List[Optional[int]] = [None] * len(messages)
+    async with AsyncExitStack() as locks:
+        for unique_id in sorted({media.file_unique_id for media in medias}):
+            await locks.enter_async_context(ingest_index.locks(unique_id))
+        pending: Dict[str, List[int]] = {}
+        for i, media in enumerate(medias):
+            message_id = await ingest_index.get(media.file_unique_id)
+            if message_id:
+                results[i] = message_id
+            else:
+                # the same file twice in one batch is forwarded only once
+                pending.setdefault(media.file_unique_id, []).append(i)
+
+        firsts = [positions[0] for positions in pending.values()]
+        pages = [firsts[i:i + 100] for i in range(0, len(firsts), 100)]
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def forward_page(page: List[int]) -> None:
+            async with semaphore:
+                while True:
+                    try:
+                        forwarded = await client.forward_messages(
+                            chat_id=LOG_CHANNEL,
+                            from_chat_id=messages[page[0]].chat.id,
+                            message_ids=[messages[i].id for i in page],
+                        )
+                        break
+                    except FloodWait as e:
+                        logging.warning(f"FloodWait of {e.value}s while forwarding a batch")
+                        await asyncio.sleep(e.value)
+            if not isinstance(forwarded, list):
+                forwarded = [forwarded]
+            # matched back by file, messages that couldn't be forwarded are left out of the result
+            for log_msg in forwarded:
+                media = get_media_from_message(log_msg) if log_msg else None
+                if media is None or media.file_unique_id not in pending:
+                    continue
+                await ingest_index.add(media.file_unique_id, log_msg.id)
+                await media_index.add(log_msg)
+                for position in pending.pop(media.file_unique_id):
+                    results[position] = log_msg.id
+
+        await asyncio.gather(*[forward_page(page) for page in pages])
+        for unique_id, positions in pending.items():
+            logging.warning(f"{unique_id} missing from a forwarded batch, copying it on its own")
+            message_id = await copy_to_log(client, medias[positions[0]])
+            for position in positions:
+                results[position] = message_id
+    for message, media, message_id in zip(messages, medias, results):
+        await record_upload(message.from_user.id, media, message_id)
+    return results
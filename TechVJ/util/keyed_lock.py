@@ -0,0 +1,27 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, List
+
+
+class KeyedLock:
+    def __init__(self):
+        """One asyncio lock per key, dropped once nobody holds or waits for it.
+        attributes:
+            locks: key -> [lock, number of coroutines holding or waiting for it].
+        """
+        self.locks: Dict[Hashable, List] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    def __len__(self) -> int:
+        return len(self.locks)
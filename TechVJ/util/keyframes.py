@@ -0,0 +1,262 @@
+import time
+import bisect
+import struct
+import logging
+from info import *
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from plugins.database import db
+from TechVJ.util.custom_dl import ByteStreamer
+from TechVJ.util.file_properties import MediaRecord
+from TechVJ.util.mp4 import Reader, top_level, parse_tracks, video_track, read_moov
+from TechVJ.util.keyed_lock import KeyedLock
+
+# (keyframe times in seconds, byte offsets), both ascending
+Keyframes = Tuple[List[float], List[int]]
+
+# seconds before a file whose headers failed to parse is read again
+RETRY_FAILED = 15 * 60
+
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_CLUSTER_POSITION = 0xF1
+
+
+def mp4_keyframes(moov: bytes) -> Optional[Keyframes]:
+    """
+    Walks the video track's sample tables (stts, stss, stsc, stsz, stco/co64)
+    and returns the decode time and file offset of every sync sample.
+    """
+    track = video_track(parse_tracks(moov))
+    if track is None:
+        return None
+    stts, stss, stsc, stsz = (track.stbl(moov, kind) for kind in (b"stts", b"stss", b"stsc", b"stsz"))
+    chunk_table = track.stbl(moov, b"stco") or track.stbl(moov, b"co64")
+    if not (stts and stsc and stsz and chunk_table):
+        return None
+
+    count = struct.unpack_from(">I", moov, chunk_table.start + 4)[0]
+    wide = chunk_table.type == b"co64"
+    chunks = struct.unpack_from(f">{count}{'Q' if wide else 'I'}", moov, chunk_table.start + 8)
+    sample_size, samples = struct.unpack_from(">II", moov, stsz.start + 4)
+    sizes = struct.unpack_from(f">{samples}I", moov, stsz.start + 12) if sample_size == 0 else None
+    count = struct.unpack_from(">I", moov, stts.start + 4)[0]
+    deltas = struct.unpack_from(f">{count * 2}I", moov, stts.start + 8)
+    count = struct.unpack_from(">I", moov, stsc.start + 4)[0]
+    runs = struct.unpack_from(f">{count * 3}I", moov, stsc.start + 8)
+    if stss:
+        count = struct.unpack_from(">I", moov, stss.start + 4)[0]
+        sync = set(struct.unpack_from(f">{count}I", moov, stss.start + 8))
+    else:
+        sync = None
+
+    # decode time of every sample, from the (count, delta) runs of stts
+    decode_times, time = [], 0
+    for run in range(0, len(deltas), 2):
+        for _ in range(deltas[run]):
+            decode_times.append(time)
+            time += deltas[run + 1]
+
+    times, offsets, sample = [], [], 0
+    for run in range(0, len(runs), 3):
+        first_chunk, per_chunk = runs[run], runs[run + 1]
+        last_chunk = runs[run + 3] - 1 if run + 3 < len(runs) else len(chunks)
+        for chunk in range(first_chunk, last_chunk + 1):
+            offset = chunks[chunk - 1]
+            for _ in range(per_chunk):
+                if sample >= samples:
+                    break
+                # stss sample numbers are 1 based
+                if (sync is None or sample + 1 in sync) and sample < len(decode_times):
+                    times.append(decode_times[sample] / track.timescale)
+                    offsets.append(offset)
+                offset += sizes[sample] if sizes else sample_size
+                sample += 1
+    return times, offsets
+
+
+def ebml_id(data: bytes, position: int) -> Tuple[int, int]:
+    """
+    Returns (element id, position after it), the id keeps its length marker bits.
+    """
+    first = data[position]
+    length = 8 - first.bit_length() + 1
+    return int.from_bytes(data[position:position + length], "big"), position + length
+
+
+def ebml_size(data: bytes, position: int) -> Tuple[Optional[int], int]:
+    """
+    Returns (element size, position after it), None for the unknown size marker.
+    """
+    first = data[position]
+    length = 8 - first.bit_length() + 1
+    value = int.from_bytes(data[position:position + length], "big") & ((1 << (7 * length)) - 1)
+    return (None if value == (1 << (7 * length)) - 1 else value), position + length
+
+
+def ebml_elements(data: bytes, start: int = 0, end: Optional[int] = None):
+    """
+    Yields (id, element start, payload start, payload end) of the elements in data[start:end].
+    """
+    end = len(data) if end is None else end
+    while start < end:
+        try:
+            element, position = ebml_id(data, start)
+            size, position = ebml_size(data, position)
+        except (IndexError, ValueError):
+            return
+        stop = end if size is None else position + size
+        yield element, start, position, min(stop, end)
+        start = stop
+
+
+def ebml_uint(data: bytes, start: int, end: int) -> int:
+    return int.from_bytes(data[start:end], "big")
+
+
+async def mkv_keyframes(read: Reader, file_size: int) -> Optional[Keyframes]:
+    """
+    Reads the Cues of a Matroska/WebM file, located through the SeekHead.
+    Cue points are placed on keyframes, each one names the cluster holding it.
+    """
+    head = await read(0, 64 * 1024)
+    elements = list(ebml_elements(head))
+    if not elements or elements[0][0] != EBML:
+        return None
+    segment = next((e for e in elements if e[0] == SEGMENT), None)
+    if segment is None:
+        return None
+    # SeekHead and CueClusterPosition offsets are relative to the Segment payload
+    segment_start = segment[2]
+
+    scale, cues_position = 1000000, None
+    for element, offset, start, end in ebml_elements(head, segment_start, len(head)):
+        if element == SEEK_HEAD:
+            for seek, _, seek_start, seek_end in ebml_elements(head, start, end):
+                if seek != SEEK:
+                    continue
+                fields = {e: (s, t) for e, _, s, t in ebml_elements(head, seek_start, seek_end)}
+                if SEEK_ID in fields and SEEK_POSITION in fields:
+                    seek_id = ebml_uint(head, *fields[SEEK_ID])
+                    if seek_id == CUES:
+                        cues_position = segment_start + ebml_uint(head, *fields[SEEK_POSITION])
+        elif element == INFO:
+            for field, _, field_start, field_end in ebml_elements(head, start, end):
+                if field == TIMECODE_SCALE:
+                    scale = ebml_uint(head, field_start, field_end)
+        elif element == CUES:
+            cues_position = offset
+    if cues_position is None or cues_position >= file_size:
+        return None
+
+    header = await read(cues_position, 16)
+    element, position = ebml_id(header, 0)
+    size, position = ebml_size(header, position)
+    if element != CUES or size is None:
+        return None
+    cues = await read(cues_position + position, size)
+
+    points = []
+    for point, _, start, end in ebml_elements(cues):
+        if point != CUE_POINT:
+            continue
+        time, cluster = None, None
+        for field, _, field_start, field_end in ebml_elements(cues, start, end):
+            if field == CUE_TIME:
+                time = ebml_uint(cues, field_start, field_end)
+            elif field == CUE_TRACK_POSITIONS and cluster is None:
+                for sub, _, sub_start, sub_end in ebml_elements(cues, field_start, field_end):
+                    if sub == CUE_CLUSTER_POSITION:
+                        cluster = ebml_uint(cues, sub_start, sub_end)
+        if time is not None and cluster is not None:
+            points.append((time * scale / 1e9, segment_start + cluster))
+    points.sort()
+    return [time for time, _ in points], [offset for _, offset in points]
+
+
+class KeyframeIndex:
+    def __init__(self, max_size: int = KEYFRAME_CACHE_SIZE):
+        """Time -> byte offset index of each media's keyframes.
+        Built once from the container headers (MP4 sample tables or Matroska Cues),
+        persisted in the keyframes collection and kept in an LRU in memory.
+        Files whose headers failed to parse aren't persisted, they're retried after RETRY_FAILED.
+        """
+        self.max_size = max_size
+        self.indexes: "OrderedDict[int, Keyframes]" = OrderedDict()
+        self.failed: "OrderedDict[int, float]" = OrderedDict()
+        self.locks = KeyedLock()
+
+    async def get(self, streamer: ByteStreamer, file_id: MediaRecord, index: int) -> Keyframes:
+        if file_id.media_id in self.indexes:
+            self.indexes.move_to_end(file_id.media_id)
+            return self.indexes[file_id.media_id]
+        if time.monotonic() < self.failed.get(file_id.media_id, 0):
+            return [], []
+        async with self.locks(file_id.media_id):
+            if file_id.media_id not in self.indexes:
+                doc = await db.get_keyframes(file_id.media_id)
+                if doc:
+                    keyframes = (doc["times"], doc["offsets"])
+                else:
+                    keyframes = await self.build(streamer, file_id, index)
+                    if keyframes is None:
+                        self.fail(file_id.media_id)
+                        return [], []
+                    # files without an index (no moov or Cues) are saved empty, so they aren't read again
+                    await db.save_keyframes(file_id.media_id, *keyframes)
+                self.indexes[file_id.media_id] = keyframes
+                while len(self.indexes) > self.max_size:
+                    self.indexes.popitem(last=False)
+        return self.indexes[file_id.media_id]
+
+    def fail(self, media_id: int) -> None:
+        self.failed[media_id] = time.monotonic() + RETRY_FAILED
+        self.failed.move_to_end(media_id)
+        while len(self.failed) > self.max_size:
+            self.failed.popitem(last=False)
+
+    async def build(self, streamer: ByteStreamer, file_id: MediaRecord, index: int) -> Optional[Keyframes]:
+        """
+        Returns None when the headers couldn't be parsed (maybe a short read), so nothing is persisted.
+        """
+        async def read(start: int, length: int) -> bytes:
+            return await streamer.read(file_id, index, start, length, 4096 if length <= 4096 else 1024 * 1024)
+
+        keyframes = None
+        try:
+            if (file_id.mime_type or "").lower() in ("video/x-matroska", "video/webm"):
+                keyframes = await mkv_keyframes(read, file_id.file_size)
+            else:
+                boxes = await top_level(read, file_id.file_size, stop=(b"moof",))
+                moov = await read_moov(read, boxes)
+                if moov:
+                    keyframes = mp4_keyframes(moov)
+        except (struct.error, IndexError, AttributeError, TypeError):
+            logging.warning(f"Couldn't index keyframes of message {file_id.message_id}", exc_info=True)
+            return None
+        logging.debug(f"Indexed {len(keyframes[0]) if keyframes else 0} keyframes of message {file_id.message_id}")
+        return keyframes or ([], [])
+
+
+def seek(keyframes: Keyframes, seconds: float) -> Optional[Tuple[float, int]]:
+    """
+    Returns (time, offset) of the last keyframe at or before `seconds`.
+    """
+    times, offsets = keyframes
+    if not times:
+        return None
+    position = max(bisect.bisect_right(times, seconds) - 1, 0)
+    return times[position], offsets[position]
+
+
+keyframe_index = KeyframeIndex()
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from info import *
+from pyrogram import Client
+from typing import Dict, Optional
+from collections import OrderedDict
+from TechVJ.util.file_properties import MediaRecord
+from plugins.database import db
+from TechVJ.server.exceptions import FIleNotFound
+from TechVJ.util.file_properties import get_file_ids, get_media_record, file_id_from_record
+
+
+class MediaIndex:
+    def __init__(self, max_size: int = MEDIA_INDEX_CACHE_SIZE):
+        """Persistent index of the media stored in LOG_CHANNEL.
+        attributes:
+            max_size: how many records are kept in memory, the rest are read from the database.
+            records: LRU of message id -> media record (see get_media_record).
+            last_seen: newest LOG_CHANNEL post seen in updates, the channel's last message id.
+
+        functions:
+            get_file_id: resolves a message id to a MediaRecord, from the index when possible.
+            refresh: re-reads a message from Telegram, used when its file reference expired.
+            run: background task that walks LOG_CHANNEL from the last indexed message id.
+        """
+        self.max_size = max_size
+        self.records: "OrderedDict[int, Dict]" = OrderedDict()
+        self.last_seen = 0
+
+    async def get(self, message_id: int) -> Optional[Dict]:
+        record = self.records.get(message_id)
+        if record is None:
+            record = await db.get_media_record(message_id)
+            if record is None:
+                return None
+            self._remember(record)
+        self.records.move_to_end(message_id)
+        return record
+
+    async def add(self, message) -> Optional[Dict]:
+        record = get_media_record(message)
+        if record:
+            self._remember(record)
+            await db.save_media_records([record])
+        return record
+
+    async def get_file_id(self, client: Client, message_id: int) -> MediaRecord:
+        record = await self.get(message_id)
+        if record:
+            return file_id_from_record(record)
+        message = await client.get_messages(LOG_CHANNEL, message_id)
+        file_id = await get_file_ids(message)
+        await self.add(message)
+        return file_id
+
+    async def refresh(self, client: Client, message_id: int) -> MediaRecord:
+        self.records.pop(message_id, None)
+        message = await client.get_messages(LOG_CHANNEL, message_id)
+        if message.empty:
+            await db.delete_media_record(message_id)
+            raise FIleNotFound
+        file_id = await get_file_ids(message)
+        await self.add(message)
+        return file_id
+
+    def _remember(self, record: Dict) -> None:
+        self.records[record["_id"]] = record
+        self.records.move_to_end(record["_id"])
+        while len(self.records) > self.max_size:
+            self.records.popitem(last=False)
+
+    def seen(self, message_id: int) -> None:
+        self.last_seen = max(self.last_seen, message_id)
+
+    async def index_once(self, client: Client, page_size: int = 200) -> int:
+        """
+        Indexes LOG_CHANNEL messages after the last indexed id, a page of ids at a time, up to the
+        channel's last message: the newest ingested one or the newest post seen in updates,
+        whichever is later. Bots can't read a channel's history, so nothing past it is probed.
+        Returns the number of media records written.
+        """
+        last_id = await db.get_meta("media_index_last_id", 0)
+        newest_id = max(await db.get_last_ingested_id(), self.last_seen)
+        written = 0
+        while last_id < newest_id:
+            ids = list(range(last_id + 1, min(last_id + page_size, newest_id) + 1))
+            batch = []
+            for message in await client.get_messages(LOG_CHANNEL, ids):
+                record = None if message.empty else get_media_record(message)
+                if record:
+                    self._remember(record)
+                    batch.append(record)
+            await db.save_media_records(batch)
+            written += len(batch)
+            last_id = ids[-1]
+            await db.set_meta("media_index_last_id", last_id)
+        return written
+
+    async def run(self, client: Client) -> None:
+        while True:
+            try:
+                written = await self.index_once(client)
+                if written:
+                    logging.info(f"Indexed {written} LOG_CHANNEL media records")
+            except Exception:
+                logging.error("LOG_CHANNEL indexing failed", exc_info=True)
+            await asyncio.sleep(MEDIA_INDEX_INTERVAL)
+
+
+media_index = MediaIndex()
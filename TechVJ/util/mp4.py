@@ -0,0 +1,152 @@
+import struct
+from typing import Awaitable, Callable, Iterator, List, Optional, Tuple
+
+# (offset, length) -> bytes, usually a ByteStreamer.read bound to one file
+Reader = Callable[[int, int], Awaitable[bytes]]
+
+# largest moov we are willing to pull into memory
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+
+class Box:
+    __slots__ = ("type", "offset", "size", "header")
+
+    def __init__(self, type: bytes, offset: int, size: int, header: int):
+        """One ISO BMFF box, offsets are relative to the buffer (or file) it was read from."""
+        self.type = type
+        self.offset = offset
+        self.size = size
+        self.header = header
+
+    @property
+    def start(self) -> int:
+        """Offset of the payload."""
+        return self.offset + self.header
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.size
+
+
+def iter_boxes(data: bytes, start: int = 0, end: Optional[int] = None) -> Iterator[Box]:
+    """
+    Yields the boxes laid out back to back in data[start:end].
+    """
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:
+            if start + 16 > end:
+                return
+            size = struct.unpack_from(">Q", data, start + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield Box(kind, start, size, header)
+        start += size
+
+
+def find_box(data: bytes, *path: bytes, start: int = 0, end: Optional[int] = None) -> Optional[Box]:
+    """
+    Returns the first box at `path` (e.g. b"trak", b"mdia", b"mdhd") under data[start:end].
+    """
+    for box in iter_boxes(data, start, end):
+        if box.type == path[0]:
+            if len(path) == 1:
+                return box
+            found = find_box(data, *path[1:], start=box.start, end=box.end)
+            if found:
+                return found
+    return None
+
+
+def find_all(data: bytes, kind: bytes, start: int = 0, end: Optional[int] = None) -> List[Box]:
+    return [box for box in iter_boxes(data, start, end) if box.type == kind]
+
+
+def full_box(data: bytes, box: Box) -> Tuple[int, int]:
+    """
+    Returns (version, flags) of a full box.
+    """
+    word = struct.unpack_from(">I", data, box.start)[0]
+    return word >> 24, word & 0xFFFFFF
+
+
+async def top_level(read: Reader, file_size: int, stop: Tuple[bytes, ...] = (), offset: int = 0) -> List[Box]:
+    """
+    Walks the top level boxes of a file from `offset` on, reading only their headers.
+    Stops after the first box whose type is in `stop`.
+    """
+    boxes = []
+    while offset + 8 <= file_size:
+        head = await read(offset, 16)
+        if len(head) < 8:
+            break
+        size, kind = struct.unpack_from(">I4s", head)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", head, 8)[0]
+            header = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header:
+            break
+        boxes.append(Box(kind, offset, size, header))
+        if kind in stop:
+            break
+        offset += size
+    return boxes
+
+
+class Track:
+    __slots__ = ("id", "handler", "timescale", "duration", "width", "height", "trak")
+
+    def __init__(self, moov: bytes, trak: Box):
+        """A track of a parsed moov.
+        attributes:
+            handler: b"vide", b"soun", ...
+            timescale: units per second of the track's sample times.
+            trak: the trak box inside the moov buffer, for reading its sample tables.
+        """
+        self.trak = trak
+        tkhd = find_box(moov, b"tkhd", start=trak.start, end=trak.end)
+        version, _ = full_box(moov, tkhd)
+        self.id = struct.unpack_from(">I", moov, tkhd.start + (20 if version else 12))[0]
+        # width and height are 16.16 fixed point, the last 8 bytes of tkhd
+        self.width = struct.unpack_from(">I", moov, tkhd.end - 8)[0] >> 16
+        self.height = struct.unpack_from(">I", moov, tkhd.end - 4)[0] >> 16
+        hdlr = find_box(moov, b"mdia", b"hdlr", start=trak.start, end=trak.end)
+        self.handler = moov[hdlr.start + 8:hdlr.start + 12] if hdlr else b""
+        mdhd = find_box(moov, b"mdia", b"mdhd", start=trak.start, end=trak.end)
+        version, _ = full_box(moov, mdhd)
+        if version:
+            self.timescale, self.duration = struct.unpack_from(">IQ", moov, mdhd.start + 20)
+        else:
+            self.timescale, self.duration = struct.unpack_from(">II", moov, mdhd.start + 12)
+
+    def stbl(self, moov: bytes, kind: bytes) -> Optional[Box]:
+        return find_box(moov, b"mdia", b"minf", b"stbl", kind, start=self.trak.start, end=self.trak.end)
+
+
+def parse_tracks(moov: bytes) -> List[Track]:
+    """
+    Parses the tracks of a moov payload (the bytes after the moov header).
+    """
+    return [Track(moov, trak) for trak in find_all(moov, b"trak")]
+
+
+def video_track(tracks: List[Track]) -> Optional[Track]:
+    return next((track for track in tracks if track.handler == b"vide"), None)
+
+
+async def read_moov(read: Reader, boxes: List[Box]) -> Optional[bytes]:
+    """
+    Returns the payload of the moov box found by `top_level`, or None.
+    """
+    moov = next((box for box in boxes if box.type == b"moov"), None)
+    if moov is None or moov.size > MAX_MOOV_SIZE:
+        return None
+    return await read(moov.start, moov.size - moov.header)
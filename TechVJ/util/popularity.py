@@ -0,0 +1,114 @@
+import time
+import asyncio
+import logging
+from info import *
+from collections import deque
+from typing import Dict, List, Tuple
+from TechVJ.bot import multi_clients, work_loads
+from TechVJ.util.chunk_store import chunk_store
+from TechVJ.util.token_bucket import TokenBucket
+from TechVJ.util.custom_dl import get_streamer
+from TechVJ.server.exceptions import FIleNotFound
+
+
+class SpaceSaving:
+    def __init__(self, size: int):
+        """Space-Saving heavy hitter sketch, keeps at most `size` counters."""
+        self.size = size
+        self.counts: Dict[int, int] = {}
+
+    def add(self, key: int, count: int = 1) -> None:
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.size:
+            self.counts[key] = count
+        else:
+            # evict the smallest counter and inherit its count, as the algorithm prescribes
+            victim = min(self.counts, key=self.counts.get)
+            self.counts[key] = self.counts.pop(victim) + count
+
+
+class PopularityTracker:
+    def __init__(self, window: int = POPULARITY_WINDOW, size: int = POPULARITY_SKETCH_SIZE):
+        """Sliding window view counts per LOG_CHANNEL message id.
+        attributes:
+            window: window length in minutes, one sketch is kept per minute.
+            size: counters per sketch, memory is bounded by window * size.
+        """
+        self.window = window
+        self.size = size
+        self.buckets: "deque[Tuple[int, SpaceSaving]]" = deque()
+
+    def hit(self, id: int) -> None:
+        self.seed(id, 1)
+
+    def seed(self, id: int, count: int) -> None:
+        minute = int(time.time() // 60)
+        if not self.buckets or self.buckets[-1][0] != minute:
+            self.buckets.append((minute, SpaceSaving(self.size)))
+        while self.buckets[0][0] <= minute - self.window:
+            self.buckets.popleft()
+        self.buckets[-1][1].add(id, count)
+
+    def top(self, count: int) -> List[Tuple[int, int]]:
+        oldest = int(time.time() // 60) - self.window
+        totals: Dict[int, int] = {}
+        for minute, sketch in self.buckets:
+            if minute <= oldest:
+                continue
+            for id, hits in sketch.counts.items():
+                totals[id] = totals.get(id, 0) + hits
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+popularity = PopularityTracker()
+
+
+class Prefetcher:
+    def __init__(self):
+        """Pulls the head and tail (MP4 moov) of trending files into the chunk store.
+        attributes:
+            buckets: per client bandwidth budget, so prefetching never starves live streams.
+        """
+        self.chunk_size = 1024 * 1024
+        self.buckets: Dict[int, TokenBucket] = {}
+
+    def offsets(self, file_size: int) -> List[int]:
+        last = max(file_size - 1, 0) // self.chunk_size
+        head = range(min(PREFETCH_HEAD_MB, last + 1))
+        tail = range(max(last + 1 - PREFETCH_TAIL_MB, 0), last + 1)
+        return [part * self.chunk_size for part in sorted(set(head) | set(tail))]
+
+    async def prefetch_once(self) -> int:
+        fetched = 0
+        for id, hits in popularity.top(PREFETCH_TOP):
+            idle = [i for i in multi_clients if work_loads.get(i, 0) < PREFETCH_MAX_LOAD]
+            if not idle:
+                logging.debug("All clients busy, skipping prefetch")
+                break
+            index = min(idle, key=work_loads.get)
+            streamer = get_streamer(multi_clients[index])
+            try:
+                file_id = await streamer.get_file_properties(id)
+                offsets = self.offsets(file_id.file_size)
+                if all(chunk_store.has(file_id.media_id, o, self.chunk_size) for o in offsets):
+                    continue
+                bucket = self.buckets.setdefault(index, TokenBucket(PREFETCH_BANDWIDTH * 1024))
+                fetched += await streamer.prefetch(file_id, index, offsets, self.chunk_size, bucket)
+                logging.debug(f"Prefetched message {id} ({hits} recent hits) with client {index}")
+            except FIleNotFound:
+                logging.debug(f"Trending message {id} no longer exists")
+        return fetched
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(PREFETCH_INTERVAL)
+            try:
+                fetched = await self.prefetch_once()
+                if fetched:
+                    logging.info(f"Prefetched {fetched} bytes of trending files")
+            except Exception:
+                logging.error("Prefetching failed", exc_info=True)
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,36 @@
+import time
+from info import *
+from typing import Dict, Tuple
+from collections import OrderedDict
+from plugins.database import db
+
+
+class ProfileCache:
+    def __init__(self, max_size: int = PROFILE_CACHE_SIZE, ttl: int = PROFILE_CACHE_TTL):
+        """Read-through LRU of uploader profiles (name, link, ban status, payout flag) for the watch page.
+        Entries are dropped explicitly by /start and /update, the ttl only bounds staleness
+        of changes made elsewhere (another instance, the admin editing the database).
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.profiles: "OrderedDict[int, Tuple[float, Dict]]" = OrderedDict()
+
+    async def get(self, user_id: int) -> Dict:
+        cached = self.profiles.get(user_id)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            self.profiles.move_to_end(user_id)
+            return cached[1]
+        profile = await db.get_profile(user_id)
+        if user_id in BANNED_USERS:
+            profile["banned"] = True
+        self.profiles[user_id] = (time.monotonic(), profile)
+        self.profiles.move_to_end(user_id)
+        while len(self.profiles) > self.max_size:
+            self.profiles.popitem(last=False)
+        return profile
+
+    def invalidate(self, user_id: int) -> None:
+        self.profiles.pop(user_id, None)
+
+
+profiles = ProfileCache()
@@ -6,10 +6,15 @@ from info import *
 import urllib.parse
 from TechVJ.bot import TechVJBot, TechVJBackUpBot
 from TechVJ.util.human_readable import humanbytes
-from TechVJ.server.exceptions import InvalidHash
+from TechVJ.server.exceptions import InvalidHash, FIleNotFound
 from pyrogram.errors import FloodWait
-from TechVJ.util.file_properties import get_name, get_hash, get_media_file_size, get_file_ids
-from plugins.database import db
+from TechVJ.util.file_properties import get_name, get_hash, get_media_file_size
+from TechVJ.util.profile_cache import profiles
+from TechVJ.util.media_index import media_index
+from TechVJ.util.popularity import popularity
+
+# placeholder poster of dl.html and req.html, swapped for the file's own thumbnail
+DEFAULT_POSTER = "https://i.ibb.co/Yz4y12n/photo-2025-06-16-10-05-31-7516486294654943252.jpg"
 
 async def render_page(id, user, secid, thid, src=None):
     file_data_one = None
@@ -17,14 +22,15 @@ async def render_page(id, user, secid, thid, src=None):
     file_data_three = None
     if id != 0:
         try:
-            fileone = await TechVJBot.get_messages(int(LOG_CHANNEL), int(id))
-        except:
-            fileone = await TechVJBackUpBot.get_messages(int(LOG_CHANNEL), int(id))
-        file_data_one = await get_file_ids(fileone)
+            file_data_one = await media_index.get_file_id(TechVJBot, int(id))
+        except FIleNotFound:
+            raise
+        except Exception:
+            file_data_one = await media_index.get_file_id(TechVJBackUpBot, int(id))
     
         src = urllib.parse.urljoin(
             STREAM_URL + "dl/",
-            f"{id}/{urllib.parse.quote_plus(file_data_one.file_name)}?hash={file_data_one.unique_id[:6]}",
+            f"{id}/{urllib.parse.quote_plus(file_data_one.file_name)}?hash={file_data_one.unique_id[:6]}&faststart=1",
         )
         quality = "480"
     else:
@@ -33,13 +39,14 @@ async def render_page(id, user, secid, thid, src=None):
 
     if secid != 0:
         try:
-            filetwo = await TechVJBot.get_messages(int(LOG_CHANNEL), int(secid))
-        except:
-            filetwo = await TechVJBackUpBot.get_messages(int(LOG_CHANNEL), int(secid))
-        file_data_two = await get_file_ids(filetwo)
+            file_data_two = await media_index.get_file_id(TechVJBot, int(secid))
+        except FIleNotFound:
+            raise
+        except Exception:
+            file_data_two = await media_index.get_file_id(TechVJBackUpBot, int(secid))
         file_url_two = urllib.parse.urljoin(
             STREAM_URL + "dl/",
-            f"{secid}/{urllib.parse.quote_plus(file_data_two.file_name)}?hash={file_data_two.unique_id[:6]}",
+            f"{secid}/{urllib.parse.quote_plus(file_data_two.file_name)}?hash={file_data_two.unique_id[:6]}&faststart=1",
         )
         quality_two = "720"
     else:
@@ -48,13 +55,14 @@ async def render_page(id, user, secid, thid, src=None):
 
     if thid != 0:
         try:
-            filethree = await TechVJBot.get_messages(int(LOG_CHANNEL), int(thid))
-        except:
-            filethree = await TechVJBackUpBot.get_messages(int(LOG_CHANNEL), int(thid))
-        file_data_three = await get_file_ids(filethree)
+            file_data_three = await media_index.get_file_id(TechVJBot, int(thid))
+        except FIleNotFound:
+            raise
+        except Exception:
+            file_data_three = await media_index.get_file_id(TechVJBackUpBot, int(thid))
         file_url_three = urllib.parse.urljoin(
             STREAM_URL + "dl/",
-            f"{thid}/{urllib.parse.quote_plus(file_data_three.file_name)}?hash={file_data_three.unique_id[:6]}",
+            f"{thid}/{urllib.parse.quote_plus(file_data_three.file_name)}?hash={file_data_three.unique_id[:6]}&faststart=1",
         )
         quality_three = "1080"
     else:
@@ -68,6 +76,10 @@ async def render_page(id, user, secid, thid, src=None):
             file_data = file_data_two
     else:
         file_data = file_data_one
+    # only ids that resolved to a file count, made up ids would push real ones out of the top-K
+    for watched in (id, secid, thid):
+        if watched != 0:
+            popularity.hit(int(watched))
         
     tag = file_data.mime_type.split("/")[0].strip()
     file_size = humanbytes(file_data.file_size)
@@ -79,15 +91,18 @@ async def render_page(id, user, secid, thid, src=None):
             async with s.get(src) as u:
                 file_size = humanbytes(int(u.headers.get("Content-Length")))
 
+    poster_url = f"{STREAM_URL}thumb/{file_data.message_id}"
+
     with open(template_file) as f:
         template = jinja2.Template(f.read())
 
     old_file_name = file_data.file_name.replace("_", " ")
     file_name_clean = clean_file_name(old_file_name)
     file_name = remove_after_year(file_name_clean)
-    link = await db.get_link(int(user))
-    name = await db.get_name(int(user))
-    return template.render(
+    profile = await profiles.get(int(user))
+    link = profile["link"]
+    name = profile["name"]
+    html = template.render(
         file_name=file_name,
         file_url=src,
         file_url_two=file_url_two,
@@ -97,6 +112,7 @@ async def render_page(id, user, secid, thid, src=None):
         link=link,
         name=name
     )
+    return html.replace(DEFAULT_POSTER, poster_url)
 
 
 def clean_file_name(file_name):
@@ -0,0 +1,210 @@
+import asyncio
+from info import *
+from aiohttp import web
+from collections import Counter, OrderedDict, deque
+from typing import AsyncIterator, Dict, Optional, Tuple
+from plugins.database import db
+from TechVJ.bot import multi_clients
+from TechVJ.util.token_bucket import TokenBucket
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# runtime tunables, /policy changes them and they're kept in the meta collection
+DEFAULT_POLICY = {
+    "slots": SCHED_SLOTS,
+    "per_ip": SCHED_PER_IP,
+    "per_file": SCHED_PER_FILE,
+    "rate": SCHED_RATE,
+    "bulk_rate": SCHED_BULK_RATE,
+    "interactive_weight": SCHED_INTERACTIVE_WEIGHT,
+}
+# the smallest value each tunable accepts, a slot count or cap of 0 would stall every stream
+MINIMUM_POLICY = {"slots": 1, "per_ip": 1, "per_file": 1, "rate": 0, "bulk_rate": 0, "interactive_weight": 1}
+
+
+def classify(request: web.Request) -> str:
+    """
+    Playback from a player (or our watch page) is interactive, anything else is a bulk download.
+    """
+    if request.headers.get("Sec-Fetch-Dest") in ("video", "audio") or request.query.get("faststart"):
+        return INTERACTIVE
+    if request.headers.get("Referer", "").startswith(STREAM_URL):
+        return INTERACTIVE
+    return BULK
+
+
+class FairScheduler:
+    def __init__(self):
+        """Fair queueing of chunk fetches between media_streamer and Telegram.
+        Every chunk of a stream takes one of `slots` fetch slots per client. Waiters queue per
+        class and per IP: IPs take turns (round robin) within a class, interactive waiters go
+        first but bulk gets a turn after every `interactive_weight` interactive grants, and no
+        IP or file holds more than `per_ip` / `per_file` slots. Each connection's egress is
+        shaped by a token bucket of `rate` (or `bulk_rate`) KiB/s, 0 meaning unlimited. A
+        waiter not granted a slot within `timeout` seconds gives up.
+        """
+        self.policy: Dict[str, int] = dict(DEFAULT_POLICY)
+        self.queues: Dict[str, "OrderedDict[str, deque]"] = {INTERACTIVE: OrderedDict(), BULK: OrderedDict()}
+        self.active_ips: Counter = Counter()
+        self.active_files: Counter = Counter()
+        self.in_use = 0
+        self.streak = 0
+        self.granted: Counter = Counter()
+        self.queued: Counter = Counter()
+        self.bytes: Counter = Counter()
+        self.streams: Counter = Counter()
+        self.timeouts: Counter = Counter()
+
+    @property
+    def capacity(self) -> int:
+        return self.policy["slots"] * max(len(multi_clients), 1)
+
+    async def load(self) -> None:
+        self.policy.update(await db.get_meta("scheduler_policy", {}) or {})
+
+    async def set(self, name: str, value: int) -> None:
+        if name not in DEFAULT_POLICY:
+            raise KeyError(name)
+        if value < MINIMUM_POLICY[name]:
+            raise ValueError(f"{name} must be at least {MINIMUM_POLICY[name]}")
+        self.policy[name] = value
+        await db.set_meta("scheduler_policy", self.policy)
+        self.dispatch()
+
+    def waiting(self, kind: str) -> int:
+        return sum(len(waiters) for waiters in self.queues[kind].values())
+
+    def pop(self, kind: str) -> Optional[Tuple[asyncio.Future, str, int]]:
+        queues = self.queues[kind]
+        for ip in list(queues):
+            waiters = queues[ip]
+            while waiters and waiters[0][0].done():
+                waiters.popleft()
+            if not waiters:
+                del queues[ip]
+                continue
+            if self.active_ips[ip] >= self.policy["per_ip"]:
+                continue
+            for position, (future, file) in enumerate(waiters):
+                if not future.done() and self.active_files[file] < self.policy["per_file"]:
+                    del waiters[position]
+                    # the IP goes to the back of the line
+                    if waiters:
+                        queues.move_to_end(ip)
+                    else:
+                        del queues[ip]
+                    return future, ip, file
+        return None
+
+    def dispatch(self) -> None:
+        while self.in_use < self.capacity:
+            order = (INTERACTIVE, BULK)
+            if self.streak >= self.policy["interactive_weight"] and self.queues[BULK]:
+                order = (BULK, INTERACTIVE)
+            for kind in order:
+                waiter = self.pop(kind)
+                if waiter:
+                    break
+            else:
+                return
+            self.streak = self.streak + 1 if kind == INTERACTIVE else 0
+            future, ip, file = waiter
+            self.grant(ip, file, kind)
+            future.set_result(None)
+
+    def grant(self, ip: str, file: int, kind: str) -> None:
+        self.in_use += 1
+        self.active_ips[ip] += 1
+        self.active_files[file] += 1
+        self.granted[kind] += 1
+
+    def release(self, ip: str, file: int) -> None:
+        self.in_use -= 1
+        for counter, key in ((self.active_ips, ip), (self.active_files, file)):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+        self.dispatch()
+
+    def try_acquire(self, ip: str, file: int, kind: str) -> bool:
+        """
+        Takes a slot only if one is free right now and nobody is waiting, for speculative
+        fetches (read-ahead) that are better skipped than queued.
+        """
+        if (self.in_use >= self.capacity or self.queues[INTERACTIVE] or self.queues[BULK]
+                or self.active_ips[ip] >= self.policy["per_ip"]
+                or self.active_files[file] >= self.policy["per_file"]):
+            return False
+        self.grant(ip, file, kind)
+        return True
+
+    async def acquire(self, ip: str, file: int, kind: str, timeout: float = SCHED_TIMEOUT) -> None:
+        """
+        Waits for a slot, raises asyncio.TimeoutError if none is granted within `timeout` seconds.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queues[kind].setdefault(ip, deque()).append((future, file))
+        self.queued[kind] += 1
+        self.dispatch()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            # granted just as the request went away or timed out, hand the slot on
+            if future.done() and not future.cancelled():
+                self.release(ip, file)
+            # and take the waiter out of its queue now, try_acquire only grants when the queues are empty
+            waiters = self.queues[kind].get(ip)
+            if waiters and (future, file) in waiters:
+                waiters.remove((future, file))
+                if not waiters:
+                    del self.queues[kind][ip]
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts[kind] += 1
+            raise
+
+    async def shape(self, body: AsyncIterator, ip: str, file: int, kind: str) -> AsyncIterator:
+        """
+        Pulls each chunk of `body` under a fetch slot and paces what is sent. A stream that
+        waits longer than the timeout for a slot ends early, the player retries the rest.
+        """
+        rate = self.policy["rate" if kind == INTERACTIVE else "bulk_rate"]
+        bucket = TokenBucket(rate * 1024) if rate > 0 else None
+        self.streams[kind] += 1
+        try:
+            while True:
+                try:
+                    await self.acquire(ip, file, kind)
+                except asyncio.TimeoutError:
+                    return
+                try:
+                    chunk = await body.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    self.release(ip, file)
+                self.bytes[kind] += len(chunk)
+                if bucket:
+                    await bucket.consume(len(chunk))
+                yield chunk
+        finally:
+            self.streams[kind] -= 1
+            await body.aclose()
+
+    def metrics(self) -> Dict:
+        return {
+            "policy": self.policy,
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "streams": dict(self.streams),
+            "waiting": {kind: self.waiting(kind) for kind in self.queues},
+            "queued": dict(self.queued),
+            "granted": dict(self.granted),
+            "timeouts": dict(self.timeouts),
+            "bytes": dict(self.bytes),
+            "active_ips": len(self.active_ips),
+            "busiest_files": self.active_files.most_common(5),
+        }
+
+
+scheduler = FairScheduler()
@@ -0,0 +1,98 @@
+import os
+import fcntl
+import sqlite3
+import asyncio
+import hashlib
+import logging
+from info import *
+from typing import Callable, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+# lock files are held open for the life of the process
+session_locks: Dict[str, int] = {}
+
+
+def session_name(token: str) -> str:
+    """
+    Stable session file name for a bot token, so a rotated token never reuses a stale session.
+    """
+    return "client_" + hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+async def lock_session(name: str, timeout: float = SESSION_LOCK_TIMEOUT) -> bool:
+    """
+    Takes the exclusive lock on a session file. During a rolling deploy the previous process
+    still holds it, so we wait up to `timeout` seconds for it to exit.
+    Returns False when the lock couldn't be taken (the caller should use an in-memory session).
+    """
+    os.makedirs(SESSION_DIR, exist_ok=True)
+    fd = os.open(os.path.join(SESSION_DIR, f"{name}.lock"), os.O_CREAT | os.O_RDWR)
+    for _ in range(max(int(timeout * 4), 1)):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            session_locks[name] = fd
+            return True
+        except BlockingIOError:
+            await asyncio.sleep(0.25)
+    os.close(fd)
+    return False
+
+
+class MediaAuthStore:
+    def __init__(self, path: str = os.path.join(SESSION_DIR, "media_auth.sqlite")):
+        """Persists the auth keys of authorized media DC sessions, per client session name.
+        pyrogram keeps those only in memory, so without this every restart pays for
+        ExportAuthorization/ImportAuthorization again on the first request to each DC.
+        The database is opened on first use and only touched from one worker thread,
+        so sqlite never blocks the event loop.
+        """
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media_auth")
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS media_auth ("
+                "session TEXT, dc_id INTEGER, test_mode INTEGER, auth_key BLOB, "
+                "PRIMARY KEY (session, dc_id, test_mode))"
+            )
+        return self.conn
+
+    async def run(self, query: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, query, *args)
+
+    async def get(self, session: str, dc_id: int, test_mode: bool) -> Optional[bytes]:
+        def query():
+            return self.connect().execute(
+                "SELECT auth_key FROM media_auth WHERE session = ? AND dc_id = ? AND test_mode = ?",
+                (session, dc_id, int(test_mode)),
+            ).fetchone()
+
+        row = await self.run(query)
+        return row[0] if row else None
+
+    async def set(self, session: str, dc_id: int, test_mode: bool, auth_key: bytes) -> None:
+        def query():
+            self.connect().execute(
+                "INSERT OR REPLACE INTO media_auth VALUES (?, ?, ?, ?)",
+                (session, dc_id, int(test_mode), auth_key),
+            )
+
+        await self.run(query)
+
+    async def delete(self, session: str, dc_id: int, test_mode: bool) -> None:
+        def query():
+            self.connect().execute(
+                "DELETE FROM media_auth WHERE session = ? AND dc_id = ? AND test_mode = ?",
+                (session, dc_id, int(test_mode)),
+            )
+
+        await self.run(query)
+        logging.debug(f"Dropped stored media auth of {session} for DC {dc_id}")
+
+
+media_auth_store = MediaAuthStore()
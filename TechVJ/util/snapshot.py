@@ -0,0 +1,82 @@
+import os
+import gzip
+import json
+import asyncio
+import logging
+from info import *
+from typing import Dict
+from TechVJ.util.media_index import media_index
+from TechVJ.util.popularity import popularity, prefetcher
+
+# order of the media record fields in the snapshot, records are stored as plain lists
+RECORD_FIELDS = ("_id", "file_id", "media_id", "dc_id", "access_hash", "size", "mime", "name", "unique_id", "thumb")
+
+
+class Snapshot:
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        """Warm-restart snapshot of the file properties cache and the hot file list.
+        attributes:
+            path: gzip'ed JSON file written atomically at shutdown and every SNAPSHOT_INTERVAL seconds.
+        """
+        self.path = path
+
+    def dump(self) -> Dict:
+        records = list(media_index.records.values())[-SNAPSHOT_RECORDS:]
+        return {
+            "records": [[record.get(field) for field in RECORD_FIELDS] for record in records],
+            "hot": popularity.top(PREFETCH_TOP * 5),
+        }
+
+    def write(self, data: Dict) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def read(self) -> Dict:
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            return json.load(f)
+
+    async def save(self) -> None:
+        data = self.dump()
+        await asyncio.get_running_loop().run_in_executor(None, self.write, data)
+        logging.info(f"Saved snapshot of {len(data['records'])} media records and {len(data['hot'])} hot files")
+
+    async def restore(self) -> None:
+        """
+        Reloads the snapshot in the background, a few thousand records at a time so the
+        event loop (and the already open HTTP port) keep serving meanwhile.
+        """
+        if not os.path.exists(self.path):
+            return
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(None, self.read)
+        except Exception:
+            logging.error("Couldn't read the snapshot", exc_info=True)
+            return
+        for i, values in enumerate(data.get("records", [])):
+            record = dict(zip(RECORD_FIELDS, values))
+            if record["_id"] not in media_index.records:
+                media_index._remember(record)
+            if i % 2000 == 0:
+                await asyncio.sleep(0)
+        for id, hits in data.get("hot", []):
+            popularity.seed(id, hits)
+        logging.info(f"Restored snapshot of {len(data.get('records', []))} media records")
+        await prefetcher.prefetch_once()
+
+    async def run(self) -> None:
+        try:
+            await self.restore()
+        except Exception:
+            logging.error("Restoring the snapshot failed", exc_info=True)
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                await self.save()
+            except Exception:
+                logging.error("Saving the snapshot failed", exc_info=True)
+
+
+snapshot = Snapshot()
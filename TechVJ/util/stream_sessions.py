@@ -0,0 +1,150 @@
+import time
+import asyncio
+import logging
+import secrets
+from info import *
+from aiohttp import web
+from pyrogram.session import Session
+from collections import OrderedDict
+from functools import partial
+from typing import Set, Tuple
+from TechVJ.bot import work_loads
+from TechVJ.util.uniques import client_ip
+from TechVJ.util.chunk_store import chunk_store
+from TechVJ.util.scheduler import scheduler, classify
+from TechVJ.util.file_properties import MediaRecord
+
+# cookie naming the viewer's stream session, so parallel players behind one IP stay apart
+COOKIE = "vs"
+
+
+class StreamSession:
+    __slots__ = ("index", "ip", "id", "kind", "chunks", "claimed", "requests", "seen")
+
+    def __init__(self, index: int, ip: str, id: int, kind: str):
+        """One viewer watching one file, shared by their successive range requests.
+        Only chunks still being fetched are held here, finished ones are in the chunk store,
+        so a session costs no chunk memory of its own.
+        attributes:
+            index: the client chosen for the first request, later ranges stay on it.
+            ip, id, kind: who the read-ahead's scheduler slots are taken for.
+            chunks: offset -> task fetching that chunk, requested or read ahead.
+            claimed: offsets of those tasks a request is waiting for, the rest can be cancelled.
+            requests: range requests seen, 1 for a new viewer.
+        """
+        self.index = index
+        self.ip = ip
+        self.id = id
+        self.kind = kind
+        self.chunks: "OrderedDict[int, asyncio.Task]" = OrderedDict()
+        self.claimed: Set[int] = set()
+        self.requests = 0
+        self.seen = time.monotonic()
+
+    def fetch(self, streamer, media_session: Session, file_id: MediaRecord, offset: int, chunk_size: int) -> asyncio.Task:
+        task = asyncio.ensure_future(streamer.get_chunk(media_session, file_id, offset, chunk_size))
+        task.add_done_callback(partial(self.done, offset))
+        self.chunks[offset] = task
+        return task
+
+    def done(self, offset: int, task: asyncio.Task) -> None:
+        # read-ahead nobody ends up awaiting must not log "exception was never retrieved"
+        task.cancelled() or task.exception()
+        if self.chunks.get(offset) is task:
+            del self.chunks[offset]
+            self.claimed.discard(offset)
+
+    def cancel(self, offset: int) -> None:
+        task = self.chunks.pop(offset)
+        if offset in self.claimed:
+            self.claimed.discard(offset)
+        else:
+            task.cancel()
+
+    def close(self) -> None:
+        for offset in list(self.chunks):
+            self.cancel(offset)
+
+    async def get_chunk(self, streamer, media_session: Session, file_id: MediaRecord, offset: int, chunk_size: int) -> bytes:
+        """
+        Returns a chunk, joining the fetch already running for it if there is one, and keeps
+        STREAM_READAHEAD chunks after it in flight so a continuation of the same read finds
+        them in the chunk store.
+        """
+        self.seen = time.monotonic()
+        task = self.chunks.get(offset)
+        if task is None:
+            task = self.fetch(streamer, media_session, file_id, offset, chunk_size)
+        self.chunks.move_to_end(offset)
+        self.claimed.add(offset)
+        for ahead in range(1, STREAM_READAHEAD + 1):
+            next_offset = offset + ahead * chunk_size
+            if (next_offset < file_id.file_size and next_offset not in self.chunks
+                    and not chunk_store.has(file_id.media_id, next_offset, chunk_size)):
+                # read-ahead takes a scheduler slot of its own, or is skipped when there's none free
+                if not scheduler.try_acquire(self.ip, self.id, self.kind):
+                    break
+                task = self.fetch(streamer, media_session, file_id, next_offset, chunk_size)
+                task.add_done_callback(lambda _: scheduler.release(self.ip, self.id))
+        while len(self.chunks) > STREAM_SESSION_CHUNKS + STREAM_READAHEAD:
+            self.cancel(next(iter(self.chunks)))
+        try:
+            # shielded, an aborted request leaves the chunk to the viewer's next range
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            # the session was dropped while we waited, fetch the chunk ourselves
+            return await streamer.get_chunk(media_session, file_id, offset, chunk_size)
+
+
+class StreamSessions:
+    def __init__(self, max_size: int = STREAM_SESSION_MAX, ttl: int = STREAM_SESSION_TTL):
+        """Stream sessions keyed by (client IP, message id, session cookie), dropped after
+        `ttl` idle seconds. Browsers send a chain of Range requests per playback, aborting
+        most of them after a few KB, this is what they have in common.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sessions: "OrderedDict[Tuple[str, int, str], StreamSession]" = OrderedDict()
+
+    def get(self, request: web.Request, id: int) -> Tuple[StreamSession, str]:
+        """
+        Returns the viewer's session for a file and the cookie token to set, every response
+        sets it again so it expires `ttl` seconds after the viewer's last request, like the session.
+        """
+        token = request.cookies.get(COOKIE) or secrets.token_urlsafe(8)
+        ip = client_ip(request)
+        key = (ip, id, token)
+        session = self.sessions.get(key)
+        if session is None or time.monotonic() - session.seen > self.ttl:
+            if session is not None:
+                session.close()
+            session = self.sessions[key] = StreamSession(
+                min(work_loads, key=work_loads.get), ip, id, classify(request)
+            )
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)[1].close()
+        self.sessions.move_to_end(key)
+        session.requests += 1
+        return session, token
+
+    def expire(self) -> int:
+        now = time.monotonic()
+        expired = [key for key, session in self.sessions.items() if now - session.seen > self.ttl]
+        for key in expired:
+            self.sessions.pop(key).close()
+        return len(expired)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                expired = self.expire()
+                if expired:
+                    logging.debug(f"Expired {expired} stream sessions, {len(self.sessions)} left")
+            except Exception:
+                logging.error("Expiring stream sessions failed", exc_info=True)
+
+
+stream_sessions = StreamSessions()
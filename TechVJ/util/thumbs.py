@@ -0,0 +1,120 @@
+import os
+import hashlib
+import asyncio
+import logging
+from info import *
+from pyrogram import Client, raw
+from pyrogram.file_id import FileId
+from pyrogram.errors import FileReferenceExpired
+from collections import OrderedDict
+from typing import Optional, Tuple
+from plugins.database import db
+from TechVJ.util.custom_dl import get_streamer
+from TechVJ.util.media_index import media_index
+from TechVJ.util.file_properties import MediaRecord
+from TechVJ.server.exceptions import FIleNotFound
+
+# message ids remembered as already re-read for their thumb
+CHECKED_SIZE = 10000
+
+
+class ThumbCache:
+    def __init__(self, max_bytes: int = THUMB_CACHE_SIZE * 1024 * 1024, directory: str = THUMB_DIR):
+        """Poster images, taken from the thumbnails Telegram keeps with each video/document.
+        attributes:
+            thumbs: LRU of message id -> (jpeg bytes, ETag), backed by one file per thumb in `directory`.
+            checked: LRU of message ids whose message was re-read for a thumb this run, so records
+                without one aren't re-read on every request.
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.thumbs: "OrderedDict[int, Tuple[bytes, str]]" = OrderedDict()
+        self.size = 0
+        self.checked: "OrderedDict[int, None]" = OrderedDict()
+
+    def path(self, id: int) -> str:
+        return os.path.join(self.directory, f"{id}.jpg")
+
+    def remember(self, id: int, data: bytes) -> Tuple[bytes, str]:
+        # thumbs of a LOG_CHANNEL message never change, so a content hash is a strong validator
+        entry = (data, f'"{hashlib.md5(data).hexdigest()}"')
+        if id not in self.thumbs:
+            self.size += len(data)
+        self.thumbs[id] = entry
+        self.thumbs.move_to_end(id)
+        while self.size > self.max_bytes:
+            _, (dropped, _) = self.thumbs.popitem(last=False)
+            self.size -= len(dropped)
+        return entry
+
+    def read(self, id: int) -> Optional[bytes]:
+        try:
+            with open(self.path(id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, id: int, data: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f"{self.path(id)}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path(id))
+
+    async def get(self, client: Client, id: int) -> Optional[Tuple[bytes, str]]:
+        """
+        Returns (jpeg bytes, ETag) of a message's thumbnail, None if it has none.
+        """
+        if id in self.thumbs:
+            self.thumbs.move_to_end(id)
+            return self.thumbs[id]
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self.read, id)
+        if data is None:
+            data = await self.fetch(client, id)
+            if data is None:
+                return None
+            await loop.run_in_executor(None, self.write, id, data)
+        return self.remember(id, data)
+
+    async def fetch(self, client: Client, id: int) -> Optional[bytes]:
+        record = await media_index.get(id)
+        if record is None and not await db.has_message_file(id):
+            # not a file we know of, don't let made up ids cost a Telegram call
+            return None
+        if (record is None or not record.get("thumb")) and id not in self.checked:
+            # records indexed before thumbs were kept don't know theirs yet
+            self.checked[id] = None
+            while len(self.checked) > CHECKED_SIZE:
+                self.checked.popitem(last=False)
+            message = await client.get_messages(LOG_CHANNEL, id)
+            if message.empty:
+                raise FIleNotFound
+            record = await media_index.add(message)
+        if not record or not record.get("thumb"):
+            return None
+
+        streamer = get_streamer(client)
+        for attempt in range(2):
+            thumb = MediaRecord(
+                FileId.decode(record["thumb"]["file_id"]), id, record["thumb"]["size"],
+                "image/jpeg", "", record["unique_id"],
+            )
+            media_session = await streamer.generate_media_session(client, thumb)
+            try:
+                r = await media_session.send(
+                    raw.functions.upload.GetFile(location=thumb.location, offset=0, limit=1024 * 1024)
+                )
+            except FileReferenceExpired:
+                if attempt:
+                    raise
+                await media_index.refresh(client, id)
+                record = await media_index.get(id)
+                continue
+            if isinstance(r, raw.types.upload.File):
+                logging.debug(f"Fetched {len(r.bytes)} byte thumb of message {id}")
+                return r.bytes
+        return None
+
+
+thumbs = ThumbCache()
@@ -0,0 +1,41 @@
+import time
+import asyncio
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """Classic token bucket.
+        attributes:
+            rate: tokens added per second (0 or less means unlimited).
+            capacity: burst size, defaults to one second worth of tokens.
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, amount: float) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    async def consume(self, amount: float) -> None:
+        """
+        Waits until `amount` tokens are available and takes them.
+        Amounts larger than the capacity are allowed and simply leave the bucket in debt.
+        """
+        if self.rate <= 0:
+            return
+        self._refill()
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from info import *
+from aiohttp import web
+from datetime import datetime
+from typing import Dict, Tuple
+from plugins.database import db
+from TechVJ.util.hyperloglog import HyperLogLog
+
+
+def client_ip(request: web.Request) -> str:
+    """
+    The viewer's IP, the first X-Forwarded-For hop when behind a proxy.
+    """
+    forwarded = request.headers.get("X-Forwarded-For", "")
+    return forwarded.split(",")[0].strip() or request.remote or ""
+
+
+def fingerprint(request: web.Request) -> str:
+    """
+    Viewer identity used for unique counts: client IP plus user agent.
+    """
+    return f"{client_ip(request)}|{request.headers.get('User-Agent', '')}"
+
+
+class UniqueViewers:
+    def __init__(self):
+        """Per file and per uploader HyperLogLog sketches of unique viewers, one per day.
+        attributes:
+            sketches: (kind, key, day) -> sketch of the views since the last flush,
+                kind being "file" (LOG_CHANNEL message id) or "user" (uploader id).
+        Flushing merges them into the daily blobs stored in the database, so memory and
+        storage stay fixed per file and day however many viewers there are.
+        """
+        self.sketches: Dict[Tuple[str, int, str], HyperLogLog] = {}
+
+    def add(self, kind: str, key: int, viewer: str) -> None:
+        day = datetime.now().strftime("%Y-%m-%d")
+        sketch = self.sketches.get((kind, key, day))
+        if sketch is None:
+            sketch = self.sketches[(kind, key, day)] = HyperLogLog()
+        sketch.add(viewer)
+
+    async def count(self, kind: str, key: int, days: int = 30) -> int:
+        """
+        Unique viewers over the last `days` days, including views not flushed yet.
+        """
+        sketch = HyperLogLog.union(await db.get_sketches(kind, key, days))
+        for (k, id, _), pending in self.sketches.items():
+            if k == kind and id == key:
+                sketch.merge(pending)
+        return sketch.count()
+
+    async def flush(self) -> int:
+        sketches, self.sketches = self.sketches, {}
+        for (kind, key, day), sketch in sketches.items():
+            if not await db.merge_sketch(kind, key, day, sketch.to_bytes()):
+                # keep it for the next flush
+                self.sketches.setdefault((kind, key, day), HyperLogLog()).merge(sketch)
+        return len(sketches)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(UNIQUES_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logging.error("Flushing unique viewer sketches failed", exc_info=True)
+
+
+uniques = UniqueViewers()
@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of the bytes copied per byte served by the chunk trimming in
+ByteStreamer.yield_file, before (bytes slicing) and after (memoryview trimming).
+
+Replays browser-like range requests over 1 MiB chunks and uses tracemalloc to
+count the bytes allocated for every piece handed to the writer.
+
+    python benchmarks/zero_copy.py
+"""
+import os
+import sys
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TechVJ.util.buffers import trim
+
+CHUNK_SIZE = 1024 * 1024
+FILE_SIZE = 64 * CHUNK_SIZE
+
+
+def pieces(from_bytes, until_bytes, slicer):
+    """Mirror of yield_file's cutting logic, with the chunk fetch replaced by a constant chunk."""
+    chunk = CHUNK
+    offset = from_bytes - (from_bytes % CHUNK_SIZE)
+    first_part_cut = from_bytes - offset
+    last_part_cut = until_bytes % CHUNK_SIZE + 1
+    part_count = until_bytes // CHUNK_SIZE - offset // CHUNK_SIZE + 1
+    for current_part in range(1, part_count + 1):
+        if part_count == 1:
+            yield slicer(chunk, first_part_cut, last_part_cut)
+        elif current_part == 1:
+            yield slicer(chunk, first_part_cut, None)
+        elif current_part == part_count:
+            yield slicer(chunk, 0, last_part_cut)
+        else:
+            yield chunk
+
+
+def copy_slice(chunk, start, end):
+    return chunk[start:end]
+
+
+def run(slicer, ranges):
+    served = copied = 0
+    tracemalloc.start()
+    for from_bytes, until_bytes in ranges:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        for piece in pieces(from_bytes, until_bytes, slicer):
+            copied += tracemalloc.get_traced_memory()[1] - base
+            served += len(piece)
+            del piece
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return served, copied
+
+
+if __name__ == "__main__":
+    CHUNK = os.urandom(CHUNK_SIZE)
+    rng = random.Random(42)
+    ranges = []
+    for _ in range(200):
+        start = rng.randrange(FILE_SIZE)
+        # players mostly issue short or open ended ranges
+        end = min(FILE_SIZE - 1, start + rng.choice([4096, 65536, CHUNK_SIZE, 3 * CHUNK_SIZE]))
+        ranges.append((start, end))
+    for name, slicer in (("bytes slicing", copy_slice), ("memoryview trim", trim)):
+        served, copied = run(slicer, ranges)
+        print(f"{name:16} served {served:>11} B, copied {copied:>11} B, {copied / served:.3f} B copied per B served")
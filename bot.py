@@ -3,6 +3,7 @@
 
 import sys
 import glob
+import signal
 import asyncio
 import logging
 import logging.config
@@ -13,7 +14,8 @@ from pyrogram.errors import FloodWait
 
 # Import configurations
 from info import *
-from TechVJ.bot import TechVJBot
+from TechVJ.bot import TechVJBot, multi_clients, work_loads
+from TechVJ.util.drain import drain
 from TechVJ.server.exceptions import FIleNotFound, InvalidHash
 from TechVJ.server import web_server
 from TechVJ.database import Database
@@ -49,16 +51,12 @@ class Bot(Client):
         self.id = me.id
         self.mention = me.mention
         
+        # The streaming routes of plugins/route.py use this bot as client 0
+        multi_clients[0] = self
+        work_loads[0] = 0
+        
         # Start web server with ads integration
         app = web.Application(client_max_size=30000000)
-        runner = web.AppRunner(app)
-        await runner.setup()
-        
-        # Bind to configured port
-        bind_address = "0.0.0.0"
-        port = PORT
-        
-        await web.TCPSite(runner, bind_address, port).start()
         
         # Set up routes with ads support
         routes = web.RouteTableDef()
@@ -112,6 +110,11 @@ class Bot(Client):
                     'https://commondatastorage.googleapis.com/gtv-videos-bucket/sample/BigBuckBunny.mp4',
                     f'{STREAM_LINK}download/{file_id}'
                 )
+                if file_data.get('message_id'):
+                    html_content = html_content.replace(
+                        'https://i.ibb.co/Yz4y12n/photo-2025-06-16-10-05-31-7516486294654943252.jpg',
+                        f"{STREAM_LINK}thumb/{file_data['message_id']}"
+                    )
                 
                 # Update view count
                 await db.increment_views(file_id)
@@ -171,6 +174,11 @@ class Bot(Client):
                     '245 MB',
                     get_readable_file_size(file_data.get('file_size', 0))
                 )
+                if file_data.get('message_id'):
+                    html_content = html_content.replace(
+                        'https://i.ibb.co/Yz4y12n/photo-2025-06-16-10-05-31-7516486294654943252.jpg',
+                        f"{STREAM_LINK}thumb/{file_data['message_id']}"
+                    )
                 
                 return web.Response(
                     text=html_content,
@@ -184,6 +192,8 @@ class Bot(Client):
         @routes.get("/download/{file_id}", allow_head=True)
         async def download_handler(request):
             """Download/stream file handler"""
+            # refused while draining, outside the try so the 503 isn't turned into a 500
+            drain.check()
             try:
                 file_id = request.match_info['file_id']
                 
@@ -242,11 +252,11 @@ class Bot(Client):
                     await response.prepare(request)
                     
                     # Stream file
-                    async for chunk in self.stream_media(
+                    async for chunk in drain.track(self.stream_media(
                         file,
                         offset=offset,
                         limit=until_bytes - from_bytes + 1
-                    ):
+                    )):
                         await response.write(chunk)
                     
                     return response
@@ -268,7 +278,7 @@ class Bot(Client):
                     await response.prepare(request)
                     
                     # Stream full file
-                    async for chunk in self.stream_media(file):
+                    async for chunk in drain.track(self.stream_media(file)):
                         await response.write(chunk)
                     
                     return response
@@ -288,6 +298,43 @@ class Bot(Client):
         # Add routes to app
         app.add_routes(routes)
         
+        # Then plugins/route.py (/healthz, /readyz, /metrics, /dl, /thumb...), ours are
+        # matched first so / and /quality stay the ones above
+        from plugins.route import routes as plugin_routes
+        app.add_routes(plugin_routes)
+        
+        # Routes are frozen once the runner is set up, so it comes last
+        runner = web.AppRunner(app)
+        await runner.setup()
+        
+        # Bind to configured port
+        bind_address = "0.0.0.0"
+        port = PORT
+        
+        await web.TCPSite(runner, bind_address, port).start()
+        
+        # Background tasks (imported here, plugins are loaded by super().start())
+        from TechVJ.util.media_index import media_index
+        from TechVJ.util.popularity import prefetcher
+        from TechVJ.util.snapshot import snapshot
+        from TechVJ.util.beacons import click_buffer
+        from TechVJ.util.uniques import uniques
+        from TechVJ.util.broadcast import resume_broadcasts
+        from TechVJ.util.stream_sessions import stream_sessions
+        from TechVJ.util.scheduler import scheduler
+        from TechVJ.util.admission import admission
+        from TechVJ.util.cluster import cluster
+        await scheduler.load()
+        asyncio.create_task(media_index.run(self))
+        asyncio.create_task(click_buffer.run())
+        asyncio.create_task(uniques.run())
+        asyncio.create_task(resume_broadcasts(self))
+        asyncio.create_task(prefetcher.run())
+        asyncio.create_task(snapshot.run())
+        asyncio.create_task(stream_sessions.run())
+        asyncio.create_task(admission.run())
+        asyncio.create_task(cluster.run())
+        
         logging.info(f"✅ Bot Started Successfully!")
         logging.info(f"👤 Bot: {me.first_name}")
         logging.info(f"🆔 Username: @{me.username}")
@@ -362,6 +409,57 @@ else:
     apps = [Bot()]
     logging.info("Single client mode")
 
+async def shutdown():
+    """Drain running streams, flush buffered writes, then stop the clients"""
+    from TechVJ.util.snapshot import snapshot
+    from TechVJ.util.beacons import click_buffer
+    from TechVJ.util.uniques import uniques
+    
+    # A second SIGTERM/SIGINT while draining stops waiting for streams
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, drain.force)
+        except (NotImplementedError, RuntimeError):
+            pass
+    
+    # Leave the cluster first so other nodes stop sending this one new viewers
+    try:
+        from TechVJ.util.cluster import cluster
+        cluster.leave()
+    except Exception as e:
+        logging.error(f"Cluster leave error: {e}")
+    
+    # Not ready anymore, refuse new streams and let running ones finish
+    drain.start()
+    await drain.wait()
+    
+    # Save the warm-restart snapshot before the caches go away
+    try:
+        await snapshot.save()
+    except Exception as e:
+        logging.error(f"Snapshot error: {e}")
+    
+    # Apply buffered click beacons (they stay in the WAL if the database is down)
+    try:
+        await click_buffer.flush()
+    except Exception as e:
+        logging.error(f"Beacon flush error: {e}")
+    
+    # Persist unique viewer sketches
+    try:
+        await uniques.flush()
+    except Exception as e:
+        logging.error(f"Unique viewers flush error: {e}")
+    
+    # Stop all clients
+    for app in apps:
+        try:
+            await app.stop()
+        except Exception as e:
+            logging.error(f"Client stop error: {e}")
+
+
 # Main execution
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
@@ -371,7 +469,7 @@ if __name__ == "__main__":
         for app in apps:
             loop.run_until_complete(app.start())
         
-        # Keep running
+        # Keep running, idle() returns on SIGINT/SIGTERM/SIGABRT (what Docker and Heroku send)
         loop.run_until_complete(idle())
         
     except KeyboardInterrupt:
@@ -379,9 +477,6 @@ if __name__ == "__main__":
     except Exception as e:
         logging.error(f"Bot error: {e}")
     finally:
-        # Stop all clients
-        for app in apps:
-            loop.run_until_complete(app.stop())
-        
+        loop.run_until_complete(shutdown())
         loop.close()
         logging.info("Bot shutdown complete")
@@ -99,6 +99,132 @@ SLEEP_THRESHOLD = int(environ.get('SLEEP_THRESHOLD', '60'))
 # Workers (Pyrogram)
 WORKERS = int(environ.get('WORKERS', '200'))
 
+# ==================== STREAMING & CACHING ====================
+
+# Folder for persistent client sessions and media DC auth keys
+SESSION_DIR = environ.get('SESSION_DIR', 'sessions')
+
+# Seconds to wait for a previous process to release a session file before going in-memory
+SESSION_LOCK_TIMEOUT = float(environ.get('SESSION_LOCK_TIMEOUT', '10'))
+
+# Max ingested files (file_unique_id -> LOG_CHANNEL message) kept in memory
+INGEST_CACHE_SIZE = int(environ.get('INGEST_CACHE_SIZE', '50000'))
+
+# Max LOG_CHANNEL media records kept in memory by the media index
+MEDIA_INDEX_CACHE_SIZE = int(environ.get('MEDIA_INDEX_CACHE_SIZE', '100000'))
+
+# Seconds between incremental LOG_CHANNEL indexing passes
+MEDIA_INDEX_INTERVAL = int(environ.get('MEDIA_INDEX_INTERVAL', '300'))
+
+# Let Telegram redirect popular files to its CDN DCs (upload.GetCdnFile)
+CDN_SUPPORT = is_enabled(environ.get('CDN_SUPPORT', 'False'), False)
+
+# Memory for the local chunk store in MiB
+CHUNK_CACHE_SIZE = int(environ.get('CHUNK_CACHE_SIZE', '256'))
+
+# Popularity window in minutes and counters kept per minute
+POPULARITY_WINDOW = int(environ.get('POPULARITY_WINDOW', '60'))
+POPULARITY_SKETCH_SIZE = int(environ.get('POPULARITY_SKETCH_SIZE', '512'))
+
+# Prefetch of trending files: how many, how much of head/tail (MiB), how often (seconds)
+PREFETCH_TOP = int(environ.get('PREFETCH_TOP', '20'))
+PREFETCH_HEAD_MB = int(environ.get('PREFETCH_HEAD_MB', '4'))
+PREFETCH_TAIL_MB = int(environ.get('PREFETCH_TAIL_MB', '2'))
+PREFETCH_INTERVAL = int(environ.get('PREFETCH_INTERVAL', '60'))
+
+# Prefetch bandwidth budget per bot in KiB/s, and skip bots serving more streams than this
+PREFETCH_BANDWIDTH = int(environ.get('PREFETCH_BANDWIDTH', '2048'))
+PREFETCH_MAX_LOAD = int(environ.get('PREFETCH_MAX_LOAD', '2'))
+
+# Memory in MiB kept apart for prefetched chunks, so live streams don't evict them
+PREFETCH_CACHE_SIZE = int(environ.get('PREFETCH_CACHE_SIZE', '128'))
+
+# Warm-restart snapshot file, how often it's written (seconds) and how many media records it keeps
+SNAPSHOT_PATH = environ.get('SNAPSHOT_PATH', 'sessions/snapshot.json.gz')
+SNAPSHOT_INTERVAL = int(environ.get('SNAPSHOT_INTERVAL', '600'))
+SNAPSHOT_RECORDS = int(environ.get('SNAPSHOT_RECORDS', '50000'))
+
+# Uploader profiles cached for the watch page, and their max age in seconds
+PROFILE_CACHE_SIZE = int(environ.get('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_CACHE_TTL = int(environ.get('PROFILE_CACHE_TTL', '600'))
+
+# Seconds between bulk writes of /click-counter beacons, and where they spill while the database is down
+BEACON_FLUSH_INTERVAL = int(environ.get('BEACON_FLUSH_INTERVAL', '10'))
+BEACON_WAL_PATH = environ.get('BEACON_WAL_PATH', 'sessions/beacons.wal')
+
+# Seconds between writes of the unique viewer sketches
+UNIQUES_FLUSH_INTERVAL = int(environ.get('UNIQUES_FLUSH_INTERVAL', '300'))
+
+# Broadcast: messages per second per bot, sends in flight per bot, users fetched per cursor batch,
+# seconds between status updates
+BROADCAST_RATE = float(environ.get('BROADCAST_RATE', '20'))
+BROADCAST_CONCURRENCY = int(environ.get('BROADCAST_CONCURRENCY', '5'))
+BROADCAST_BATCH_SIZE = int(environ.get('BROADCAST_BATCH_SIZE', '500'))
+BROADCAST_STATUS_INTERVAL = int(environ.get('BROADCAST_STATUS_INTERVAL', '10'))
+
+# Seconds without a heartbeat after which another process takes a running broadcast over
+BROADCAST_LEASE = int(environ.get('BROADCAST_LEASE', '60'))
+
+# Uploaders whose searchable /files library is kept in memory
+LIBRARY_CACHE_USERS = int(environ.get('LIBRARY_CACHE_USERS', '1000'))
+
+# Memory for rewritten MP4 moov boxes (virtual faststart), in MiB
+FASTSTART_CACHE_SIZE = int(environ.get('FASTSTART_CACHE_SIZE', '128'))
+
+# Keyframe indexes kept in memory for /seek (all of them are persisted in the database)
+KEYFRAME_CACHE_SIZE = int(environ.get('KEYFRAME_CACHE_SIZE', '1000'))
+
+# Poster thumbnails: memory budget in MiB and the directory they're kept in on disk
+THUMB_CACHE_SIZE = int(environ.get('THUMB_CACHE_SIZE', '32'))
+THUMB_DIR = environ.get('THUMB_DIR', 'sessions/thumbs')
+
+# Viewer stream sessions: chunks kept per session, chunks read ahead, idle seconds before a
+# session is dropped and the most sessions kept at once
+STREAM_SESSION_CHUNKS = int(environ.get('STREAM_SESSION_CHUNKS', '4'))
+STREAM_READAHEAD = int(environ.get('STREAM_READAHEAD', '2'))
+STREAM_SESSION_TTL = int(environ.get('STREAM_SESSION_TTL', '60'))
+STREAM_SESSION_MAX = int(environ.get('STREAM_SESSION_MAX', '1000'))
+
+# Fair scheduling of chunk fetches: slots per client, caps per IP and per file, per connection
+# egress in KiB/s for playback and for downloads (0 = unlimited), and how many playback chunks
+# go before a waiting download gets its turn. All of them can be changed at runtime with /policy.
+# SCHED_TIMEOUT is how many seconds a stream waits for a slot before it's cut short
+SCHED_SLOTS = int(environ.get('SCHED_SLOTS', '16'))
+SCHED_PER_IP = int(environ.get('SCHED_PER_IP', '4'))
+SCHED_PER_FILE = int(environ.get('SCHED_PER_FILE', '8'))
+SCHED_RATE = int(environ.get('SCHED_RATE', '0'))
+SCHED_BULK_RATE = int(environ.get('SCHED_BULK_RATE', '2048'))
+SCHED_INTERACTIVE_WEIGHT = int(environ.get('SCHED_INTERACTIVE_WEIGHT', '4'))
+SCHED_TIMEOUT = int(environ.get('SCHED_TIMEOUT', '60'))
+
+# Admission control: GetFile calls in flight per client and loop lag (ms) past which new streams
+# queue, and how many seconds they may wait before getting a 503
+ADMISSION_MAX_INFLIGHT = int(environ.get('ADMISSION_MAX_INFLIGHT', '24'))
+ADMISSION_MAX_LAG = int(environ.get('ADMISSION_MAX_LAG', '200'))
+ADMISSION_WAIT = float(environ.get('ADMISSION_WAIT', '3'))
+
+# Seconds running streams get to finish on shutdown (Heroku sends SIGKILL 30s after SIGTERM)
+DRAIN_TIMEOUT = int(environ.get('DRAIN_TIMEOUT', '25'))
+
+# Cluster mode: this node's public URL, the other nodes (comma separated URLs) and/or a shared
+# registry file nodes add themselves to, virtual nodes per member on the hash ring and how
+# often (seconds) the registry is re-read and this node's heartbeat in it renewed, a node
+# missing three heartbeats is dropped. With a single member /dl is served locally
+NODE_URL = environ.get('NODE_URL', STREAM_LINK)
+CLUSTER_NODES = [node.strip() for node in environ.get('CLUSTER_NODES', '').split(',') if node.strip()]
+CLUSTER_REGISTRY = environ.get('CLUSTER_REGISTRY', '')
+CLUSTER_VNODES = int(environ.get('CLUSTER_VNODES', '160'))
+CLUSTER_REFRESH = int(environ.get('CLUSTER_REFRESH', '10'))
+
+# Parallel forward_messages calls used by /batch and album uploads, how many files one /batch
+# may collect and how many seconds it stays open before it's dropped
+BATCH_CONCURRENCY = int(environ.get('BATCH_CONCURRENCY', '3'))
+BATCH_MAX_FILES = int(environ.get('BATCH_MAX_FILES', '200'))
+BATCH_TIMEOUT = int(environ.get('BATCH_TIMEOUT', '1800'))
+
+# Seconds to wait for the rest of an album before ingesting it
+ALBUM_WAIT = float(environ.get('ALBUM_WAIT', '2'))
+
 # ==================== EARNINGS & PAYMENTS ====================
 
 # CPM Rate (Earnings per 1000 views)
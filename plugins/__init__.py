@@ -3,9 +3,10 @@
 # Ask Doubt on telegram @KingVJ01
 
 from aiohttp import web
-from .route import routes
 
 async def web_server():
+    # imported here, TechVJ.util modules import plugins.database and route imports them back
+    from .route import routes
     web_app = web.Application(client_max_size=30000000)
     web_app.add_routes(routes)
     return web_app
@@ -1,13 +1,35 @@
 # VJ Video Player - Database Helper
 # YouTube: @Tech_VJ | Telegram: @VJ_Bots | GitHub: @VJBots
 
+import time
 import pymongo
+import asyncio
 import logging
-from datetime import datetime
-from typing import Optional, Dict, List
+from bson import ObjectId
+from info import MONGODB_URI, SESSION
+from TechVJ.util.hyperloglog import HyperLogLog
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, Tuple
 
 logger = logging.getLogger(__name__)
 
+
+def encode_cursor(doc: Dict, field: str) -> str:
+    """Compact keyset cursor (sort value + _id), small enough for callback data"""
+    value = doc[field]
+    if isinstance(value, datetime):
+        value = round(value.timestamp() * 1000)
+    return f"{value}.{doc['_id']}"
+
+
+def decode_cursor(cursor: str, field: str) -> Tuple:
+    value, _id = cursor.split(".", 1)
+    value = int(value)
+    if field != "_id":
+        value = datetime.fromtimestamp(value / 1000)
+    return value, ObjectId(_id)
+
+
 class Database:
     """MongoDB Database Handler"""
     
@@ -16,12 +38,26 @@ class Database:
         try:
             self.client = pymongo.MongoClient(uri)
             self.db = self.client[database_name]
+            # health checks use their own client, failing fast instead of after the 30s default
+            self.ping_client = pymongo.MongoClient(
+                uri, serverSelectionTimeoutMS=2000, connectTimeoutMS=2000, socketTimeoutMS=2000
+            )
+            self.ping_lock = asyncio.Lock()
+            self.pinged_at = None
+            self.ping_ok = False
+            self.ping_ms = None
             
             # Collections
             self.users = self.db.users
             self.files = self.db.files
             self.earnings = self.db.earnings
             self.withdrawals = self.db.withdrawals
+            self.ingest = self.db.ingest
+            self.media_index = self.db.media_index
+            self.meta = self.db.meta
+            self.uniques = self.db.uniques
+            self.broadcasts = self.db.broadcasts
+            self.keyframes = self.db.keyframes
             
             # Create indexes for better performance
             self._create_indexes()
@@ -41,14 +77,64 @@ class Database:
             # File indexes
             self.files.create_index("file_id", unique=True)
             self.files.create_index("user_id")
+            self.files.create_index("message_id")
+            self.files.create_index([("user_id", 1), ("uploaded_date", -1), ("_id", -1)])
             
             # Earnings indexes
             self.earnings.create_index([("user_id", 1), ("date", -1)])
+            self.earnings.create_index([("user_id", 1), ("date", -1), ("_id", -1)])
+            
+            # Withdrawal indexes
+            self.withdrawals.create_index([("status", 1), ("requested_date", -1), ("_id", -1)])
+            
+            # Unique viewer sketch indexes
+            self.uniques.create_index([("kind", 1), ("key", 1), ("day", -1)])
+            
+            # Ingest indexes
+            self.ingest.create_index("file_unique_id", unique=True)
             
             logger.info("✅ Database indexes created")
         except Exception as e:
             logger.error(f"Index creation error: {e}")
     
+    def _keyset_page(self, collection, query: Dict, field: str, cursor: Optional[str],
+                     limit: int, projection: Optional[Dict]) -> Tuple[List[Dict], Optional[str]]:
+        """
+        One page of a (field desc, _id desc) ordered query, resumed after `cursor`.
+        Costs the same on page 1000 as on page 1, unlike skip/limit.
+        """
+        query = dict(query)
+        if cursor:
+            value, _id = decode_cursor(cursor, field)
+            query["$or"] = [
+                {field: {"$lt": value}},
+                {field: value, "_id": {"$lt": _id}}
+            ]
+        if projection:
+            projection = dict(projection, **{field: 1})
+        docs = list(
+            collection.find(query, projection)
+            .sort([(field, -1), ("_id", -1)])
+            .limit(limit + 1)
+        )
+        next_cursor = encode_cursor(docs[limit - 1], field) if len(docs) > limit else None
+        return docs[:limit], next_cursor
+    
+    async def ping(self, max_age: float = 5) -> bool:
+        """Check the database answers, reusing the last answer for `max_age` seconds"""
+        async with self.ping_lock:
+            if self.pinged_at is None or time.monotonic() - self.pinged_at > max_age:
+                started = time.monotonic()
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self.ping_client.admin.command, "ping")
+                    self.ping_ok = True
+                except Exception as e:
+                    logger.error(f"Database ping error: {e}")
+                    self.ping_ok = False
+                self.pinged_at = time.monotonic()
+                self.ping_ms = round((self.pinged_at - started) * 1000, 1)
+            return self.ping_ok
+    
     # ==================== USER METHODS ====================
     
     async def add_user(self, user_id: int, name: str, username: str = None) -> bool:
@@ -99,6 +185,32 @@ class Database:
             logger.error(f"Update user error: {e}")
             return False
     
+    async def set_name(self, user_id: int, name: str) -> bool:
+        """Set business name shown on the watch page"""
+        return await self.update_user(user_id, {"business_name": name})
+    
+    async def set_link(self, user_id: int, link: str) -> bool:
+        """Set channel link shown on the watch page"""
+        return await self.update_user(user_id, {"channel_link": link})
+    
+    async def get_profile(self, user_id: int) -> Dict:
+        """Get everything the watch page needs about an uploader in one query"""
+        try:
+            user = self.users.find_one(
+                {"user_id": user_id},
+                {"_id": 0, "name": 1, "business_name": 1, "channel_link": 1, "banned": 1, "withdraw": 1}
+            ) or {}
+            return {
+                "name": user.get("business_name") or user.get("name"),
+                "link": user.get("channel_link"),
+                "banned": bool(user.get("banned", False)),
+                "withdraw": bool(user.get("withdraw", False)),
+                "exists": bool(user)
+            }
+        except Exception as e:
+            logger.error(f"Get profile error: {e}")
+            return {"name": None, "link": None, "banned": False, "withdraw": False, "exists": False}
+    
     async def get_all_users(self) -> List[Dict]:
         """Get all users"""
         try:
@@ -107,6 +219,95 @@ class Database:
             logger.error(f"Get all users error: {e}")
             return []
     
+    async def add_visits(self, counts: Dict[int, int]) -> Dict[int, int]:
+        """Atomically add link clicks for many users in one bulk write, unknown users are skipped.
+        Returns the counts that were not applied, so only those are retried"""
+        items = list(counts.items())
+        try:
+            if items:
+                self.users.bulk_write(
+                    [
+                        pymongo.UpdateOne({"user_id": user_id}, {"$inc": {"link_clicks": count}})
+                        for user_id, count in items
+                    ],
+                    ordered=False
+                )
+            return {}
+        except pymongo.errors.BulkWriteError as e:
+            # unordered: every op not listed in writeErrors has been applied
+            failed = {items[error["index"]][0]: items[error["index"]][1] for error in e.details["writeErrors"]}
+            logger.error(f"Add visits error: {len(failed)} of {len(items)} updates failed")
+            return failed
+        except Exception as e:
+            logger.error(f"Add visits error: {e}")
+            return dict(counts)
+    
+    async def get_link_clicks(self, user_id: int) -> int:
+        """Get the link clicks counted for a user"""
+        try:
+            user = self.users.find_one({"user_id": user_id}, {"_id": 0, "link_clicks": 1}) or {}
+            return user.get("link_clicks", 0)
+        except Exception as e:
+            logger.error(f"Get link clicks error: {e}")
+            return 0
+    
+    async def hold_link_clicks(self, user_id: int, count: int) -> bool:
+        """Remember the link clicks a pending withdrawal pays out"""
+        try:
+            self.users.update_one({"user_id": user_id}, {"$set": {"withdraw_clicks": count}})
+            return True
+        except Exception as e:
+            logger.error(f"Hold link clicks error: {e}")
+            return False
+    
+    async def get_held_clicks(self, user_id: int) -> int:
+        """Get the link clicks held by a pending withdrawal"""
+        try:
+            user = self.users.find_one({"user_id": user_id}, {"_id": 0, "withdraw_clicks": 1}) or {}
+            return user.get("withdraw_clicks", 0)
+        except Exception as e:
+            logger.error(f"Get held clicks error: {e}")
+            return 0
+    
+    async def reset_link_clicks(self, user_id: int, count: int) -> bool:
+        """Take paid out link clicks off a user, clicks counted since the request are kept"""
+        try:
+            self.users.update_one(
+                {"user_id": user_id},
+                {"$inc": {"link_clicks": -count}, "$unset": {"withdraw_clicks": ""}}
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Reset link clicks error: {e}")
+            return False
+    
+    async def get_users_page(self, cursor: str = None, limit: int = 50,
+                             projection: Dict = None) -> Tuple[List[Dict], Optional[str]]:
+        """Get a page of users, newest first"""
+        try:
+            query = {}
+            if cursor:
+                query["_id"] = {"$lt": ObjectId(cursor)}
+            docs = list(
+                self.users.find(query, projection or {"user_id": 1, "name": 1, "balance": 1})
+                .sort("_id", -1)
+                .limit(limit + 1)
+            )
+            next_cursor = str(docs[limit - 1]["_id"]) if len(docs) > limit else None
+            return docs[:limit], next_cursor
+        except Exception as e:
+            logger.error(f"Get users page error: {e}")
+            return [], None
+    
+    async def iter_users(self, after_id=None, batch_size: int = 500, projection: Dict = None):
+        """Stream users in _id order through a batched cursor, starting after after_id"""
+        query = {"_id": {"$gt": after_id}} if after_id is not None else {}
+        cursor = self.users.find(
+            query, projection or {"_id": 1, "user_id": 1}
+        ).sort("_id", 1).batch_size(batch_size)
+        for user in cursor:
+            yield user
+    
     async def total_users_count(self) -> int:
         """Get total users count"""
         try:
@@ -118,7 +319,7 @@ class Database:
     # ==================== FILE METHODS ====================
     
     async def add_file(self, file_data: Dict) -> bool:
-        """Add file to database"""
+        """Add file to database, returns False if it was already there"""
         try:
             file_doc = {
                 "file_id": file_data.get("file_id"),
@@ -133,7 +334,14 @@ class Database:
                 "earnings": 0.0
             }
             
-            result = self.files.insert_one(file_doc)
+            # re-uploads of a file are expected, only the first one inserts
+            result = self.files.update_one(
+                {"file_id": file_doc["file_id"]},
+                {"$setOnInsert": file_doc},
+                upsert=True
+            )
+            if result.upserted_id is None:
+                return False
             
             # Update user's total files
             self.users.update_one(
@@ -141,7 +349,7 @@ class Database:
                 {"$inc": {"total_files": 1}}
             )
             
-            return result.inserted_id is not None
+            return True
             
         except Exception as e:
             logger.error(f"Add file error: {e}")
@@ -155,17 +363,39 @@ class Database:
             logger.error(f"Get file error: {e}")
             return None
     
+    async def has_message_file(self, message_id: int) -> bool:
+        """Check if a LOG_CHANNEL message holds a file some user uploaded"""
+        try:
+            return self.files.find_one({"message_id": message_id}, {"_id": 1}) is not None
+        except Exception as e:
+            logger.error(f"Has message file error: {e}")
+            return False
+    
     async def get_user_files(self, user_id: int, limit: int = 10) -> List[Dict]:
         """Get user's files"""
+        files, _ = await self.get_user_files_page(user_id, limit=limit)
+        return files
+    
+    async def get_user_files_page(self, user_id: int, cursor: str = None, limit: int = 10,
+                                  projection: Dict = None) -> Tuple[List[Dict], Optional[str]]:
+        """Get a page of user's files, newest first"""
         try:
-            return list(
-                self.files.find({"user_id": user_id})
-                .sort("uploaded_date", -1)
-                .limit(limit)
+            return self._keyset_page(
+                self.files, {"user_id": user_id}, "uploaded_date", cursor, limit,
+                projection or {"message_id": 1, "file_name": 1, "file_size": 1, "views": 1}
             )
         except Exception as e:
-            logger.error(f"Get user files error: {e}")
-            return []
+            logger.error(f"Get user files page error: {e}")
+            return [], None
+    
+    async def iter_user_files(self, user_id: int, batch_size: int = 1000):
+        """Stream all of a user's files with just the fields the library index needs"""
+        cursor = self.files.find(
+            {"user_id": user_id},
+            {"_id": 0, "message_id": 1, "file_name": 1, "file_size": 1, "uploaded_date": 1}
+        ).batch_size(batch_size)
+        for file in cursor:
+            yield file
     
     async def delete_file(self, file_id: str) -> bool:
         """Delete file from database"""
@@ -227,6 +457,117 @@ class Database:
             logger.error(f"Increment views error: {e}")
             return False
     
+    # ==================== INGEST METHODS ====================
+    
+    async def get_ingested(self, file_unique_id: str) -> Optional[int]:
+        """Get LOG_CHANNEL message id already holding this media"""
+        try:
+            doc = self.ingest.find_one(
+                {"file_unique_id": file_unique_id},
+                {"_id": 0, "message_id": 1}
+            )
+            return doc["message_id"] if doc else None
+        except Exception as e:
+            logger.error(f"Get ingested error: {e}")
+            return None
+    
+    async def add_ingested(self, file_unique_id: str, message_id: int) -> bool:
+        """Remember which LOG_CHANNEL message holds this media"""
+        try:
+            self.ingest.update_one(
+                {"file_unique_id": file_unique_id},
+                {"$setOnInsert": {
+                    "file_unique_id": file_unique_id,
+                    "message_id": message_id,
+                    "date": datetime.now()
+                }},
+                upsert=True
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Add ingested error: {e}")
+            return False
+    
+    async def get_last_ingested_id(self) -> int:
+        """Get the highest LOG_CHANNEL message id created by ingest"""
+        try:
+            doc = self.ingest.find_one({}, {"_id": 0, "message_id": 1}, sort=[("message_id", -1)])
+            return doc["message_id"] if doc else 0
+        except Exception as e:
+            logger.error(f"Get last ingested error: {e}")
+            return 0
+    
+    # ==================== MEDIA INDEX METHODS ====================
+    
+    async def get_media_record(self, message_id: int) -> Optional[Dict]:
+        """Get indexed media record of a LOG_CHANNEL message"""
+        try:
+            return self.media_index.find_one({"_id": message_id})
+        except Exception as e:
+            logger.error(f"Get media record error: {e}")
+            return None
+    
+    async def save_media_records(self, records: List[Dict]) -> bool:
+        """Upsert indexed media records"""
+        try:
+            if records:
+                self.media_index.bulk_write(
+                    [pymongo.ReplaceOne({"_id": r["_id"]}, r, upsert=True) for r in records],
+                    ordered=False
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Save media records error: {e}")
+            return False
+    
+    async def delete_media_record(self, message_id: int) -> bool:
+        """Delete indexed media record"""
+        try:
+            result = self.media_index.delete_one({"_id": message_id})
+            return result.deleted_count > 0
+        except Exception as e:
+            logger.error(f"Delete media record error: {e}")
+            return False
+    
+    async def get_keyframes(self, media_id: int) -> Optional[Dict]:
+        """Get the keyframe index (times and byte offsets) of a media"""
+        try:
+            return self.keyframes.find_one({"_id": media_id})
+        except Exception as e:
+            logger.error(f"Get keyframes error: {e}")
+            return None
+    
+    async def save_keyframes(self, media_id: int, times: List[float], offsets: List[int]) -> bool:
+        """Save the keyframe index of a media"""
+        try:
+            self.keyframes.replace_one(
+                {"_id": media_id},
+                {"_id": media_id, "times": times, "offsets": offsets, "created": datetime.now()},
+                upsert=True
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Save keyframes error: {e}")
+            return False
+    
+    async def get_meta(self, key: str, default=None):
+        """Get a small piece of bot state"""
+        try:
+            doc = self.meta.find_one({"_id": key})
+            return doc["value"] if doc else default
+        except Exception as e:
+            logger.error(f"Get meta error: {e}")
+            return default
+    
+    async def set_meta(self, key: str, value) -> bool:
+        """Set a small piece of bot state"""
+        try:
+            self.meta.update_one({"_id": key}, {"$set": {"value": value}}, upsert=True)
+            return True
+        except Exception as e:
+            logger.error(f"Set meta error: {e}")
+            return False
+    
     # ==================== EARNINGS METHODS ====================
     
     async def get_user_earnings(self, user_id: int, days: int = 30) -> List[Dict]:
@@ -245,6 +586,19 @@ class Database:
             logger.error(f"Get earnings error: {e}")
             return []
     
+    async def get_user_earnings_page(self, user_id: int, days: int = 30, cursor: str = None,
+                                     limit: int = 20) -> Tuple[List[Dict], Optional[str]]:
+        """Get a page of user's earnings history, newest first"""
+        try:
+            start_date = datetime.now() - timedelta(days=days)
+            return self._keyset_page(
+                self.earnings, {"user_id": user_id, "date": {"$gte": start_date}}, "date", cursor, limit,
+                {"amount": 1, "file_id": 1, "type": 1}
+            )
+        except Exception as e:
+            logger.error(f"Get earnings page error: {e}")
+            return [], None
+    
     async def get_user_stats(self, user_id: int) -> Dict:
         """Get user statistics"""
         try:
@@ -280,9 +634,13 @@ class Database:
             today_views = today_data[0]["count"] if today_data else 0
             today_amount = today_data[0]["total"] if today_data else 0.0
             
+            # Unique viewers of the last 30 days
+            unique_viewers = HyperLogLog.union(await self.get_sketches("user", user_id)).count()
+            
             return {
                 "total_files": total_files,
                 "total_views": total_views,
+                "unique_viewers": unique_viewers,
                 "total_earnings": round(total_earnings, 2),
                 "balance": round(balance, 2),
                 "today_views": today_views,
@@ -293,6 +651,102 @@ class Database:
             logger.error(f"Get user stats error: {e}")
             return {}
     
+    # ==================== UNIQUE VIEWER METHODS ====================
+    
+    async def merge_sketch(self, kind: str, key: int, day: str, sketch: bytes, attempts: int = 5) -> bool:
+        """Merge a HyperLogLog sketch into the stored one of that file/uploader and day.
+        Compare and swap on a version field, so concurrent flushes never overwrite each other"""
+        _id = f"{kind}:{key}:{day}"
+        try:
+            for _ in range(attempts):
+                doc = self.uniques.find_one({"_id": _id}, {"sketch": 1, "version": 1})
+                if doc is None:
+                    try:
+                        self.uniques.insert_one(
+                            {"_id": _id, "kind": kind, "key": key, "day": day, "sketch": sketch, "version": 1}
+                        )
+                        return True
+                    except pymongo.errors.DuplicateKeyError:
+                        continue
+                merged = HyperLogLog.from_bytes(doc["sketch"]).merge(HyperLogLog.from_bytes(sketch)).to_bytes()
+                # a missing version (sketches stored before versioning) matches None
+                result = self.uniques.update_one(
+                    {"_id": _id, "version": doc.get("version")},
+                    {"$set": {"sketch": merged}, "$inc": {"version": 1}}
+                )
+                if result.matched_count:
+                    return True
+            logger.warning(f"Merge sketch of {_id} lost {attempts} races, retrying on the next flush")
+            return False
+        except Exception as e:
+            logger.error(f"Merge sketch error: {e}")
+            return False
+    
+    async def get_sketches(self, kind: str, key: int, days: int = 30) -> List[bytes]:
+        """Get the daily sketches of a file/uploader for the last days"""
+        try:
+            since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+            return [
+                doc["sketch"] for doc in self.uniques.find(
+                    {"kind": kind, "key": key, "day": {"$gte": since}},
+                    {"_id": 0, "sketch": 1}
+                )
+            ]
+        except Exception as e:
+            logger.error(f"Get sketches error: {e}")
+            return []
+    
+    # ==================== BROADCAST METHODS ====================
+    
+    async def create_broadcast(self, source: int, status_chat: int, status_message: int, owner: str) -> Dict:
+        """Create broadcast of a LOG_CHANNEL message, owned by the calling process"""
+        broadcast = {
+            "source": source,
+            "status_chat": status_chat,
+            "status_message": status_message,
+            "last_id": None,
+            "sent": 0,
+            "failed": 0,
+            "status": "running",
+            "owner": owner,
+            "heartbeat": datetime.now(),
+            "started_date": datetime.now()
+        }
+        broadcast["_id"] = self.broadcasts.insert_one(broadcast).inserted_id
+        return broadcast
+    
+    async def update_broadcast(self, broadcast_id, owner: str, data: Dict) -> bool:
+        """Checkpoint broadcast progress and renew its heartbeat.
+        Returns False once another process took the broadcast over"""
+        try:
+            result = self.broadcasts.update_one(
+                {"_id": broadcast_id, "owner": owner},
+                {"$set": dict(data, heartbeat=datetime.now())}
+            )
+            return result.matched_count > 0
+        except Exception as e:
+            # keep going, the next checkpoint retries
+            logger.error(f"Update broadcast error: {e}")
+            return True
+    
+    async def claim_broadcast(self, owner: str, lease: int) -> Optional[Dict]:
+        """Atomically take over one running broadcast whose owner stopped sending heartbeats"""
+        try:
+            return self.broadcasts.find_one_and_update(
+                {
+                    "status": "running",
+                    "$or": [
+                        {"heartbeat": {"$lt": datetime.now() - timedelta(seconds=lease)}},
+                        {"heartbeat": {"$exists": False}}
+                    ]
+                },
+                {"$set": {"owner": owner, "heartbeat": datetime.now()}},
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+        except Exception as e:
+            logger.error(f"Claim broadcast error: {e}")
+            return None
+    
     # ==================== WITHDRAWAL METHODS ====================
     
     async def create_withdrawal(self, user_id: int, amount: float, method: str, details: str) -> bool:
@@ -340,6 +794,18 @@ class Database:
             logger.error(f"Get withdrawals error: {e}")
             return []
     
+    async def get_pending_withdrawals_page(self, cursor: str = None,
+                                           limit: int = 10) -> Tuple[List[Dict], Optional[str]]:
+        """Get a page of pending withdrawals, newest first"""
+        try:
+            return self._keyset_page(
+                self.withdrawals, {"status": "pending"}, "requested_date", cursor, limit,
+                {"user_id": 1, "amount": 1, "method": 1, "details": 1}
+            )
+        except Exception as e:
+            logger.error(f"Get withdrawals page error: {e}")
+            return [], None
+    
     async def update_withdrawal_status(self, withdrawal_id, status: str) -> bool:
         """Update withdrawal status"""
         try:
@@ -356,3 +822,6 @@ class Database:
         except Exception as e:
             logger.error(f"Update withdrawal error: {e}")
             return False
+
+
+db = Database(MONGODB_URI, SESSION)
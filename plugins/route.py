@@ -8,13 +8,27 @@ from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
 from plugins.start import decode, encode 
 from datetime import datetime
-from plugins.database import record_visit, get_count
+from TechVJ.util.beacons import click_buffer, MAX_USER_ID
+from TechVJ.util.uniques import uniques, fingerprint, client_ip
 from TechVJ.bot import multi_clients, work_loads, TechVJBot
 from TechVJ.server.exceptions import FIleNotFound, InvalidHash
 from TechVJ import StartTime, __version__
-from TechVJ.util.custom_dl import ByteStreamer
+from TechVJ.util.custom_dl import ByteStreamer, class_cache, get_streamer
+from TechVJ.util.faststart import faststart
+from TechVJ.util.keyframes import keyframe_index, seek
+from TechVJ.util.thumbs import thumbs
+from TechVJ.util.stream_sessions import stream_sessions, COOKIE
+from TechVJ.util.scheduler import scheduler, classify
+from TechVJ.util.chunk_store import chunk_store
+from TechVJ.util.admission import admission, PAGE, STREAM
+from TechVJ.util.drain import drain
+from TechVJ.util.health import health_report, is_ready
+from TechVJ.util.cluster import cluster
+from TechVJ.util.popularity import popularity
+from TechVJ.util.buffers import coalesce
 from TechVJ.util.time_format import get_readable_time
 from TechVJ.util.render_template import render_page
+from TechVJ.util.profile_cache import profiles
 from TechVJ.util.file_properties import get_file_ids
 
 routes = web.RouteTableDef()
@@ -99,6 +113,7 @@ async def root_route_handler(request):
 
 @routes.get(r"/{path}/{user_path}/{second}/{third}", allow_head=True)
 async def stream_handler(request: web.Request):
+    await admission.check(PAGE)
     try:
         path = request.match_info["path"]
         user_path = request.match_info["user_path"]
@@ -108,41 +123,70 @@ async def stream_handler(request: web.Request):
         user_id = int(await decode(user_path))
         secid = int(await decode(sec))
         thid = int(await decode(th))
-        return web.Response(text=await render_page(id, user_id, secid, thid), content_type='text/html')
+        page = await render_page(id, user_id, secid, thid)
+        # counted once the files resolved (render_page raises otherwise) and for known uploaders
+        # only, every id counted gets a sketch of its own
+        viewer = fingerprint(request)
+        if (await profiles.get(user_id))["exists"]:
+            uniques.add("user", user_id, viewer)
+        for file in (id, secid, thid):
+            if file != 0:
+                uniques.add("file", file, viewer)
+        return web.Response(text=page, content_type='text/html')
     except Exception as e:
         return web.Response(text=html_content, content_type='text/html')
     return 
 
 @routes.post('/click-counter')
 async def handle_click(request):
+    # beacons are buffered and applied in bulk by click_buffer, never wait on the database here
+    response = web.Response(status=204)
     try:
         data = await request.json()  # Get the JSON body
         user_id = int(data.get('user_id'))  # Extract user_id from the request
+        if not 0 < user_id <= MAX_USER_ID:
+            return response
         today = datetime.now().strftime('%Y-%m-%d')
 
-        user_agent = request.headers.get('User-Agent')
+        user_agent = request.headers.get('User-Agent', '')
         is_chrome = "Chrome" in user_agent or "Google Inc" in user_agent
 
-        if is_chrome:
-            visited_cookie = request.cookies.get('visited')
-        else:
-            return
-
-        if visited_cookie == today:
-            return
-        else:
-            response = web.Response(text="Hello, World!")
+        if is_chrome and request.cookies.get('visited') != today:
             response.set_cookie('visited', today, max_age=24*60*60)
-            u = get_count(user_id)
-            if u:
-                c = int(u + 1)
-                record_visit(user_id, c)
-            else:
-                c = int(1)
-                record_visit(user_id, c)
-            return response
-    except:
+            click_buffer.add(user_id)
+    except (ValueError, TypeError, AttributeError):
         pass
+    return response
+
+@routes.get('/healthz', allow_head=True)
+async def healthz(request: web.Request):
+    # liveness: the loop answers and at least one client is connected, a database outage
+    # must not get the node restarted so it's left to /readyz
+    report = await health_report(ping=False)
+    status = 200 if report["connected_clients"] else 503
+    return web.json_response(report, status=status)
+
+@routes.get('/readyz', allow_head=True)
+async def readyz(request: web.Request):
+    report = await health_report()
+    return web.json_response(
+        report,
+        status=200 if is_ready(report) else 503,
+        headers={"X-Weight": str(report["weight"])},
+    )
+
+@routes.get('/metrics', allow_head=True)
+async def metrics_handler(request: web.Request):
+    return web.json_response({
+        "scheduler": scheduler.metrics(),
+        "admission": admission.metrics(),
+        "work_loads": work_loads,
+        "stream_sessions": len(stream_sessions.sessions),
+        "chunk_store": {"bytes": chunk_store.size, "pinned_bytes": chunk_store.pinned_size,
+                        "hits": chunk_store.hits, "misses": chunk_store.misses},
+        "ttfb": {label: stats[1] / stats[0] if stats[0] else None for label, stats in faststart.ttfb.items()},
+        "cluster": {"node": cluster.node_url, "nodes": cluster.ring.nodes},
+    })
 
 @routes.get('/{short_link}', allow_head=True)
 async def get_original(request: web.Request):
@@ -167,6 +211,46 @@ async def visits(request: web.Request):
     link = f"{STREAM_URL}{data}/{user_id}/{sec_id}/{th_id}"
     raise web.HTTPFound(link)  # Redirect to the constructed link
 
+@routes.get(r"/seek/{id:\d+}", allow_head=True)
+async def seek_handler(request: web.Request):
+    try:
+        seconds = float(request.query["t"])
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest(text="t must be a number of seconds")
+    index = min(work_loads, key=work_loads.get)
+    streamer = get_streamer(multi_clients[index])
+    try:
+        file_id = await streamer.get_file_properties(int(request.match_info["id"]))
+    except FIleNotFound as e:
+        raise web.HTTPNotFound(text=e.message)
+    found = seek(await keyframe_index.get(streamer, file_id, index), max(seconds, 0))
+    if found is None:
+        raise web.HTTPNotFound(text="No keyframe index for this file")
+    keyframe_time, offset = found
+    # players on ?faststart=1 urls need offsets into the rewritten layout
+    if request.query.get("faststart"):
+        layout = await faststart.get(streamer, file_id, index)
+        if layout:
+            offset = layout.output_offset(offset)
+    return web.json_response({"t": seconds, "time": keyframe_time, "offset": offset, "range": f"bytes={offset}-"})
+
+@routes.get(r"/thumb/{id:\d+}", allow_head=True)
+async def thumb_handler(request: web.Request):
+    index = min(work_loads, key=work_loads.get)
+    try:
+        thumb = await thumbs.get(multi_clients[index], int(request.match_info["id"]))
+    except FIleNotFound as e:
+        raise web.HTTPNotFound(text=e.message)
+    if thumb is None:
+        raise web.HTTPNotFound(text="This file has no thumbnail")
+    data, etag = thumb
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=604800"}
+    # If-None-Match is a list of (possibly weak) ETags, or *
+    tags = [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]
+    if "*" in tags or etag in tags or f"W/{etag}" in tags:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=data, content_type="image/jpeg", headers=headers)
+
 @routes.get(r"/dl/{path:\S+}", allow_head=True)
 async def stream_handler(request: web.Request):
     try:
@@ -178,23 +262,30 @@ async def stream_handler(request: web.Request):
         else:
             id = int(re.search(r"(\d+)(?:\/\S+)?", path).group(1))
             secure_hash = request.rel_url.query.get("hash")
+        cluster.redirect(request, id)
         return await media_streamer(request, id, secure_hash)
     except InvalidHash as e:
         raise web.HTTPForbidden(text=e.message)
     except FIleNotFound as e:
         raise web.HTTPNotFound(text=e.message)
+    except (web.HTTPServiceUnavailable, web.HTTPTemporaryRedirect):
+        raise
     except (AttributeError, BadStatusLine, ConnectionResetError):
         pass
     except Exception as e:
         logging.critical(e.with_traceback(None))
         raise web.HTTPInternalServerError(text=str(e))
 
-class_cache = {}
-
 async def media_streamer(request: web.Request, id: int, secure_hash: str):
+    drain.check()
     range_header = request.headers.get("Range", 0)
-    
-    index = min(work_loads, key=work_loads.get)
+
+    # follow-up ranges of the same viewer reuse the client and chunks of their session
+    session, token = stream_sessions.get(request, id)
+    if session.requests == 1:
+        # a new viewer, shed it rather than slowing down the ones already playing
+        await admission.check(STREAM)
+    index = session.index
     faster_client = multi_clients[index]
     
     if MULTI_CLIENT:
@@ -210,8 +301,15 @@ async def media_streamer(request: web.Request, id: int, secure_hash: str):
     logging.debug("before calling get_file_properties")
     file_id = await tg_connect.get_file_properties(id)
     logging.debug("after calling get_file_properties")
-    
-    file_size = file_id.file_size
+    # only ids that resolved to a file count, made up ids would push real ones out of the top-K
+    popularity.hit(id)
+    uniques.add("file", id, fingerprint(request))
+
+    # ?faststart=1 serves MP4s with a trailing moov as if it were at the front
+    layout = None
+    if request.query.get("faststart"):
+        layout = await faststart.get(tg_connect, file_id, index)
+    file_size = layout.size if layout else file_id.file_size
 
     if range_header:
         from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
@@ -237,9 +335,16 @@ async def media_streamer(request: web.Request, id: int, secure_hash: str):
 
     req_length = until_bytes - from_bytes + 1
     part_count = math.ceil(until_bytes / chunk_size) - math.floor(offset / chunk_size)
-    body = tg_connect.yield_file(
-        file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-    )
+    if layout:
+        body = faststart.yield_range(
+            tg_connect, file_id, index, layout, from_bytes, until_bytes, chunk_size, session
+        )
+    else:
+        body = tg_connect.yield_file(
+            file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size, session
+        )
+    body = faststart.timed(body, "faststart" if layout else "original")
+    body = drain.track(coalesce(scheduler.shape(body, client_ip(request), id, classify(request))))
 
     mime_type = file_id.mime_type
     file_name = file_id.file_name
@@ -258,7 +363,7 @@ async def media_streamer(request: web.Request, id: int, secure_hash: str):
             mime_type = "application/octet-stream"
             file_name = f"{secrets.token_hex(2)}.unknown"
 
-    return web.Response(
+    response = web.Response(
         status=206 if range_header else 200,
         body=body,
         headers={
@@ -269,4 +374,6 @@ async def media_streamer(request: web.Request, id: int, secure_hash: str):
             "Accept-Ranges": "bytes",
         },
     )
+    response.set_cookie(COOKIE, token, max_age=STREAM_SESSION_TTL, httponly=True)
+    return response
 
@@ -1,15 +1,28 @@
+import html
 import random
+import asyncio
 import requests
 import humanize
 import base64
 from Script import script
 from pyrogram import Client, filters, enums
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ForceReply, CallbackQuery
-from info import LOG_CHANNEL, LINK_URL, ADMIN
-from plugins.database import checkdb, db, get_count, get_withdraw, record_withdraw, record_visit
+from info import LOG_CHANNEL, LINK_URL, ADMIN, ALBUM_WAIT, BATCH_MAX_FILES, BATCH_TIMEOUT
+from plugins.database import checkdb, db, get_withdraw, record_withdraw, record_visit
 from urllib.parse import quote_plus, urlencode
 from TechVJ.util.file_properties import get_name, get_hash, get_media_file_size
 from TechVJ.util.human_readable import humanbytes
+from TechVJ.util.ingest import ingest_media, ingest_many
+from TechVJ.util.file_library import file_library
+from TechVJ.util.media_index import media_index
+from TechVJ.util.profile_cache import profiles
+from TechVJ.util.uniques import uniques
+from TechVJ.util.broadcast import start_broadcast
+from TechVJ.util.scheduler import scheduler
+
+batch_sessions = {}
+album_buffers = {}
+library_queries = {}
 
 async def encode(string):
     try:
@@ -30,6 +43,26 @@ async def decode(base64_string):
     except:
         pass
 
+async def stream_link(user_id, first_id, second_id=0, third_id=0):
+    params = {'u': user_id, 'w': str(first_id), 's': str(second_id), 't': str(third_id)}
+    link = await encode(urlencode(params))
+    return f"{LINK_URL}?Tech_VJ={link}"
+
+async def reply_links(message, files, log_ids):
+    # one consolidated reply, split only where Telegram's 4096 chars limit forces it
+    lines = []
+    for file, log_id in zip(files, log_ids):
+        encoded_url = await stream_link(message.from_user.id, log_id)
+        lines.append(f"<b>{html.escape(getattr(file, 'file_name', None) or 'File')}</b>\n<code>{encoded_url}</code>")
+    text = ""
+    for line in lines:
+        if len(text) + len(line) + 2 > 4000:
+            await message.reply_text(text=text, disable_web_page_preview=True)
+            text = ""
+        text += line + "\n\n"
+    if text:
+        await message.reply_text(text=text, disable_web_page_preview=True)
+
 @Client.on_message(filters.command("start") & filters.private)
 async def start(client, message):
     if not await checkdb.is_user_exist(message.from_user.id):
@@ -45,6 +78,7 @@ async def start(client, message):
         else:
             return await message.reply("**Wrong Input Start Your Process Again By Hitting /start**")
         await checkdb.add_user(message.from_user.id, message.from_user.first_name)
+        profiles.invalidate(message.from_user.id)
         return await message.reply("<b>Congratulations 🎉\n\nYour Account Created Successfully.\n\nFor Uploading File In Quality Option Use Command /quality\n\nMore Commands Are /account and /update and /withdraw\n\nFor Without Quality Option Direct Send File To Bot.</b>")
     else:
         rm = InlineKeyboardMarkup([[InlineKeyboardButton("✨ Update Channel", url="https://t.me/FluxDrives")]])
@@ -65,6 +99,7 @@ async def update(client, message):
             return await message.reply("**Process Cancelled**")
         if name.text:
             await db.set_name(message.from_user.id, name=name.text)
+            profiles.invalidate(message.from_user.id)
         else:
             return await message.reply("**Wrong Input Start Your Process Again By Hitting /update**")
         link = await client.ask(message.chat.id, "<b>Now Send Me Your Telegram Channel Link, Channel Link Will Show On Your Website.\n\nSend Like This <code>https://t.me/FluxDrives</code> ✅\n\nDo not send like this @FluxDrives ❌</b>")
@@ -72,21 +107,61 @@ async def update(client, message):
             await db.set_link(message.from_user.id, link=link.text)
         else:
             return await message.reply("**Wrong Input Start Your Process Again By Hitting /update**")
+        profiles.invalidate(message.from_user.id)
         return await message.reply("<b>Update Successfully.</b>")
 
 @Client.on_message(filters.private & (filters.document | filters.video))
 async def stream_start(client, message):
-    file = getattr(message, message.media.value)
-    fileid = file.file_id
     user_id = message.from_user.id
-    log_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-    params = {'u': user_id, 'w': str(log_msg.id), 's': str(0), 't': str(0)}
-    url1 = f"{urlencode(params)}"
-    link = await encode(url1)
-    encoded_url = f"{LINK_URL}?Tech_VJ={link}"
+    if user_id in batch_sessions:
+        if len(batch_sessions[user_id]) >= BATCH_MAX_FILES:
+            return await message.reply(f"<b>A Batch Holds At Most {BATCH_MAX_FILES} Files, Send /done To Get Their Links.</b>")
+        batch_sessions[user_id].append(message)
+        return
+    if message.media_group_id:
+        return await album_start(client, message)
+    file = getattr(message, message.media.value)
+    log_msg_id = await ingest_media(client, file, user_id)
+    encoded_url = await stream_link(user_id, log_msg_id)
     rm=InlineKeyboardMarkup([[InlineKeyboardButton("🖇️ Open Link", url=encoded_url)]])
     await message.reply_text(text=f"<code>{encoded_url}</code>", reply_markup=rm)
 
+async def album_start(client, message):
+    # albums arrive as separate updates, collect them for ALBUM_WAIT seconds and ingest in one pass
+    group_id = message.media_group_id
+    if group_id in album_buffers:
+        album_buffers[group_id].append(message)
+        return
+    album_buffers[group_id] = [message]
+    await asyncio.sleep(ALBUM_WAIT)
+    messages = sorted(album_buffers.pop(group_id), key=lambda m: m.id)
+    log_ids = await ingest_many(client, messages)
+    await reply_links(messages[0], [getattr(m, m.media.value) for m in messages], log_ids)
+
+def expire_batch(user_id, messages):
+    # an abandoned /batch would hold its messages forever, a newer one is left alone
+    if batch_sessions.get(user_id) is messages:
+        del batch_sessions[user_id]
+
+@Client.on_message(filters.private & filters.command("batch"))
+async def batch_start(client, message):
+    messages = batch_sessions[message.from_user.id] = []
+    asyncio.get_running_loop().call_later(BATCH_TIMEOUT, expire_batch, message.from_user.id, messages)
+    await message.reply("<b>Batch Mode Started.\n\nNow Send Me All Your Files, When Done Send /done To Get All Links In One Message.</b>")
+
+@Client.on_message(filters.private & filters.command("done"))
+async def batch_done(client, message):
+    messages = batch_sessions.pop(message.from_user.id, None)
+    if messages is None:
+        return await message.reply("**No Batch In Progress, Start One With /batch**")
+    if not messages:
+        return await message.reply("**No Files Received, Batch Cancelled**")
+    status = await message.reply(f"<b>Creating {len(messages)} Links, Please Wait...</b>")
+    messages.sort(key=lambda m: m.id)
+    log_ids = await ingest_many(client, messages)
+    await status.delete()
+    await reply_links(message, [getattr(m, m.media.value) for m in messages], log_ids)
+
 @Client.on_message(filters.private & filters.command("quality"))
 async def quality_link(client, message):
     first_id = str(0)
@@ -97,27 +172,21 @@ async def quality_link(client, message):
         f_id = await client.ask(message.from_user.id, "Now Send Me Your 480p Quality File.")
         if f_id.video or f_id.document:
             file = getattr(f_id, f_id.media.value)
-            fileid = file.file_id
-            first_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-            first_id = str(first_msg.id)
+            first_id = str(await ingest_media(client, file, message.from_user.id))
         else:
             return await message.reply("Wrong Input, Start Process Again By /quality")
     elif first.text == "720":
         s_id = await client.ask(message.from_user.id, "Now Send Me Your 720p Quality File.")
         if s_id.video or s_id.document:
             file = getattr(s_id, s_id.media.value)
-            fileid = file.file_id
-            first_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-            second_id = str(first_msg.id)
+            second_id = str(await ingest_media(client, file, message.from_user.id))
         else:
             return await message.reply("Wrong Input, Start Process Again By /quality")
     elif first.text == "1080":
         t_id = await client.ask(message.from_user.id, "Now Send Me Your 1080p Quality File.")
         if t_id.video or t_id.document:
             file = getattr(t_id, t_id.media.value)
-            fileid = file.file_id
-            first_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-            third_id = str(first_msg.id)
+            third_id = str(await ingest_media(client, file, message.from_user.id))
         else:
             return await message.reply("Wrong Input, Start Process Again By /quality")
     else:
@@ -128,27 +197,21 @@ async def quality_link(client, message):
         f_id = await client.ask(message.from_user.id, "Now Send Me Your 480p Quality File.")
         if f_id.video or f_id.document:
             file = getattr(f_id, f_id.media.value)
-            fileid = file.file_id
-            first_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-            first_id = str(first_msg.id)
+            first_id = str(await ingest_media(client, file, message.from_user.id))
         else:
             return await message.reply("Wrong Input, Start Process Again By /quality")
     elif second.text != first.text and second.text == "720":
         s_id = await client.ask(message.from_user.id, "Now Send Me Your 720p Quality File.")
         if s_id.video or s_id.document:
             file = getattr(s_id, s_id.media.value)
-            fileid = file.file_id
-            first_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-            second_id = str(first_msg.id)
+            second_id = str(await ingest_media(client, file, message.from_user.id))
         else:
             return await message.reply("Wrong Input, Start Process Again By /quality")
     elif second.text != first.text and second.text == "1080":
         t_id = await client.ask(message.from_user.id, "Now Send Me Your 1080p Quality File.")
         if t_id.video or t_id.document:
             file = getattr(t_id, t_id.media.value)
-            fileid = file.file_id
-            first_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-            third_id = str(first_msg.id)
+            third_id = str(await ingest_media(client, file, message.from_user.id))
         else:
             return await message.reply("Wrong Input, Start Process Again By /quality")
     else:
@@ -159,27 +222,21 @@ async def quality_link(client, message):
         f_id = await client.ask(message.from_user.id, "Now Send Me Your 480p Quality File.")
         if f_id.video or f_id.document:
             file = getattr(f_id, f_id.media.value)
-            fileid = file.file_id
-            first_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-            first_id = str(first_msg.id)
+            first_id = str(await ingest_media(client, file, message.from_user.id))
         else:
             return await message.reply("Wrong Input, Start Process Again By /quality")
     elif third.text != second.text and third.text != first.text and third.text == "720":
         s_id = await client.ask(message.from_user.id, "Now Send Me Your 720p Quality File.")
         if s_id.video or s_id.document:
             file = getattr(s_id, s_id.media.value)
-            fileid = file.file_id
-            first_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-            second_id = str(first_msg.id)
+            second_id = str(await ingest_media(client, file, message.from_user.id))
         else:
             return await message.reply("Wrong Input, Start Process Again By /quality")
     elif third.text != second.text and third.text != first.text and third.text == "1080":
         t_id = await client.ask(message.from_user.id, "Now Send Me Your 1080p Quality File.")
         if t_id.video or t_id.document:
             file = getattr(t_id, t_id.media.value)
-            fileid = file.file_id
-            first_msg = await client.send_cached_media(chat_id=LOG_CHANNEL, file_id=fileid)
-            third_id = str(first_msg.id)
+            third_id = str(await ingest_media(client, file, message.from_user.id))
         else:
             return await message.reply("Wrong Input, Start Process Again By /quality")
     elif third.text == "/getlink":
@@ -199,7 +256,7 @@ async def quality_link(client, message):
     rm=InlineKeyboardMarkup([[InlineKeyboardButton("🖇️ Open Link", url=encoded_url)]])
     await message.reply_text(text=f"<code>{encoded_url}</code>", reply_markup=rm)
 
-@Client.on_message(filters.private & filters.text & ~filters.command(["account", "withdraw", "notify", "quality", "start", "update"]))
+@Client.on_message(filters.private & filters.text & ~filters.command(["account", "withdraw", "notify", "quality", "start", "update", "batch", "done", "broadcast", "files", "withdrawals", "policy"]))
 async def link_start(client, message):
     if not message.text.startswith(LINK_URL):
         return
@@ -227,14 +284,15 @@ async def link_start(client, message):
 
 @Client.on_message(filters.private & filters.command("account"))
 async def show_account(client, message):
-    link_clicks = get_count(message.from_user.id)
+    link_clicks = await db.get_link_clicks(message.from_user.id)
+    unique_viewers = await uniques.count("user", message.from_user.id)
     if link_clicks:
         # Calculate balance using the reduced link clicks
         balance = link_clicks / 1000.0  # Use floating-point division
         formatted_balance = f"{balance:.2f}"  # Format to 2 decimal places
-        response = f"<b>Your Api Key :- <code>{message.from_user.id}</code>\n\nVideo Plays :- {link_clicks} ( Delay To Show Data )\n\nBalance :- ${formatted_balance}</b>"
+        response = f"<b>Your Api Key :- <code>{message.from_user.id}</code>\n\nVideo Plays :- {link_clicks} ( Delay To Show Data )\n\nUnique Viewers (30 Days) :- {unique_viewers}\n\nBalance :- ${formatted_balance}</b>"
     else:
-        response = f"<b>Your Api Key :- <code>{message.from_user.id}</code>\nVideo Plays :- 0 ( Delay To Show Data )\nBalance :- $0</b>" 
+        response = f"<b>Your Api Key :- <code>{message.from_user.id}</code>\nVideo Plays :- 0 ( Delay To Show Data )\nUnique Viewers (30 Days) :- {unique_viewers}\nBalance :- $0</b>" 
     await message.reply(response)
 
 @Client.on_message(filters.private & filters.command("withdraw"))
@@ -242,7 +300,7 @@ async def show_withdraw(client, message):
     w = get_withdraw(message.from_user.id)
     if w == True:
         return await message.reply("One Withdrawal Is In Process Wait For Complete It")
-    link_clicks = get_count(message.from_user.id)
+    link_clicks = await db.get_link_clicks(message.from_user.id)
     if not link_clicks:
         return await message.reply("**You Are Not Eligible For Withdrawal.\nMinimum Withraw Is 1000 Link Clicks or Video Plays.**")
     if link_clicks >= 1000:
@@ -292,6 +350,7 @@ async def show_withdraw(client, message):
             text += upi
             text += f"Traffic Link - {traffic.text}"
             await client.send_message(ADMIN, text)
+            await db.hold_link_clicks(message.from_user.id, link_clicks)
             record_withdraw(message.from_user.id, True)
             await message.reply(f"Your Withdrawal Balance - ${formatted_balance}/n/nNow Your Withdrawal Send To Owner, If Everything Fullfill The Criteria Then You Will Get Your Payment Within 3 Working Days.")
     else:
@@ -299,19 +358,146 @@ async def show_withdraw(client, message):
         
 @Client.on_message(filters.private & filters.command("notify") & filters.chat(ADMIN))
 async def show_notify(client, message):
-    count = int(1)
     user_id = await client.ask(message.from_user.id, "Now Send Me Api Key Of User")
     if int(user_id.text):
         sub = await client.ask(message.from_user.id, "Payment Is Cancelled Or Send Successfully. /send or /cancel")
         if sub.text == "/send":
-            record_visits(user_id.text, count)
+            # only the clicks that were paid out, not the ones counted since the request
+            paid = await db.get_held_clicks(int(user_id.text))
+            await db.reset_link_clicks(int(user_id.text), paid)
             record_withdraw(user_id.text, False)
             await client.send_message(user_id.text, "Your Withdrawal Is Successfully Completed And Sended To Your Bank Account.")
         else:
             reason = await client.ask(message.from_user.id, "Send Me The Reason For Cancellation Of Payment")
             if reason.text:
-                record_visits(user_id.text, count)
+                # nothing was paid, the hold goes and the clicks stay
+                await db.reset_link_clicks(int(user_id.text), 0)
                 record_withdraw(user_id.text, False)
                 await client.send_message(user_id.text, f"Your Payment Cancelled - {reason.text}")
     await message.reply("Successfully Message Send.")
-    
+
+@Client.on_message(filters.private & filters.command("broadcast") & filters.chat(ADMIN))
+async def broadcast(client, message):
+    if not message.reply_to_message:
+        return await message.reply("**Reply To The Message You Want To Broadcast With /broadcast**")
+    # helper bots can only copy what they can see, so the message goes through LOG_CHANNEL
+    source = await message.reply_to_message.copy(LOG_CHANNEL)
+    status = await message.reply("<b>Broadcast Started...</b>")
+    asyncio.create_task(start_broadcast(client, source.id, status.chat.id, status.id))
+
+async def files_page(user_id, cursor=None):
+    files, next_cursor = await db.get_user_files_page(user_id, cursor=cursor, limit=10)
+    if not files:
+        return "<b>No Files Found.</b>", None
+    text = "<b>Your Files</b>\n\n"
+    for file in files:
+        encoded_url = await stream_link(user_id, file["message_id"])
+        text += f"<b>{html.escape(file.get('file_name') or 'File')}</b> ({humanbytes(file.get('file_size'))})\n<code>{encoded_url}</code>\n\n"
+    rm = InlineKeyboardMarkup([[InlineKeyboardButton("Next ➡️", callback_data=f"files:{next_cursor}")]]) if next_cursor else None
+    return text, rm
+
+async def search_page(user_id, query, page=0):
+    results, total = await file_library.search(user_id, query, page)
+    if not results:
+        return f"<b>No Files Found For</b> <code>{html.escape(query)}</code>", None
+    text = f"<b>{total} Files Found For</b> <code>{html.escape(query)}</code>\n\n"
+    for message_id, title, size in results:
+        encoded_url = await stream_link(user_id, message_id)
+        text += f"<b>{html.escape(title)}</b> ({humanbytes(size)})\n<code>{encoded_url}</code>\n\n"
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Back", callback_data=f"fs:{page - 1}"))
+    if (page + 1) * 10 < total:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"fs:{page + 1}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+@Client.on_message(filters.private & filters.command("files"))
+async def show_files(client, message):
+    if len(message.command) > 1:
+        query = message.text.split(None, 1)[1]
+        library_queries[message.from_user.id] = query
+        text, rm = await search_page(message.from_user.id, query)
+    else:
+        text, rm = await files_page(message.from_user.id)
+    await message.reply_text(text=text, reply_markup=rm, disable_web_page_preview=True)
+
+async def withdrawals_page(cursor=None):
+    withdrawals, next_cursor = await db.get_pending_withdrawals_page(cursor=cursor, limit=10)
+    if not withdrawals:
+        return "<b>No Pending Withdrawals.</b>", None
+    text = "<b>Pending Withdrawals</b>\n\n"
+    for w in withdrawals:
+        text += f"Api Key - <code>{w['user_id']}</code>\nAmount - ${w['amount']:.2f}\nMethod - {html.escape(str(w.get('method')))}\nRequested - {w['requested_date']:%Y-%m-%d %H:%M}\n\n"
+    rm = InlineKeyboardMarkup([[InlineKeyboardButton("Next ➡️", callback_data=f"wd:{next_cursor}")]]) if next_cursor else None
+    return text, rm
+
+@Client.on_message(filters.private & filters.command("withdrawals") & filters.chat(ADMIN))
+async def show_withdrawals(client, message):
+    text, rm = await withdrawals_page()
+    await message.reply_text(text=text, reply_markup=rm)
+
+async def users_page(cursor=None):
+    users, next_cursor = await db.get_users_page(cursor=cursor, limit=20,
+                                                 projection={"user_id": 1, "name": 1, "link_clicks": 1})
+    if not users:
+        return "<b>No Users Found.</b>", None
+    text = "<b>Users</b>\n\n"
+    for u in users:
+        text += f"Api Key - <code>{u['user_id']}</code>\nName - {html.escape(str(u.get('name') or ''))}\nVideo Plays - {u.get('link_clicks', 0)}\n\n"
+    rm = InlineKeyboardMarkup([[InlineKeyboardButton("Next ➡️", callback_data=f"us:{next_cursor}")]]) if next_cursor else None
+    return text, rm
+
+@Client.on_message(filters.private & filters.command("users") & filters.chat(ADMIN))
+async def show_users(client, message):
+    text, rm = await users_page()
+    await message.reply_text(text=text, reply_markup=rm)
+
+async def earnings_page(user_id, cursor=None):
+    earnings, next_cursor = await db.get_user_earnings_page(user_id, cursor=cursor, limit=20)
+    if not earnings:
+        return "<b>No Earnings In The Last 30 Days.</b>", None
+    text = "<b>Your Earnings (30 Days)</b>\n\n"
+    for e in earnings:
+        text += f"{e['date']:%Y-%m-%d %H:%M} - ${e.get('amount', 0):.4f}\n"
+    rm = InlineKeyboardMarkup([[InlineKeyboardButton("Next ➡️", callback_data=f"ea:{next_cursor}")]]) if next_cursor else None
+    return text, rm
+
+@Client.on_message(filters.private & filters.command("earnings"))
+async def show_earnings(client, message):
+    text, rm = await earnings_page(message.from_user.id)
+    await message.reply_text(text=text, reply_markup=rm)
+
+@Client.on_message(filters.private & filters.command("policy") & filters.chat(ADMIN))
+async def set_policy(client, message):
+    if len(message.command) == 3:
+        try:
+            await scheduler.set(message.command[1], int(message.command[2]))
+        except (KeyError, ValueError):
+            return await message.reply_text("<b>Usage :- /policy name value</b>")
+    text = "<b>Streaming Policy</b>\n\n"
+    for name, value in scheduler.policy.items():
+        text += f"{name} :- <code>{value}</code>\n"
+    await message.reply_text(text)
+
+@Client.on_callback_query(filters.regex(r"^(files|wd|fs|us|ea):"))
+async def next_page(client, query: CallbackQuery):
+    kind, cursor = query.data.split(":", 1)
+    if kind == "files":
+        text, rm = await files_page(query.from_user.id, cursor)
+    elif kind == "fs":
+        if query.from_user.id not in library_queries:
+            return await query.answer("Search Again With /files", show_alert=True)
+        text, rm = await search_page(query.from_user.id, library_queries[query.from_user.id], int(cursor))
+    elif kind == "ea":
+        text, rm = await earnings_page(query.from_user.id, cursor)
+    elif query.from_user.id == ADMIN:
+        text, rm = await (users_page(cursor) if kind == "us" else withdrawals_page(cursor))
+    else:
+        return await query.answer()
+    await query.message.edit_text(text=text, reply_markup=rm, disable_web_page_preview=True)
+
+@Client.on_message(filters.chat(LOG_CHANNEL))
+async def log_channel_post(client, message):
+    # posts made directly in LOG_CHANNEL, indexed now and the newest id bounds the background walk
+    media_index.seen(message.id)
+    await media_index.add(message)
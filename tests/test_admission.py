@@ -0,0 +1,54 @@
+"""
+Admission control sheds new streams once the scheduler's fetch slots are saturated.
+
+    python -m unittest tests.test_admission
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# info.py refuses to load without these, nothing here talks to Telegram or the database
+for name, value in (("API_ID", "1"), ("API_HASH", "x"), ("BOT_TOKEN", "1:x"), ("LOG_CHANNEL", "-100"),
+                    ("ADMINS", "1"), ("STREAM_LINK", "http://localhost/"),
+                    ("MONGODB_URI", "mongodb://127.0.0.1:27017/?serverSelectionTimeoutMS=100")):
+    os.environ.setdefault(name, value)
+
+from aiohttp import web
+from TechVJ.util import admission as admission_module
+from TechVJ.util.admission import AdmissionController, STREAM
+from TechVJ.util.scheduler import scheduler, INTERACTIVE
+
+
+class AdmissionTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.admission = AdmissionController()
+        patcher = mock.patch.object(admission_module, "ADMISSION_WAIT", 0.2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, scheduler, "in_use", scheduler.in_use)
+
+    async def test_admits_with_free_slots(self):
+        scheduler.in_use = 0
+        await self.admission.check(STREAM)
+        self.assertEqual(self.admission.admitted[STREAM], 1)
+
+    async def test_sheds_new_stream_when_slots_are_taken(self):
+        # the default GetFile threshold is never reached, every slot is taken all the same
+        scheduler.in_use = scheduler.capacity
+        with self.assertRaises(web.HTTPServiceUnavailable) as raised:
+            await self.admission.check(STREAM)
+        self.assertIn("Retry-After", raised.exception.headers)
+        self.assertEqual(self.admission.rejected[STREAM], 1)
+
+    async def test_sheds_new_stream_when_viewers_queue(self):
+        scheduler.in_use = 0
+        queued = {"203.0.113.1": [(None, 1)]}
+        with mock.patch.dict(scheduler.queues[INTERACTIVE], queued):
+            self.assertTrue(self.admission.saturated)
+            self.assertFalse(await self.admission.admit(STREAM))
+
+
+if __name__ == "__main__":
+    unittest.main()